@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+import os
+import gzip
+import json
+import time
+import shutil
+import tarfile
+import threading
+import subprocess
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import trash
+
+ARCHIVE_NAME = 'archive.tar.zst'
+INDEX_NAME = 'archive.index.jsonl.gz'
+DEFAULT_BLOCK_SIZE = 16 * 1024 * 1024
+CACHED_BLOCKS = 16
+
+def is_archive_snapshot(snapshot_path):
+    """Check whether a backup directory has been packed into an archive"""
+    return os.path.isfile(os.path.join(snapshot_path, INDEX_NAME))
+
+def available():
+    return zstandard is not None or shutil.which('zstd') is not None
+
+def compress_block(data, level):
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    result = subprocess.run(['zstd', '-q', '-c', f"-{level}"], input=data, capture_output=True, check=True)
+    return result.stdout
+
+def decompress_block(data, block_size):
+    if zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=block_size)
+    result = subprocess.run(['zstd', '-q', '-d', '-c'], input=data, capture_output=True, check=True)
+    return result.stdout
+
+def iter_index(snapshot_path):
+    """Yield the file entries of an archive index"""
+    with gzip.open(os.path.join(snapshot_path, INDEX_NAME), 'rt', encoding='utf-8') as f:
+        for line in f:
+            entry = json.loads(line)
+            if 'path' in entry:
+                yield entry
+
+def archive_bytes(snapshot_path):
+    """Disk space taken by a snapshot's archive files"""
+    return sum(os.path.getsize(os.path.join(snapshot_path, name))
+               for name in (ARCHIVE_NAME, INDEX_NAME)
+               if os.path.exists(os.path.join(snapshot_path, name)))
+
+class BlockWriter:
+    """File-like sink that cuts a stream into fixed-size blocks and compresses each as its own zstd frame
+
+    Concatenated zstd frames are still one valid .zst stream, so
+    `zstd -d < archive.tar.zst | tar x` unpacks the archive without this
+    tool, while the block table lets a reader decompress only the blocks
+    that hold one file. Blocks are compressed on a thread pool.
+
+    out is a path, or an open binary file that stays open (e.g. stdout).
+    """
+
+    def __init__(self, out, block_size, level, threads):
+        self.owns_out = isinstance(out, str)
+        self.out = open(out, 'wb') if self.owns_out else out
+        self.block_size = block_size
+        self.level = level
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.position = 0
+        self.blocks = []
+        self.compressed = 0
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def submit(self, block):
+        self.pending.append(self.executor.submit(compress_block, block, self.level))
+        # Bound the memory held by blocks waiting to be written
+        while len(self.pending) > 2 * self.threads:
+            self.write_next()
+
+    def write_next(self):
+        data = self.pending.popleft().result()
+        self.out.write(data)
+        self.blocks.append([self.compressed, len(data)])
+        self.compressed += len(data)
+
+    def close(self):
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.write_next()
+        self.executor.shutdown()
+        self.out.flush()
+        if self.owns_out:
+            os.fsync(self.out.fileno())
+            self.out.close()
+
+def pack_snapshot(snapshot_path, level=10, threads=4, block_size=DEFAULT_BLOCK_SIZE):
+    """Pack a plain snapshot into archive.tar.zst plus a seekable index; return stats
+
+    The snapshot's own files are left in place; the index is renamed into
+    place last, so its presence means the archive is complete.
+    """
+    archive_tmp = os.path.join(snapshot_path, ARCHIVE_NAME + '.tmp')
+    index_tmp = os.path.join(snapshot_path, INDEX_NAME + '.tmp')
+    stats = {'files': 0, 'bytes': 0}
+
+    writer = BlockWriter(archive_tmp, block_size, level, threads)
+    with gzip.open(index_tmp, 'wt', encoding='utf-8') as index, \
+            tarfile.open(fileobj=writer, mode='w', format=tarfile.PAX_FORMAT) as tar:
+        for root, dirs, files in os.walk(snapshot_path):
+            dirs.sort()
+            rel_root = os.path.relpath(root, snapshot_path)
+            for name in sorted(dirs) + sorted(files):
+                full_path = os.path.join(root, name)
+                rel_path = name if rel_root == '.' else os.path.join(rel_root, name)
+                if rel_root == '.' and name.startswith((ARCHIVE_NAME, INDEX_NAME)):
+                    continue
+
+                st = os.lstat(full_path)
+                info = tar.gettarinfo(full_path, rel_path)
+                if info.islnk():
+                    # Store every hardlink with its own data, so each file extracts on its own
+                    info.type = tarfile.REGTYPE
+                    info.linkname = ''
+                    info.size = st.st_size
+
+                entry = {'path': rel_path, 'mtime': st.st_mtime, 'mtime_ns': st.st_mtime_ns, 'mode': info.mode}
+                if info.isfile():
+                    with open(full_path, 'rb') as f:
+                        tar.addfile(info, f)
+                    # Data ends at the current offset, padded to the tar block size
+                    padded = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                    entry.update(size=info.size, offset=tar.offset - padded)
+                    stats['files'] += 1
+                    stats['bytes'] += info.size
+                elif info.issym():
+                    tar.addfile(info)
+                    entry.update(size=0, link=info.linkname)
+                else:
+                    tar.addfile(info)
+                    continue
+                index.write(json.dumps(entry) + '\n')
+
+    writer.close()
+    with gzip.open(index_tmp, 'at', encoding='utf-8') as index:
+        index.write(json.dumps({'block_size': block_size, 'blocks': writer.blocks,
+                                'created': time.time()}) + '\n')
+    with open(index_tmp, 'rb') as f:
+        os.fsync(f.fileno())
+
+    os.replace(archive_tmp, os.path.join(snapshot_path, ARCHIVE_NAME))
+    os.replace(index_tmp, os.path.join(snapshot_path, INDEX_NAME))
+    stats['archive_bytes'] = archive_bytes(snapshot_path)
+    return stats
+
+def unpacked_items(snapshot_path):
+    """Return the entries of an archived snapshot that are not part of the archive"""
+    return [name for name in os.listdir(snapshot_path) if not name.startswith((ARCHIVE_NAME, INDEX_NAME))]
+
+def trash_unpacked(backup_dest, snapshot_path):
+    """Move an archived snapshot's original files into the trash in one directory; return the count"""
+    items = unpacked_items(snapshot_path)
+    if not items:
+        return 0
+    # Gather them in one folder first, so the trash gets a single rename
+    holder = os.path.join(snapshot_path, f".unpacked-{os.path.basename(snapshot_path)}")
+    os.makedirs(holder, exist_ok=True)
+    for name in items:
+        if name != os.path.basename(holder):
+            os.rename(os.path.join(snapshot_path, name), os.path.join(holder, name))
+    trash.move_to_trash(backup_dest, holder)
+    return len(items)
+
+class ArchiveReader:
+    """Random access to the files of an archived snapshot
+
+    Only the blocks holding a file are read and decompressed; recently used
+    blocks are cached, so restoring many small neighbouring files costs
+    about one decompression per block.
+    """
+
+    def __init__(self, snapshot_path):
+        self.path = os.path.join(snapshot_path, ARCHIVE_NAME)
+        self.entries = {}
+        self.blocks = []
+        self.block_size = DEFAULT_BLOCK_SIZE
+        with gzip.open(os.path.join(snapshot_path, INDEX_NAME), 'rt', encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                if 'path' in entry:
+                    self.entries[entry['path']] = entry
+                else:
+                    self.blocks = entry['blocks']
+                    self.block_size = entry['block_size']
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def block(self, number):
+        with self.lock:
+            data = self.cache.get(number)
+            if data is not None:
+                self.cache.move_to_end(number)
+                return data
+
+        offset, length = self.blocks[number]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = decompress_block(f.read(length), self.block_size)
+
+        with self.lock:
+            self.cache[number] = data
+            while len(self.cache) > CACHED_BLOCKS:
+                self.cache.popitem(last=False)
+        return data
+
+    def read_chunks(self, entry):
+        """Yield the content of a file entry in pieces"""
+        offset = entry['offset']
+        end = offset + entry['size']
+        while offset < end:
+            number = offset // self.block_size
+            block_start = number * self.block_size
+            data = self.block(number)
+            piece = data[offset - block_start:min(end - block_start, len(data))]
+            if not piece:
+                raise IOError(f"Archive {self.path} is truncated")
+            yield piece
+            offset += len(piece)
+
+    def extract(self, entry, destination):
+        """Write one file (or symlink) of the archive to destination"""
+        if 'link' in entry:
+            if os.path.lexists(destination):
+                os.remove(destination)
+            os.symlink(entry['link'], destination)
+            return
+        with open(destination, 'wb') as f:
+            for piece in self.read_chunks(entry):
+                f.write(piece)
+        os.chmod(destination, entry['mode'] & 0o7777)
+        os.utime(destination, ns=(entry['mtime_ns'], entry['mtime_ns']))
+
+    def read(self, path):
+        return b''.join(self.read_chunks(self.entries[path]))
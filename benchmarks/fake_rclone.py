@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""Stand-in for the rclone binary, backed by local directories
+
+Implements the subset of rclone that the backup tools call (version,
+listremotes, lsjson, lsd, sync, copy, with filters, --files-from,
+--dry-run, JSON logs and the core/bwlimit rc call). A remote path is
+"name:/absolute/path". Faults are injected through the environment:
+
+    FAKE_RCLONE_REMOTES          remotes printed by listremotes (default "bench:")
+    FAKE_RCLONE_OBJECTHANDLE     comma-separated globs of folders and files that fail
+                                 with "ObjectHandle is Invalid"
+    FAKE_RCLONE_THROTTLE_RATE    share of API calls answered with 429 Too Many Requests
+    FAKE_RCLONE_THROTTLE_DELAY   seconds a throttled call waits before it is retried
+    FAKE_RCLONE_LATENCY          seconds added to every API call (listing or file)
+    FAKE_RCLONE_SEED             seed for the throttling dice
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import base64
+import random
+import fnmatch
+import hashlib
+import threading
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import integrity
+
+VALUED_OPTIONS = {
+    '--bwlimit', '--transfers', '--checkers', '--stats', '--stats-log-level', '--exclude-from',
+    '--exclude', '--include', '--filter', '--files-from', '--retries', '--low-level-retries',
+    '--contimeout', '--timeout', '--max-depth', '--hash-type', '--rc-addr', '--rc-user',
+    '--rc-pass', '--tpslimit', '--tpslimit-burst', '--max-transfer', '--order-by',
+    '--buffer-size', '--log-file', '--log-level', '--modify-window', '--multi-thread-streams',
+    '--multi-thread-cutoff', '--onedrive-chunk-size', '--config',
+}
+UNITS = {'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+class Options:
+    """Command-line options: flags, repeatable valued options and positional arguments"""
+
+    def __init__(self, argv):
+        self.flags = set()
+        self.values = {}
+        self.positional = []
+        i = 0
+        while i < len(argv):
+            arg = argv[i]
+            if arg.startswith('--') and '=' in arg:
+                name, value = arg.split('=', 1)
+                self.values.setdefault(name, []).append(value)
+            elif arg in VALUED_OPTIONS and i + 1 < len(argv):
+                self.values.setdefault(arg, []).append(argv[i + 1])
+                i += 1
+            elif arg.startswith('-') and len(arg) > 1:
+                self.flags.add(arg)
+            else:
+                self.positional.append(arg)
+            i += 1
+
+    def get(self, name, default=None):
+        return self.values.get(name, [default])[-1]
+
+    def all(self, name):
+        return self.values.get(name, [])
+
+def local_path(remote_path):
+    """Map "name:/path" (or a plain local path) to a local path"""
+    if ':' in remote_path and not remote_path.startswith('/'):
+        remote_path = remote_path.split(':', 1)[1] or '/'
+    return remote_path
+
+def glob_to_regex(pattern):
+    out = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**', i):
+            out += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            out += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            out += '[^/]'
+            i += 1
+        else:
+            out += re.escape(pattern[i])
+            i += 1
+    return out
+
+class Filter:
+    """rclone's --exclude / --exclude-from rules (globs, '/' anchors, trailing '/' for folders)"""
+
+    def __init__(self, options):
+        patterns = list(options.all('--exclude'))
+        for path in options.all('--exclude-from'):
+            with open(path, 'r') as f:
+                patterns.extend(line.strip() for line in f)
+        self.file_rules = []
+        self.dir_rules = []
+        for pattern in patterns:
+            if not pattern or pattern.startswith('#'):
+                continue
+            rules = self.dir_rules if pattern.endswith('/') else self.file_rules
+            pattern = pattern.rstrip('/')
+            prefix = '^' if pattern.startswith('/') else '(^|/)'
+            rules.append(re.compile(prefix + glob_to_regex(pattern.lstrip('/')) + '$'))
+
+    def excluded_dir(self, rel_path):
+        return any(rule.search(rel_path) for rule in self.dir_rules)
+
+    def excluded_file(self, rel_path):
+        return any(rule.search(rel_path) for rule in self.file_rules)
+
+class Faults:
+    def __init__(self):
+        self.bad = [p for p in os.environ.get('FAKE_RCLONE_OBJECTHANDLE', '').split(',') if p]
+        self.throttle_rate = float(os.environ.get('FAKE_RCLONE_THROTTLE_RATE', 0) or 0)
+        self.throttle_delay = float(os.environ.get('FAKE_RCLONE_THROTTLE_DELAY', 0.5) or 0)
+        self.latency = float(os.environ.get('FAKE_RCLONE_LATENCY', 0) or 0)
+        self.random = random.Random(os.environ.get('FAKE_RCLONE_SEED') or None)
+
+    def is_bad(self, path):
+        return any(fnmatch.fnmatch(path, '*/' + pattern) or fnmatch.fnmatch(path, pattern)
+                   for pattern in self.bad)
+
+    def api_call(self):
+        """Wait like one API round trip; True if the call was throttled first"""
+        throttled = self.throttle_rate and self.random.random() < self.throttle_rate
+        if throttled:
+            time.sleep(self.throttle_delay)
+        if self.latency:
+            time.sleep(self.latency)
+        return throttled
+
+class Output:
+    def __init__(self, options):
+        self.json = '--use-json-log' in options.flags
+        self.verbose = bool(options.flags & {'-v', '--verbose', '-vv', '-P', '--progress'})
+
+    def log(self, level, message, obj=None):
+        if self.json:
+            entry = {'level': level, 'msg': message, 'source': 'fake_rclone'}
+            if obj is not None:
+                entry['object'] = obj
+            print(json.dumps(entry), flush=True)
+        elif level in ('error', 'notice') or self.verbose:
+            stamp = datetime.now().strftime('%Y/%m/%d %H:%M:%S')
+            print(f"{stamp} {level.upper():<6}: " + (f"{obj}: " if obj else "") + message, flush=True)
+
+    def stats(self, stats, elapsed):
+        speed = stats['bytes'] / max(elapsed, 1e-6)
+        if self.json:
+            print(json.dumps({'level': 'notice', 'msg': 'stats', 'stats': dict(stats, speed=speed, eta=0)}),
+                  flush=True)
+        else:
+            print(f"Transferred: {stats['bytes']} B, {stats['transfers']} files, "
+                  f"{stats['checks']} checks, {stats['errors']} errors", flush=True)
+
+def parse_rate(text):
+    if not text or text == 'off' or ' ' in text or ',' in text:
+        return None  # timetables are not emulated
+    match = re.match(r'^([\d.]+)([BKMG]?)', text.upper())
+    return float(match.group(1)) * UNITS[match.group(2) or 'K'] if match else None
+
+class Limiter:
+    """--bwlimit, adjustable through the rc API"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.sent = 0
+
+    def set(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.start = time.monotonic()
+            self.sent = 0
+
+    def consume(self, count):
+        with self.lock:
+            self.sent += count
+            ahead = self.sent / self.rate - (time.monotonic() - self.start) if self.rate else 0
+        if ahead > 0:
+            time.sleep(ahead)
+
+def start_rc(address, limiter, user=None, password=None):
+    host, port = address.rsplit(':', 1)
+    expected = 'Basic ' + base64.b64encode(f"{user}:{password}".encode()).decode() if user else None
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if expected and self.headers.get('Authorization') != expected:
+                self.send_response(401)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            result = {}
+            if self.path.strip('/') == 'core/bwlimit' and 'rate' in params:
+                limiter.set(parse_rate(params['rate']))
+                result = {'rate': params['rate'], 'bytesPerSecond': int(limiter.rate or -1)}
+            body = json.dumps(result).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), Handler)
+    except OSError as e:
+        # rclone exits the same way when the rc port is taken
+        print(f"Failed to start remote control: {e}", file=sys.stderr)
+        sys.exit(1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+def modtime(st):
+    return datetime.fromtimestamp(st.st_mtime, timezone.utc).isoformat().replace('+00:00', 'Z')
+
+def file_hash(path, hash_type):
+    hasher = integrity.QuickXorHash() if hash_type == 'quickxor' else hashlib.new(hash_type)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    # rclone prints every hash as lowercase hex, quickxor included
+    return hasher.digest().hex()
+
+def walk(root, filters, faults, output, recursive=True):
+    """Yield (relative path, is_dir, stat) below root, honouring filters and ObjectHandle faults"""
+    pending = ['']
+    while pending:
+        rel_dir = pending.pop()
+        full_dir = os.path.join(root, rel_dir)
+        faults.api_call()
+        if rel_dir and faults.is_bad(full_dir):
+            output.log('error', "error listing: invalidRequest: ObjectHandle is Invalid", rel_dir)
+            yield rel_dir, None, None
+            continue
+        with os.scandir(full_dir) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if filters.excluded_dir(rel_path):
+                        continue
+                    yield rel_path, True, entry.stat(follow_symlinks=False)
+                    if recursive:
+                        pending.append(rel_path)
+                elif not filters.excluded_file(rel_path):
+                    yield rel_path, False, entry.stat(follow_symlinks=False)
+
+def cmd_lsjson(options, faults):
+    root = local_path(options.positional[-1])
+    recursive = '-R' in options.flags or '--recursive' in options.flags
+    if options.get('--max-depth') == '1':
+        recursive = False
+    hash_types = options.get('--hash-type', 'quickxor').split(',') if '--hash' in options.flags else []
+
+    if not recursive and faults.is_bad(root):
+        print(f"ERROR : {options.positional[-1]}: error listing: invalidRequest: ObjectHandle is Invalid",
+              file=sys.stderr)
+        return 3
+    if not recursive and faults.api_call():
+        print(f"ERROR : {options.positional[-1]}: error listing: 429 Too Many Requests", file=sys.stderr)
+        return 1
+    if not os.path.isdir(root):
+        print(f"ERROR : {options.positional[-1]}: directory not found", file=sys.stderr)
+        return 3
+
+    class StderrOutput(Output):
+        def log(self, level, message, obj=None):
+            print(f"ERROR : {obj}: {message}", file=sys.stderr)
+
+    failed = False
+    print('[')
+    first = True
+    for rel_path, is_dir, st in walk(root, Filter(options), faults, StderrOutput(options), recursive):
+        if is_dir is None:
+            failed = True
+            continue
+        if (is_dir and '--files-only' in options.flags) or (not is_dir and '--dirs-only' in options.flags):
+            continue
+        item = {'Path': rel_path, 'Name': os.path.basename(rel_path), 'Size': -1 if is_dir else st.st_size,
+                'ModTime': modtime(st), 'IsDir': is_dir}
+        if hash_types and not is_dir:
+            item['Hashes'] = {name: file_hash(os.path.join(root, rel_path), name) for name in hash_types}
+        print(('' if first else ',\n') + json.dumps(item), end='')
+        first = False
+    print('\n]')
+    return 3 if failed else 0
+
+def cmd_lsd(options, faults):
+    root = local_path(options.positional[-1])
+    if faults.is_bad(root):
+        print(f"ERROR : {options.positional[-1]}: error listing: invalidRequest: ObjectHandle is Invalid",
+              file=sys.stderr)
+        return 3
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if os.path.isdir(path):
+            stamp = datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y-%m-%d %H:%M:%S')
+            print(f"          -1 {stamp}        -1 {name}")
+    return 0
+
+def same_file(source_st, dest_path):
+    try:
+        dest_st = os.stat(dest_path)
+    except FileNotFoundError:
+        return False
+    return dest_st.st_size == source_st.st_size and int(dest_st.st_mtime) == int(source_st.st_mtime)
+
+def copy_file(source, destination, limiter):
+    tmp_path = destination + '.partial'
+    with open(source, 'rb') as src, open(tmp_path, 'wb') as dst:
+        for block in iter(lambda: src.read(1024 * 1024), b''):
+            dst.write(block)
+            limiter.consume(len(block))
+    os.replace(tmp_path, destination)
+    st = os.stat(source)
+    os.utime(destination, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+def cmd_transfer(command, options, faults):
+    output = Output(options)
+    source = local_path(options.positional[0])
+    destination = local_path(options.positional[1])
+    dry_run = '--dry-run' in options.flags
+    limiter = Limiter(parse_rate(options.get('--bwlimit')))
+    if '--rc' in options.flags:
+        start_rc(options.get('--rc-addr', '127.0.0.1:5572'), limiter,
+                 options.get('--rc-user', os.environ.get('RCLONE_RC_USER')),
+                 options.get('--rc-pass', os.environ.get('RCLONE_RC_PASS')))
+
+    stats = {'bytes': 0, 'totalBytes': 0, 'transfers': 0, 'totalTransfers': 0, 'checks': 0, 'errors': 0}
+    started = time.monotonic()
+    wanted = None
+    if options.get('--files-from'):
+        with open(options.get('--files-from'), 'r') as f:
+            wanted = [line.rstrip('\n') for line in f if line.strip()]
+
+    if wanted is not None:
+        items = []
+        for rel_path in wanted:
+            try:
+                items.append((rel_path, False, os.stat(os.path.join(source, rel_path))))
+            except FileNotFoundError:
+                output.log('error', "Failed to copy: object not found", rel_path)
+                stats['errors'] += 1
+    else:
+        items = walk(source, Filter(options), faults, output)
+
+    seen = set()
+    for rel_path, is_dir, st in items:
+        if is_dir is None:
+            stats['errors'] += 1
+            continue
+        seen.add(rel_path)
+        target = os.path.join(destination, rel_path)
+        if is_dir:
+            if not dry_run:
+                os.makedirs(target, exist_ok=True)
+            continue
+        if faults.is_bad(os.path.join(source, rel_path)):
+            output.log('error', "Failed to copy: invalidRequest: ObjectHandle is Invalid", rel_path)
+            stats['errors'] += 1
+            continue
+        if same_file(st, target):
+            stats['checks'] += 1
+            continue
+        if faults.api_call():
+            output.log('error', "Failed to copy: 429 Too Many Requests: trying again", rel_path)
+        stats['totalTransfers'] += 1
+        stats['totalBytes'] += st.st_size
+        if not dry_run:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            copy_file(os.path.join(source, rel_path), target, limiter)
+        stats['transfers'] += 1
+        stats['bytes'] += st.st_size
+        output.log('info', "Copied (new)", rel_path)
+
+    if command == 'sync' and wanted is None and not stats['errors'] and os.path.isdir(destination):
+        # Like rclone, deletions are skipped when there were errors; excluded files stay
+        filters = Filter(options)
+        for root, dirs, files in os.walk(destination, topdown=False):
+            rel_root = os.path.relpath(root, destination)
+            for name in files:
+                rel_path = name if rel_root == '.' else os.path.join(rel_root, name)
+                if rel_path not in seen and not filters.excluded_file(rel_path) \
+                        and not any(filters.excluded_dir(part) for part in parents(rel_path)):
+                    if not dry_run:
+                        os.remove(os.path.join(root, name))
+                    output.log('info', "Deleted", rel_path)
+            if rel_root != '.' and rel_root not in seen and not filters.excluded_dir(rel_root) and not dry_run:
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass
+
+    output.stats(stats, time.monotonic() - started)
+    return 1 if stats['errors'] else 0
+
+def parents(rel_path):
+    parts = rel_path.split('/')[:-1]
+    return ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: fake_rclone.py COMMAND ...", file=sys.stderr)
+        return 1
+    command = sys.argv[1]
+    options = Options(sys.argv[2:])
+    faults = Faults()
+
+    if command == 'version':
+        print("rclone v1.66.0-fake\n- os/type: benchmark stand-in")
+        return 0
+    if command == 'listremotes':
+        print('\n'.join(os.environ.get('FAKE_RCLONE_REMOTES', 'bench:').split(',')))
+        return 0
+    if command == 'lsjson':
+        return cmd_lsjson(options, faults)
+    if command == 'lsd':
+        return cmd_lsd(options, faults)
+    if command in ('sync', 'copy'):
+        return cmd_transfer(command, options, faults)
+    print(f"fake_rclone: unsupported command {command}", file=sys.stderr)
+    return 2
+
+if __name__ == '__main__':
+    sys.exit(main())
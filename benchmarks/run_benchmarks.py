@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""Time backups, restores and scans against a synthetic OneDrive stand-in
+
+Each round builds a synthetic source tree, backs it up through
+fake_rclone.py (or a real rclone local remote with --real-rclone) and
+times the scenarios in order. Results are appended to a JSON-lines
+history tagged with the git commit, and compared with the last run that
+used the same parameters.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import statistics
+import subprocess
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+sys.path.insert(0, REPO)
+
+import onedrive_backup
+import restore
+import restore_engine
+import find_problem_files
+import synthetic_tree
+
+SCENARIOS = ['full_backup', 'incremental_backup', 'unchanged_backup', 'stats', 'list',
+             'search', 'restore', 'prune', 'problem_scan']
+BACKUP_SCENARIOS = ('full_backup', 'incremental_backup', 'unchanged_backup')
+# Scenarios that time the source rather than a backup, so they still run after a failed one
+INDEPENDENT_SCENARIOS = ('problem_scan',)
+HISTORY_FILE = os.path.join(HERE, 'history.jsonl')
+
+def git_commit():
+    """Return (short commit, whether tracked files have uncommitted changes)"""
+    try:
+        commit = subprocess.run(['git', '-C', REPO, 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', '-C', REPO, 'status', '--porcelain', '-uno'],
+                                    capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+
+def install_rclone(workdir, real):
+    """Put the rclone to benchmark first on PATH; return its name"""
+    if real:
+        if shutil.which('rclone') is None:
+            sys.exit("--real-rclone needs rclone on PATH")
+        # An rclone remote defined in the environment, backed by local disk
+        os.environ['RCLONE_CONFIG_BENCH_TYPE'] = 'local'
+        return 'real'
+
+    bin_dir = os.path.join(workdir, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    wrapper = os.path.join(bin_dir, 'rclone')
+    with open(wrapper, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(HERE, "fake_rclone.py")}" "$@"\n')
+    os.chmod(wrapper, 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    return 'fake'
+
+def inject_faults(args):
+    os.environ['FAKE_RCLONE_OBJECTHANDLE'] = args.objecthandle
+    os.environ['FAKE_RCLONE_THROTTLE_RATE'] = str(args.throttle_rate)
+    os.environ['FAKE_RCLONE_THROTTLE_DELAY'] = str(args.throttle_delay)
+    os.environ['FAKE_RCLONE_LATENCY'] = str(args.latency)
+    os.environ['FAKE_RCLONE_SEED'] = str(args.seed)
+
+def backup_config(args, source, destination, workdir):
+    config = onedrive_backup.OneDriveBackup.default_config()
+    config.update({
+        'source_type': args.source_type,
+        'rclone_remote': f"bench:{source}",
+        'local_source': source,
+        'local_sync_engine': args.local_engine,
+        'backup_destination': destination,
+        'log_file': os.path.join(workdir, 'backup.log'),
+        'rclone_options': ['--transfers', '8', '--checkers', '16', '--ignore-errors'],
+        'keep_versions': len(BACKUP_SCENARIOS) + 1,
+        'background_prune': False,
+        'parallel_workers': args.workers,
+        'snapshot_mode': args.snapshot_mode,
+        'storage_backend': args.storage_backend,
+        'change_detection': args.change_detection,
+        'adaptive_throttle': args.throttle_rate > 0,
+        'progress_interval': 3600,
+    })
+    return config
+
+def next_second():
+    """Snapshots are named by the second they start in, so never start two in the same one"""
+    time.sleep(1 - time.time() % 1 + 0.01)
+
+def timed(name, func, results, quiet=True):
+    start = time.perf_counter()
+    if quiet:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            value = func()
+    else:
+        value = func()
+    elapsed = time.perf_counter() - start
+    results[name] = {'seconds': round(elapsed, 3)}
+    print(f"  {name:<20} {elapsed:9.2f}s")
+    return value
+
+def run_round(args, number, workdir, scenarios):
+    """Run every scenario once in workdir; return ({scenario: result}, {scenario: failure}, source stats)
+
+    A failed scenario has no result, and once a backup fails the scenarios
+    that work on its snapshots are skipped rather than timed.
+    """
+    source = os.path.join(workdir, 'source')
+    destination = os.path.join(workdir, 'backup')
+    synthetic_tree.generate(source, args.files, args.depth, args.fanout, args.size_profile, args.seed)
+    paths = synthetic_tree.list_files(source)
+    source_bytes = sum(os.path.getsize(os.path.join(source, path)) for path in paths)
+
+    config = backup_config(args, source, destination, workdir)
+    backup = onedrive_backup.OneDriveBackup(os.path.join(workdir, 'config.json'), config=config,
+                                            account=f"benchmark-{number}")
+    results = {}
+    failures = {}
+
+    def fail(name, reason):
+        results.pop(name, None)
+        failures[name] = reason
+        print(f"  {name:<20} {'failed':>10}: {reason}")
+
+    def run_backup(name):
+        next_second()
+        success = timed(name, lambda: backup.run(), results)
+        record = backup.last_record or {}
+        if not success:
+            fail(name, f"backup failed, see {config['log_file']}")
+            return
+        results[name].update(success=True, files=record.get('files', 0),
+                             bytes=record.get('bytes', 0), errors=record.get('errors', 0))
+
+    for name in scenarios:
+        if failures and name not in INDEPENDENT_SCENARIOS:
+            failures[name] = 'skipped after a failed backup'
+            print(f"  {name:<20} {'skipped':>10}")
+            continue
+        if name == 'full_backup':
+            run_backup(name)
+        elif name == 'incremental_backup':
+            synthetic_tree.apply_churn(source, args.churn, args.size_profile, args.seed + 1)
+            run_backup(name)
+        elif name == 'unchanged_backup':
+            run_backup(name)
+        elif name == 'stats':
+            latest = backup.get_latest_backup()
+            timed(name, lambda: backup.get_backup_stats(latest), results)
+        elif name == 'list':
+            timed(name, lambda: [restore.backup_size(path) for label, path in restore.list_backups(destination)],
+                  results)
+        elif name == 'search':
+            matches = timed(name, lambda: restore.search_all_backups(restore.list_backups(destination), '*.pdf'),
+                            results)
+            results[name]['matches'] = sum(len(paths) for label, paths in matches)
+        elif name == 'restore':
+            target = os.path.join(workdir, 'restored')
+            latest = backup.get_latest_backup()
+            if latest is None:
+                fail(name, 'no backup to restore')
+                continue
+
+            def restore_all():
+                engine = restore_engine.RestoreEngine(latest, target, workers=8)
+                return engine.restore(engine.all_paths())
+            stats = timed(name, restore_all, results)
+            if stats['errors']:
+                fail(name, f"{len(stats['errors'])} files could not be restored")
+                continue
+            results[name].update(files=stats['files'], bytes=stats['bytes'], errors=0)
+        elif name == 'prune':
+            backup.config['keep_versions'] = 2
+            timed(name, backup.cleanup_old_backups, results)
+        elif name == 'problem_scan':
+            remote = config['rclone_remote']
+            found = timed(name, lambda: find_problem_files.find_problematic_path(
+                remote, args.scan_workers, os.path.join(workdir, 'scan_cache.json'), use_cache=False), results)
+            results[name]['problem_paths'] = len(found)
+
+    for name, result in results.items():
+        if result.get('files') and result['seconds']:
+            result['files_per_second'] = round(result['files'] / result['seconds'], 1)
+    return results, failures, {'files': len(paths), 'bytes': source_bytes}
+
+def summarize(rounds):
+    """Merge the results of several rounds: median and fastest time per scenario"""
+    merged = {}
+    for name in rounds[0]:
+        runs = [result[name]['seconds'] for result in rounds if name in result]
+        merged[name] = dict(rounds[-1][name], seconds=round(statistics.median(runs), 3),
+                            min=min(runs), runs=runs)
+    return merged
+
+def load_history(path):
+    try:
+        with open(path, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+def find_baseline(history, record, commit=None):
+    """The newest earlier record with the same parameters (and the given commit, if any)"""
+    for candidate in reversed(history):
+        if candidate is record or candidate['params'] != record['params']:
+            continue
+        if commit and not (candidate.get('commit') or '').startswith(commit):
+            continue
+        return candidate
+    return None
+
+def compare(baseline, record, threshold):
+    """Print both runs side by side; return the scenarios more than threshold percent slower"""
+    print(f"\nCompared with {baseline.get('commit')} ({baseline['time']}):")
+    print(f"  {'Scenario':<20} {'Before':>9} {'After':>9} {'Change':>8}")
+    slower = []
+    for name, result in record['results'].items():
+        before = baseline['results'].get(name, {}).get('seconds')
+        if not before:
+            print(f"  {name:<20} {'-':>9} {result['seconds']:>8.2f}s")
+            continue
+        change = (result['seconds'] - before) / before * 100
+        flag = ''
+        if change > threshold:
+            slower.append(name)
+            flag = '  slower'
+        print(f"  {name:<20} {before:>8.2f}s {result['seconds']:>8.2f}s {change:>+7.1f}%{flag}")
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the backup tools against a synthetic OneDrive')
+    parser.add_argument('--files', type=int, default=2000, help='Files in the synthetic source')
+    parser.add_argument('--depth', type=int, default=3, help='Folder nesting depth')
+    parser.add_argument('--fanout', type=int, default=4, help='Subfolders per folder')
+    parser.add_argument('--size-profile', choices=sorted(synthetic_tree.SIZE_PROFILES), default='office',
+                        help='File size distribution')
+    parser.add_argument('--churn', type=float, default=0.05,
+                        help='Share of files modified, deleted or added before the incremental backup')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the tree and the fault dice')
+    parser.add_argument('--workers', type=int, default=1, help='parallel_workers of the backup')
+    parser.add_argument('--snapshot-mode', default='hardlink', choices=['full', 'hardlink', 'reflink'])
+    parser.add_argument('--storage-backend', default='files', choices=['files', 'dedup'])
+    parser.add_argument('--change-detection', default='full', choices=['full', 'listing'])
+    parser.add_argument('--source-type', default='rclone', choices=['rclone', 'local'],
+                        help='Back up through rclone, or the tree as a local source')
+    parser.add_argument('--local-engine', default='rsync', choices=['rsync', 'builtin'],
+                        help='local_sync_engine for --source-type local')
+    parser.add_argument('--scan-workers', type=int, default=find_problem_files.DEFAULT_WORKERS,
+                        help='Parallel listings of the problem-file scan')
+    parser.add_argument('--objecthandle', default='', metavar='GLOBS',
+                        help='Comma-separated folders/files that fail with ObjectHandle is Invalid')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='Share of API calls that are throttled (429)')
+    parser.add_argument('--throttle-delay', type=float, default=0.2,
+                        help='Seconds a throttled call waits')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every API call')
+    parser.add_argument('--real-rclone', action='store_true',
+                        help='Use the installed rclone with a local remote instead of the stand-in (no faults)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='Comma-separated scenarios to time (full_backup always runs)')
+    parser.add_argument('--rounds', type=int, default=1, help='Repeat everything and keep the median')
+    parser.add_argument('--label', default='', help='Free-form note stored with the results')
+    parser.add_argument('--history', default=HISTORY_FILE, help='JSON-lines results history')
+    parser.add_argument('--baseline', metavar='COMMIT',
+                        help='Compare with the newest run of this commit (default: newest run with the same parameters)')
+    parser.add_argument('--fail-slower', type=float, metavar='PERCENT',
+                        help='Exit with status 1 if a scenario got slower than this')
+    parser.add_argument('--compare-only', action='store_true',
+                        help='Do not run; compare the newest history entry with its baseline')
+    parser.add_argument('--workdir', help='Where to build trees and backups (default: a temporary directory)')
+    parser.add_argument('--keep', action='store_true', help='Keep the work directory')
+
+    args = parser.parse_args()
+    threshold = args.fail_slower if args.fail_slower is not None else 10.0
+
+    if args.compare_only:
+        history = load_history(args.history)
+        if not history:
+            sys.exit(f"No benchmark history in {args.history}")
+        record = history[-1]
+    else:
+        scenarios = [name for name in SCENARIOS if name in args.scenarios.split(',') or name == 'full_backup']
+        workdir = args.workdir or tempfile.mkdtemp(prefix='onedrive-bench-')
+        os.makedirs(workdir, exist_ok=True)
+        rclone = install_rclone(workdir, args.real_rclone)
+        inject_faults(args)
+
+        rounds = []
+        failures = []
+        try:
+            for number in range(1, args.rounds + 1):
+                print(f"Round {number}/{args.rounds}: {args.files} files ({args.size_profile}), "
+                      f"{rclone} rclone, work directory {workdir}")
+                round_dir = os.path.join(workdir, f"round{number}")
+                results, failed, source = run_round(args, number, round_dir, scenarios)
+                rounds.append(results)
+                failures.extend((number, name, reason) for name, reason in failed.items())
+                if failed:
+                    break
+                if not args.keep:
+                    shutil.rmtree(round_dir, ignore_errors=True)
+        finally:
+            # A failed round's log and backups are kept for inspection
+            if not args.keep and not args.workdir and not failures:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+        if failures:
+            # Timings of an incomplete run would skew later comparisons, so nothing is recorded
+            print("\nBenchmark failed, no results recorded:")
+            for number, name, reason in failures:
+                print(f"  round {number}: {name}: {reason}")
+            sys.exit(1)
+
+        commit, dirty = git_commit()
+        params = {key: getattr(args, key) for key in (
+            'files', 'depth', 'fanout', 'size_profile', 'churn', 'seed', 'workers', 'snapshot_mode',
+            'storage_backend', 'change_detection', 'source_type', 'local_engine', 'scan_workers', 'objecthandle', 'throttle_rate',
+            'throttle_delay', 'latency')}
+        params['rclone'] = rclone
+        record = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'commit': commit,
+            'dirty': dirty,
+            'label': args.label,
+            'params': params,
+            'source': source,
+            'host': {'python': platform.python_version(), 'platform': platform.platform(),
+                     'cpus': os.cpu_count()},
+            'rounds': args.rounds,
+            'results': summarize(rounds),
+        }
+        history = load_history(args.history)
+        os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    baseline = find_baseline(history, record, args.baseline)
+    if baseline is None:
+        print("\nNo earlier run with the same parameters to compare with")
+        return
+    slower = compare(baseline, record, threshold)
+    if args.fail_slower is not None and slower:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Generate synthetic OneDrive-like source trees and apply churn to them"""
+
+import os
+import math
+import random
+import argparse
+
+# Log-normal file sizes: (median bytes, sigma, largest file)
+SIZE_PROFILES = {
+    'tiny': (2 * 1024, 0.8, 256 * 1024),
+    'office': (16 * 1024, 1.2, 32 * 1024 ** 2),
+    'photos': (3 * 1024 ** 2, 0.5, 24 * 1024 ** 2),
+    'mixed': (48 * 1024, 2.0, 256 * 1024 ** 2),
+}
+EXTENSIONS = ['.docx', '.xlsx', '.pdf', '.txt', '.jpg', '.png', '.pptx', '.md', '.csv', '.zip']
+# Files are dated in the past, so churned files always look newer
+BASE_TIME = 1_600_000_000
+
+def file_size(rng, profile):
+    median, sigma, largest = SIZE_PROFILES[profile]
+    return min(largest, int(rng.lognormvariate(math.log(median), sigma)))
+
+def write_file(path, size, rng, mtime):
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            count = min(remaining, 1024 * 1024)
+            f.write(rng.randbytes(count))
+            remaining -= count
+    os.utime(path, (mtime, mtime))
+
+def folder_names(depth, fanout):
+    """Relative paths of every folder in a tree of the given depth and fanout"""
+    folders = ['']
+    level = ['']
+    for d in range(depth):
+        level = [os.path.join(parent, f"Folder {d}-{i}" if i % 3 == 0 else f"folder_{d}_{i}")
+                 for parent in level for i in range(fanout)]
+        folders.extend(level)
+    return folders
+
+def generate(root, files=2000, depth=3, fanout=4, profile='office', seed=1):
+    """Create a tree of files under root; return (file count, total bytes)"""
+    rng = random.Random(seed)
+    folders = folder_names(depth, fanout)
+    for folder in folders:
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    total = 0
+    for n in range(files):
+        folder = rng.choice(folders)
+        name = f"file {n}{rng.choice(EXTENSIONS)}" if n % 7 == 0 else f"file_{n}{rng.choice(EXTENSIONS)}"
+        size = file_size(rng, profile)
+        write_file(os.path.join(root, folder, name), size, rng, BASE_TIME + rng.randrange(10 ** 7))
+        total += size
+    return files, total
+
+def list_files(root):
+    return sorted(os.path.relpath(os.path.join(dirpath, name), root)
+                  for dirpath, dirnames, filenames in os.walk(root) for name in filenames)
+
+def apply_churn(root, rate=0.05, profile='office', seed=2):
+    """Modify, delete and add files, rate being the share of files touched; return counts"""
+    rng = random.Random(seed)
+    paths = list_files(root)
+    touched = rng.sample(paths, min(len(paths), int(len(paths) * rate)))
+    counts = {'modified': 0, 'deleted': 0, 'added': 0}
+    now = int(BASE_TIME + 2 * 10 ** 7 + seed)
+
+    for i, rel_path in enumerate(touched):
+        full_path = os.path.join(root, rel_path)
+        kind = i % 5
+        if kind < 3:
+            write_file(full_path, file_size(rng, profile), rng, now)
+            counts['modified'] += 1
+        elif kind == 3:
+            os.remove(full_path)
+            counts['deleted'] += 1
+        else:
+            new_path = os.path.join(os.path.dirname(full_path), f"new_{seed}_{i}{rng.choice(EXTENSIONS)}")
+            write_file(new_path, file_size(rng, profile), rng, now)
+            counts['added'] += 1
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic source tree for benchmarks')
+    parser.add_argument('root', help='Directory to create the tree in')
+    parser.add_argument('--files', type=int, default=2000, help='Number of files')
+    parser.add_argument('--depth', type=int, default=3, help='Folder nesting depth')
+    parser.add_argument('--fanout', type=int, default=4, help='Subfolders per folder')
+    parser.add_argument('--size-profile', choices=sorted(SIZE_PROFILES), default='office',
+                        help='File size distribution')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('--churn', type=float, metavar='RATE',
+                        help='Instead of generating, modify/delete/add this share of the files in root')
+
+    args = parser.parse_args()
+
+    if args.churn is not None:
+        counts = apply_churn(args.root, args.churn, args.size_profile, args.seed)
+        print(f"Modified {counts['modified']}, deleted {counts['deleted']}, added {counts['added']} files")
+        return
+    files, total = generate(args.root, args.files, args.depth, args.fanout, args.size_profile, args.seed)
+    print(f"Created {files} files, {total / (1024 ** 3):.2f} GB in {args.root}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import gzip
+import time
+import subprocess
+
+CURSOR_DIR = os.path.join('.state', 'cursors')
+
+class RcloneLister:
+    """Lists every file of a remote with `rclone lsjson -R`
+
+    Works against any rclone remote, including a plain local directory,
+    which makes it easy to exercise without OneDrive. With hash_type set,
+    each entry also carries that hash as provided by the remote.
+    """
+
+    def __init__(self, remote, options=None, exclude_file=None, hash_type=None):
+        self.remote = remote
+        self.options = options or []
+        self.exclude_file = exclude_file
+        self.hash_type = hash_type
+
+    def command(self):
+        cmd = ['rclone', 'lsjson', '-R', '--files-only', '--no-mimetype']
+        if self.hash_type:
+            cmd.extend(['--hash', '--hash-type', self.hash_type])
+        cmd.extend(self.options)
+        if self.exclude_file:
+            cmd.extend(['--exclude-from', self.exclude_file])
+        cmd.append(self.remote)
+        return cmd
+
+    def list(self):
+        """Return {path: [size, modtime]} (plus the hash, with hash_type) for every file on the remote"""
+        process = subprocess.Popen(self.command(), stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, text=True)
+        listing = {}
+        # rclone prints one object per line, so the array can be parsed as a stream
+        for line in process.stdout:
+            line = line.strip().rstrip(',')
+            if not line.startswith('{'):
+                continue
+            item = json.loads(line)
+            listing[item['Path']] = [item.get('Size', -1), item.get('ModTime')]
+            if self.hash_type:
+                listing[item['Path']].append((item.get('Hashes') or {}).get(self.hash_type))
+
+        stderr = process.stderr.read()
+        process.wait()
+        if process.returncode != 0:
+            raise RuntimeError(f"rclone lsjson failed: {stderr.strip()}")
+        return listing
+
+def diff_listings(old, new):
+    """Compare two listings; return (sorted new or modified paths, sorted deleted paths)"""
+    changed = [path for path, meta in new.items() if old.get(path) != meta]
+    deleted = [path for path in old if path not in new]
+    return sorted(changed), sorted(deleted)
+
+class CursorStore:
+    """Remote listings saved per snapshot, used as the change-tracking cursor"""
+
+    def __init__(self, backup_dest):
+        self.root = os.path.join(backup_dest, CURSOR_DIR)
+
+    def path(self, name):
+        return os.path.join(self.root, f"{name}.jsonl.gz")
+
+    def load(self, name):
+        """Return (meta, listing) for a snapshot, or (None, None) if it has no cursor"""
+        try:
+            with gzip.open(self.path(name), 'rt', encoding='utf-8') as f:
+                meta = json.loads(f.readline())
+                listing = {}
+                for line in f:
+                    path, size, modtime = json.loads(line)
+                    listing[path] = [size, modtime]
+            return meta, listing
+        except (OSError, ValueError, EOFError):
+            return None, None
+
+    def save(self, name, listing, meta):
+        """Store the listing a snapshot was built from"""
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f"{self.path(name)}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            f.write(json.dumps(dict(meta, saved=time.time())) + '\n')
+            for path, (size, modtime) in listing.items():
+                f.write(json.dumps([path, size, modtime]) + '\n')
+        os.replace(tmp_path, self.path(name))
+
+    def prune(self, keep_names):
+        """Delete cursors of snapshots that no longer exist"""
+        if not os.path.isdir(self.root):
+            return
+        for item in os.listdir(self.root):
+            name = item[:-len('.jsonl.gz')] if item.endswith('.jsonl.gz') else None
+            if name is None or name not in keep_names:
+                os.remove(os.path.join(self.root, item))
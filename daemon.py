@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import signal
+import fnmatch
+import shutil
+import threading
+import subprocess
+
+import change_tracker
+import run_metrics
+
+class LocalWatcher:
+    """Follows changes under a local directory with `inotifywait -m -r`
+
+    Events for excluded names are dropped; the rest only bump a counter and
+    wake the daemon, the backup itself still runs over the whole tree.
+    """
+
+    EVENTS = 'close_write,create,delete,move,attrib'
+
+    def __init__(self, path, exclude_patterns, wakeup, logger):
+        self.path = path
+        self.exclude_patterns = [p for p in exclude_patterns if '/' not in p]
+        self.wakeup = wakeup
+        self.logger = logger
+        self.process = None
+        self.lock = threading.Lock()
+        self.events = 0
+        self.last_event = 0.0
+
+    def start(self):
+        """Start watching; return False if inotifywait is not available"""
+        if shutil.which('inotifywait') is None:
+            self.logger.warning("inotifywait not found (install inotify-tools), "
+                                "falling back to interval runs only")
+            return False
+
+        cmd = ['inotifywait', '-m', '-r', '-q', '--format', '%e %w%f', '-e', self.EVENTS, self.path]
+        self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                        text=True)
+        threading.Thread(target=self.read_events, daemon=True).start()
+        self.logger.info(f"Watching {self.path} for changes")
+        return True
+
+    def read_events(self):
+        for line in self.process.stdout:
+            event, _, path = line.rstrip('\n').partition(' ')
+            # The kernel queue overflowed: changes were lost, so treat it as a change
+            if 'Q_OVERFLOW' not in event and self.is_excluded(path):
+                continue
+            with self.lock:
+                self.events += 1
+                self.last_event = time.monotonic()
+            self.wakeup.set()
+
+        if self.process.wait() != 0:
+            self.logger.warning("inotifywait stopped (too many folders for fs.inotify.max_user_watches?), "
+                                "falling back to interval runs only")
+
+    def is_excluded(self, path):
+        name = os.path.basename(path)
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.exclude_patterns)
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def pending(self):
+        with self.lock:
+            return self.events
+
+    def quiet_for(self):
+        """Seconds since the last change event"""
+        with self.lock:
+            return time.monotonic() - self.last_event
+
+    def take(self):
+        """Return and reset the number of events seen since the last call"""
+        with self.lock:
+            events, self.events = self.events, 0
+        return events
+
+    def stop(self):
+        if self.alive():
+            self.process.terminate()
+            self.process.wait()
+
+class BackupDaemon:
+    """Keeps one OneDriveBackup resident and runs it on an interval or on local changes
+
+    Dependency checks, the rclone remote check and the last remote listing
+    survive between runs. A run is skipped when the remote listing (or the
+    local watcher) shows nothing changed since the last successful backup.
+    The remote is only listed ahead of a run when the run will use that
+    listing; otherwise every interval runs and rclone finds the changes.
+    """
+
+    def __init__(self, backup, dry_run=False):
+        self.backup = backup
+        self.logger = backup.logger
+        self.config = backup.config
+        self.dry_run = dry_run
+        self.interval = self.config.get('daemon_interval_minutes', 60) * 60
+        self.debounce = self.config.get('daemon_debounce_seconds', 60)
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.requested = True  # back up once at startup
+        self.watcher = None
+        self.reference_listing = None
+        self.pending_listing = None
+        self.metrics_server = None
+        self.running = False
+        self.runs = 0
+        self.skipped_runs = 0
+        # A local source has no record of the last run's state, so its first run always happens
+        self.dirty = self.config['source_type'] != 'rclone'
+
+    def handle_stop(self, signum, frame):
+        self.logger.info("Stop requested, exiting after the current run")
+        self.stopping = True
+        self.wakeup.set()
+
+    def handle_request(self, signum, frame):
+        self.requested = True
+        self.wakeup.set()
+
+    def run(self):
+        """Serve until SIGTERM/SIGINT; SIGUSR1 starts a run immediately"""
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGUSR1, self.handle_request)
+
+        if not self.backup.check_environment():
+            return False
+
+        if self.config['source_type'] != 'rclone' and self.config.get('daemon_watch', True):
+            source = os.path.expanduser(self.config['local_source'])
+            self.watcher = LocalWatcher(source, self.config['exclude_patterns'], self.wakeup, self.logger)
+            if not self.watcher.start():
+                self.watcher = None
+
+        port = self.config.get('metrics_port', 0)
+        if port:
+            self.metrics_server = run_metrics.MetricsServer(
+                self.config.get('metrics_address', '127.0.0.1'), port,
+                lambda: self.backup.last_record or self.backup.read_last_run_record(),
+                self.status, self.logger)
+            self.metrics_server.start()
+
+        self.logger.info(f"Daemon started (pid {os.getpid()}), backing up every "
+                         f"{self.interval / 60:g} minutes"
+                         + (f" or {self.debounce} seconds after local changes settle" if self.watcher else ""))
+
+        next_due = time.monotonic()
+        try:
+            while not self.stopping:
+                self.wakeup.wait(max(0, next_due - time.monotonic()))
+                self.wakeup.clear()
+                if self.stopping:
+                    break
+
+                if self.watcher and self.watcher.pending() and not self.requested:
+                    # Coalesce a burst of changes into one run, but don't let
+                    # constant churn postpone the backup forever
+                    self.settle()
+                    if self.stopping:
+                        break
+                elif not self.requested and time.monotonic() < next_due:
+                    continue
+
+                self.requested = False
+                self.cycle()
+                next_due = time.monotonic() + self.interval
+        finally:
+            if self.watcher:
+                self.watcher.stop()
+            if self.metrics_server:
+                self.metrics_server.stop()
+
+        self.logger.info("Daemon stopped")
+        return True
+
+    def status(self):
+        """Live daemon gauges for the metrics endpoint: name -> (type, help, value)"""
+        return {
+            'daemon_up': ('gauge', 'Whether the backup daemon is running', 1),
+            'daemon_run_in_progress': ('gauge', 'Whether a backup run is in progress', int(self.running)),
+            'daemon_runs_total': ('counter', 'Backup runs started by the daemon', self.runs),
+            'daemon_skipped_runs_total': ('counter', 'Wake-ups skipped because nothing changed',
+                                          self.skipped_runs),
+            'daemon_pending_local_changes': ('gauge', 'Local change events not yet backed up',
+                                             self.watcher.pending() if self.watcher else 0),
+        }
+
+    def settle(self):
+        """Wait until no change arrived for the debounce period"""
+        deadline = time.monotonic() + 10 * self.debounce
+        while not self.stopping and not self.requested and time.monotonic() < deadline:
+            remaining = self.debounce - self.watcher.quiet_for()
+            if remaining <= 0:
+                return
+            self.wakeup.wait(min(remaining, deadline - time.monotonic()))
+            self.wakeup.clear()
+
+    def has_changes(self):
+        """Check cheaply whether there is anything to back up"""
+        if self.config['source_type'] != 'rclone':
+            events = self.watcher.take() if self.watcher else 0
+            if events:
+                self.logger.info(f"{events} local changes since the last run")
+            # Without a live watcher a quiet period proves nothing
+            return self.dirty or bool(events) or not (self.watcher and self.watcher.alive())
+
+        if not self.backup.uses_listing():
+            # A full sync walks the whole remote itself; listing it first would double the slowest step
+            return True
+
+        try:
+            listing = self.backup.list_remote()
+        except Exception as e:
+            self.logger.warning(f"Could not list remote to check for changes: {e}")
+            return True
+
+        reference = self.reference_listing
+        if reference is None:
+            latest = self.backup.get_latest_backup()
+            if latest:
+                _, reference = self.backup.get_cursor_store().load(os.path.basename(latest))
+
+        # detect_changes() takes this listing instead of listing the remote again
+        self.backup.prefetched_listing = listing
+        self.pending_listing = listing
+        if reference is None or self.dirty:
+            return True
+
+        changed, deleted = change_tracker.diff_listings(reference, listing)
+        if changed or deleted:
+            self.logger.info(f"Remote changed: {len(changed)} new or modified, {len(deleted)} deleted files")
+            return True
+        return False
+
+    def cycle(self):
+        self.pending_listing = None
+        if not self.has_changes():
+            self.logger.info("Nothing changed since the last backup, skipping run")
+            self.backup.prefetched_listing = None
+            self.skipped_runs += 1
+            return
+
+        self.running = True
+        self.runs += 1
+        try:
+            success = self.backup.run(dry_run=self.dry_run)
+        except Exception as e:
+            self.logger.error(f"Backup run failed: {e}")
+            success = False
+        self.running = False
+        self.backup.prefetched_listing = None
+
+        # After a failure the next wake-up must run even if nothing new changed
+        self.dirty = not success or self.dry_run
+        if success and self.pending_listing is not None:
+            self.reference_listing = self.pending_listing
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import gzip
+import hashlib
+import time
+from contextlib import contextmanager
+
+import run_journal
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MANIFEST_NAME = 'manifest.jsonl.gz'
+STORE_DIR = '.store'
+STAGING_DIR = 'staging'
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+def is_manifest_snapshot(snapshot_path):
+    """Check whether a backup directory holds a manifest instead of plain files"""
+    return os.path.isfile(os.path.join(snapshot_path, MANIFEST_NAME))
+
+def read_manifest_header(snapshot_path):
+    """Return the header record of a snapshot manifest"""
+    with gzip.open(os.path.join(snapshot_path, MANIFEST_NAME), 'rt', encoding='utf-8') as f:
+        return json.loads(f.readline())
+
+def iter_manifest(snapshot_path):
+    """Yield the file entries of a snapshot manifest"""
+    with gzip.open(os.path.join(snapshot_path, MANIFEST_NAME), 'rt', encoding='utf-8') as f:
+        f.readline()  # header
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def load_manifest(snapshot_path):
+    """Return a snapshot manifest as a dict of path -> entry"""
+    return {entry['path']: entry for entry in iter_manifest(snapshot_path)}
+
+def manifest_paths_matching(entries, files):
+    """Select manifest entries for the requested files or folders"""
+    prefixes = [f.strip('/') for f in files]
+    for entry in entries:
+        for prefix in prefixes:
+            if entry['path'] == prefix or entry['path'].startswith(prefix + '/'):
+                yield prefix, entry
+                break
+
+class ObjectStore:
+    """Content-addressed chunk store shared by all snapshots in a backup destination
+
+    File content is split into fixed-size chunks, each stored once under its
+    SHA-256 digest. A snapshot is a manifest listing every file with the
+    digests of its chunks, so unchanged files and unchanged regions of large
+    files cost no extra disk space.
+    """
+
+    def __init__(self, backup_dest, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.root = os.path.join(backup_dest, STORE_DIR)
+        self.objects_dir = os.path.join(self.root, 'objects')
+        self.staging_dir = os.path.join(self.root, STAGING_DIR)
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def for_snapshot(cls, snapshot_path):
+        """Return the store that holds the chunks of a snapshot"""
+        snapshot_path = os.path.realpath(snapshot_path)
+        return cls(os.path.dirname(snapshot_path))
+
+    @contextmanager
+    def locked(self):
+        """Hold the store lock, so garbage collection never runs while a snapshot is being ingested"""
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, 'lock'), 'w') as handle:
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+            yield
+
+    def object_path(self, digest):
+        """Return the on-disk location of a chunk"""
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def put(self, digest, data):
+        """Store a chunk unless it already exists; return True if it was written"""
+        path = self.object_path(digest)
+        if os.path.exists(path):
+            return False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return True
+
+    def store_file(self, path):
+        """Chunk a file into the store; return (sha256, chunk digests, new bytes)"""
+        file_hash = hashlib.sha256()
+        chunks = []
+        new_bytes = 0
+
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                file_hash.update(data)
+                digest = hashlib.sha256(data).hexdigest()
+                if self.put(digest, data):
+                    new_bytes += len(data)
+                chunks.append(digest)
+
+        return file_hash.hexdigest(), chunks, new_bytes
+
+    def read_entry(self, entry):
+        """Yield the content of a file entry chunk by chunk"""
+        for digest in entry['chunks']:
+            with open(self.object_path(digest), 'rb') as f:
+                yield f.read()
+
+    def restore_entry(self, entry, destination):
+        """Reassemble a file from its chunks at destination"""
+        os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+        tmp_path = f"{destination}.restore-tmp"
+        with open(tmp_path, 'wb') as out:
+            for data in self.read_entry(entry):
+                out.write(data)
+        os.replace(tmp_path, destination)
+
+        if 'mode' in entry:
+            os.chmod(destination, entry['mode'])
+        os.utime(destination, (entry['mtime'], entry['mtime']))
+
+    def ingest(self, source_dir, snapshot_path, previous_snapshot=None, logger=None):
+        """Store the tree at source_dir and write its manifest into snapshot_path
+
+        Files whose size and mtime match the previous snapshot's manifest reuse
+        its chunk list without being read again.
+        """
+        previous = {}
+        if previous_snapshot and is_manifest_snapshot(previous_snapshot):
+            previous = load_manifest(previous_snapshot)
+
+        stats = {'files': 0, 'bytes': 0, 'new_bytes': 0, 'hashed_files': 0}
+        manifest_path = os.path.join(snapshot_path, MANIFEST_NAME)
+        tmp_path = f"{manifest_path}.tmp"
+
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as manifest:
+            header = {
+                'version': 1,
+                'snapshot': os.path.basename(snapshot_path),
+                'created': time.time(),
+                'chunk_size': self.chunk_size,
+            }
+            manifest.write(json.dumps(header) + '\n')
+
+            for root, dirs, files in os.walk(source_dir):
+                dirs.sort()
+                for name in sorted(files):
+                    file_path = os.path.join(root, name)
+                    rel_path = os.path.relpath(file_path, source_dir)
+                    try:
+                        st = os.lstat(file_path)
+                    except OSError:
+                        continue
+                    if not os.path.isfile(file_path) or os.path.islink(file_path):
+                        continue
+
+                    old = previous.get(rel_path)
+                    if old and old['size'] == st.st_size and old['mtime'] == st.st_mtime:
+                        sha256, chunks = old['sha256'], old['chunks']
+                    else:
+                        try:
+                            sha256, chunks, new_bytes = self.store_file(file_path)
+                        except OSError as e:
+                            if logger:
+                                logger.warning(f"Could not store {rel_path}: {e}")
+                            continue
+                        stats['new_bytes'] += new_bytes
+                        stats['hashed_files'] += 1
+
+                    entry = {
+                        'path': rel_path,
+                        'size': st.st_size,
+                        'mtime': st.st_mtime,
+                        'mode': st.st_mode & 0o7777,
+                        'sha256': sha256,
+                        'chunks': chunks,
+                    }
+                    manifest.write(json.dumps(entry) + '\n')
+                    stats['files'] += 1
+                    stats['bytes'] += st.st_size
+
+        os.replace(tmp_path, manifest_path)
+        return stats
+
+    def garbage_collect(self, snapshot_paths):
+        """Delete chunks no longer referenced by any of the given snapshots
+
+        Raises RuntimeError, deleting nothing, if a snapshot has vanished or
+        is an empty directory without a manifest, since its chunks could not
+        be accounted for. Snapshots holding plain files (made before the
+        dedup backend was enabled) and working directories that have not been
+        ingested yet own no chunks and are skipped.
+        """
+        referenced = set()
+        for snapshot_path in snapshot_paths:
+            if not os.path.isdir(snapshot_path):
+                raise RuntimeError(f"{snapshot_path} disappeared while collecting garbage")
+            if not is_manifest_snapshot(snapshot_path):
+                if os.listdir(snapshot_path) or run_journal.is_working_dir(os.path.basename(snapshot_path)):
+                    continue
+                raise RuntimeError(f"{snapshot_path} has no manifest")
+            for entry in iter_manifest(snapshot_path):
+                referenced.update(entry['chunks'])
+
+        removed = 0
+        freed_bytes = 0
+        if not os.path.isdir(self.objects_dir):
+            return removed, freed_bytes
+
+        for prefix in os.listdir(self.objects_dir):
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            for digest in os.listdir(prefix_dir):
+                if digest in referenced:
+                    continue
+                path = os.path.join(prefix_dir, digest)
+                freed_bytes += os.path.getsize(path)
+                os.remove(path)
+                removed += 1
+
+        return removed, freed_bytes
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import os
+import errno
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl number for FICLONE (Linux btrfs/xfs/bcachefs reflinks)
+FICLONE = 0x40049409
+
+# Errors meaning "this filesystem/pair of files can't do that", not real failures
+UNSUPPORTED_ERRNOS = {errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY,
+                      errno.ENOSYS, errno.EBADF, errno.EPERM}
+
+def clone_file(src, dst):
+    """Create dst as a copy-on-write clone (reflink) of src"""
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflinks not supported on this platform", dst)
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+def copy_file_data(src, dst):
+    """Copy file contents in-kernel with copy_file_range, falling back to shutil"""
+    if not hasattr(os, 'copy_file_range'):
+        shutil.copyfile(src, dst)
+        return
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(remaining, 1 << 30))
+                if copied == 0:
+                    break
+                remaining -= copied
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+def copy_file(src, dst, reflink=True):
+    """Copy a file with metadata, preferring a reflink when the filesystem supports it
+
+    Returns 'reflink' or 'copy' depending on how the data ended up in dst.
+    """
+    if reflink:
+        try:
+            clone_file(src, dst)
+            return 'reflink'
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+
+    copy_file_data(src, dst)
+    shutil.copystat(src, dst)
+    return 'copy'
+
+def link_tree(src, dst, mode='hardlink'):
+    """Recreate the tree at src under dst, sharing file data instead of copying it
+
+    mode is 'hardlink' (files share inodes, like rsync --link-dest) or 'reflink'
+    (copy-on-write clones, falling back to a plain copy where unsupported).
+    Returns (file_count, total_bytes).
+    """
+    file_count = 0
+    total_bytes = 0
+    reflink_ok = True
+
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        target_root = dst if rel == '.' else os.path.join(dst, rel)
+        os.makedirs(target_root, exist_ok=True)
+
+        # os.walk lists symlinks to directories in dirs but does not follow them
+        for name in dirs + files:
+            src_path = os.path.join(root, name)
+            if os.path.islink(src_path):
+                dst_path = os.path.join(target_root, name)
+                if not os.path.lexists(dst_path):
+                    os.symlink(os.readlink(src_path), dst_path)
+
+        for name in files:
+            src_path = os.path.join(root, name)
+            dst_path = os.path.join(target_root, name)
+            if os.path.islink(src_path) or os.path.lexists(dst_path):
+                continue
+
+            if mode == 'hardlink':
+                os.link(src_path, dst_path)
+            else:
+                method = copy_file(src_path, dst_path, reflink=reflink_ok)
+                # Don't keep retrying the ioctl once the filesystem has refused it
+                reflink_ok = method == 'reflink'
+
+            file_count += 1
+            total_bytes += os.lstat(src_path).st_size
+
+    return file_count, total_bytes
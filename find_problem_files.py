@@ -1,76 +1,227 @@
 #!/usr/bin/env python3
 
+import os
 import subprocess
 import json
 import sys
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-def find_problematic_path():
+import transfer_stream
+
+DEFAULT_WORKERS = 8
+MAX_THROTTLE_RETRIES = 5
+
+def is_objecthandle_error(text):
+    return "ObjectHandle is Invalid" in text or "invalidResourceId" in text
+
+def is_throttled(text):
+    return transfer_stream.THROTTLE_RE.search(text) is not None
+
+def join_path(parent, name):
+    """Append a folder name to an rclone path"""
+    if parent.endswith(':') or parent.endswith('/'):
+        return f"{parent}{name}"
+    return f"{parent}/{name}"
+
+def default_cache_file(remote):
+    """Location of the scan cache for a remote"""
+    cache_dir = os.path.expanduser('~/.cache/onedrive-backup')
+    safe_name = ''.join(c if c.isalnum() else '_' for c in remote).strip('_')
+    return os.path.join(cache_dir, f"problem_scan_{safe_name}.json")
+
+def load_cache(cache_file):
+    """Load {path: modtime} for folders whose whole subtree was OK last time"""
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache_file, cache):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = f"{cache_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_file, cache_file)
+
+class Backoff:
+    """Shared delay that grows when OneDrive throttles and decays on success"""
+
+    def __init__(self, initial=1.0, maximum=120.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            delay = self.delay
+        if delay:
+            time.sleep(delay)
+
+    def throttled(self):
+        with self.lock:
+            self.delay = min(self.maximum, max(self.initial, self.delay * 2))
+            return self.delay
+
+    def succeeded(self):
+        with self.lock:
+            self.delay = self.delay / 2 if self.delay > self.initial else 0.0
+
+def list_subdirs(path, backoff):
+    """List the subfolders of a path; return (status, [(path, modtime)], detail)"""
+    backoff.wait()
+    cmd = ["rclone", "lsjson", "--dirs-only", path]
+
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+    except subprocess.TimeoutExpired:
+        return 'timeout', [], None
+    except Exception as e:
+        return 'error', [], str(e)
+
+    if is_objecthandle_error(result.stderr):
+        return 'bad', [], None
+    if result.returncode != 0:
+        if is_throttled(result.stderr):
+            return 'throttled', [], None
+        return 'error', [], result.stderr.strip()
+
+    backoff.succeeded()
+    try:
+        items = json.loads(result.stdout or '[]')
+    except ValueError:
+        return 'error', [], "unparseable rclone output"
+    return 'ok', [(join_path(path, item['Name']), item.get('ModTime')) for item in items], None
+
+def find_problematic_path(remote="onedrive:", workers=DEFAULT_WORKERS, cache_file=None, use_cache=True):
     """Find the specific path causing ObjectHandle errors"""
-    
+
     print("Scanning OneDrive for problematic files/folders...")
-    print("This may take a few minutes...\n")
-    
-    # Start with root and progressively go deeper
-    paths_to_check = ["onedrive:"]
+    print(f"Using {workers} parallel listings\n")
+
+    cache_file = cache_file or default_cache_file(remote)
+    cache = load_cache(cache_file) if use_cache else {}
+
     problematic_paths = []
-    
-    while paths_to_check:
-        current_path = paths_to_check.pop(0)
-        print(f"Checking: {current_path}")
-        
-        # Try to list this specific path
-        cmd = ["rclone", "lsd", current_path, "--max-depth", "1"]
-        
-        try:
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-            
-            if "ObjectHandle is Invalid" in result.stderr or "invalidResourceId" in result.stderr:
-                print(f"  ❌ ERROR found at: {current_path}")
-                problematic_paths.append(current_path)
-                # Don't traverse deeper into problematic paths
-                continue
-                
-            if result.returncode == 0:
-                # Parse output to get subdirectories
-                for line in result.stdout.strip().split('\n'):
-                    if line.strip():
-                        # Extract directory name (last column)
-                        parts = line.split()
-                        if len(parts) >= 4:
-                            dir_name = ' '.join(parts[3:])
-                            if current_path == "onedrive:":
-                                new_path = f"onedrive:{dir_name}"
-                            else:
-                                new_path = f"{current_path}/{dir_name}"
-                            paths_to_check.append(new_path)
-                print(f"  ✓ OK")
-            else:
-                print(f"  ⚠ Warning: Non-zero return code but no ObjectHandle error")
-                
-        except subprocess.TimeoutExpired:
-            print(f"  ⚠ Timeout checking path")
-        except Exception as e:
-            print(f"  ⚠ Error: {e}")
-    
+    incomplete_paths = []   # timeouts and other failures; their subtrees are not cached
+    modtimes = {}
+    listed_ok = []
+    skipped = 0
+    throttle_retries = {}
+    backoff = Backoff()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(list_subdirs, remote, backoff): remote}
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                current_path = pending.pop(future)
+                status, subdirs, detail = future.result()
+
+                if status == 'bad':
+                    print(f"  ❌ ERROR found at: {current_path}")
+                    problematic_paths.append(current_path)
+                    # Don't traverse deeper into problematic paths
+                    continue
+
+                if status == 'throttled':
+                    retries = throttle_retries.get(current_path, 0) + 1
+                    throttle_retries[current_path] = retries
+                    delay = backoff.throttled()
+                    if retries <= MAX_THROTTLE_RETRIES:
+                        print(f"  ⏳ Throttled at {current_path}, backing off {delay:.0f}s")
+                        pending[executor.submit(list_subdirs, current_path, backoff)] = current_path
+                    else:
+                        print(f"  ⚠ Giving up on {current_path} after repeated throttling")
+                        incomplete_paths.append(current_path)
+                    continue
+
+                if status == 'timeout':
+                    print(f"  ⚠ Timeout checking path: {current_path}")
+                    incomplete_paths.append(current_path)
+                    continue
+
+                if status == 'error':
+                    print(f"  ⚠ Warning: {current_path}: {detail or 'non-zero return code but no ObjectHandle error'}")
+                    incomplete_paths.append(current_path)
+                    continue
+
+                print(f"  ✓ OK: {current_path}")
+                listed_ok.append(current_path)
+                for path, modtime in subdirs:
+                    modtimes[path] = modtime
+                    # Unchanged folder whose whole subtree was fine last time
+                    if modtime and cache.get(path) == modtime:
+                        skipped += 1
+                        continue
+                    pending[executor.submit(list_subdirs, path, backoff)] = path
+
+    # Remember folders whose subtree scanned clean so the next run can skip them
+    unhealthy = problematic_paths + incomplete_paths
+    for path in listed_ok:
+        if path in modtimes and modtimes[path]:
+            if not any(p == path or p.startswith(path + '/') for p in unhealthy):
+                cache[path] = modtimes[path]
+        else:
+            cache.pop(path, None)
+    for path in unhealthy:
+        cache.pop(path, None)
+    save_cache(cache_file, cache)
+
     print("\n" + "="*50)
+    if skipped:
+        print(f"Skipped {skipped} unchanged folders that were OK in a previous scan (use --full to rescan)")
     if problematic_paths:
         print("PROBLEMATIC PATHS FOUND:")
         for path in problematic_paths:
             print(f"  - {path}")
         print("\nYou can exclude these paths from your backup by adding them to exclude_patterns in config.json")
+        print("or by re-running with --update-config")
     else:
         print("No problematic paths found.")
         print("The error might be transient or related to specific file operations.")
-    
+
     return problematic_paths
 
+def path_to_exclude_pattern(remote, path):
+    """Turn a problematic rclone path into an anchored rclone exclude pattern"""
+    relative = path[len(remote):] if path.startswith(remote) else path.split(':', 1)[-1]
+    return f"/{relative.strip('/')}/**"
+
+def add_exclusions(config_file, remote, paths):
+    """Add the problematic paths to exclude_patterns in config.json"""
+    with open(config_file, 'r') as f:
+        config = json.load(f)
+
+    patterns = config.setdefault('exclude_patterns', [])
+    added = []
+    for path in paths:
+        pattern = path_to_exclude_pattern(remote, path)
+        if pattern not in patterns:
+            patterns.append(pattern)
+            added.append(pattern)
+
+    if added:
+        with open(config_file, 'w') as f:
+            json.dump(config, f, indent=4)
+        print(f"\nAdded {len(added)} exclude patterns to {config_file}:")
+        for pattern in added:
+            print(f"  {pattern}")
+    else:
+        print(f"\n{config_file} already excludes all problematic paths")
+
 def test_specific_path(path):
     """Test a specific path for errors"""
     print(f"Testing path: {path}")
     cmd = ["rclone", "lsd", path, "--max-depth", "1", "-vv"]
-    
+
     result = subprocess.run(cmd, capture_output=True, text=True)
-    
+
     if "ObjectHandle is Invalid" in result.stderr or "invalidResourceId" in result.stderr:
         print(f"ERROR: ObjectHandle is Invalid for path: {path}")
         print("\nDetailed error output:")
@@ -80,10 +231,42 @@ def test_specific_path(path):
         print(f"Path is accessible: {path}")
         return True
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1:
+def main():
+    parser = argparse.ArgumentParser(description='Find OneDrive paths that cause ObjectHandle errors')
+    parser.add_argument('path', nargs='?',
+                       help='Test a single rclone path instead of scanning')
+    parser.add_argument('--config', default='config.json',
+                       help='Configuration file path (for rclone_remote and --update-config)')
+    parser.add_argument('--remote',
+                       help='rclone remote to scan, e.g. work: (default: rclone_remote from the config file)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                       help='Number of concurrent folder listings')
+    parser.add_argument('--full', action='store_true',
+                       help='Ignore the scan cache and check every folder')
+    parser.add_argument('--cache', help='Scan cache file (default: ~/.cache/onedrive-backup/)')
+    parser.add_argument('--update-config', action='store_true',
+                       help='Add problematic paths to exclude_patterns in the config file')
+
+    args = parser.parse_args()
+
+    if args.path:
         # Test specific path provided as argument
-        test_specific_path(sys.argv[1])
-    else:
-        # Scan for problematic paths
-        find_problematic_path()
\ No newline at end of file
+        test_specific_path(args.path)
+        return
+
+    remote = args.remote or "onedrive:"
+    if not args.remote and os.path.exists(args.config):
+        with open(args.config, 'r') as f:
+            remote = json.load(f).get('rclone_remote', remote)
+
+    # Scan for problematic paths
+    problematic_paths = find_problematic_path(remote, args.workers, args.cache, not args.full)
+
+    if args.update_config and problematic_paths:
+        if not os.path.exists(args.config):
+            print(f"Configuration file not found: {args.config}")
+            sys.exit(1)
+        add_exclusions(args.config, remote, problematic_paths)
+
+if __name__ == "__main__":
+    main()
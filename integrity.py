@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import base64
+import string
+import hashlib
+from datetime import datetime
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import dedup_store
+import archive_tier
+import snapshot_index
+
+# A multiple of the QuickXorHash width, so every read after the first starts block-aligned
+BUFFER_SIZE = 160 * 16384
+STATE_FILE = os.path.join('.state', 'scrub.json')
+HISTORY_FILE = os.path.join('.state', 'integrity.jsonl')
+MASK_160 = (1 << 160) - 1
+
+def fold_blocks(value, blocks):
+    """XOR together the 160-byte blocks of a little-endian integer"""
+    while blocks > 1:
+        half = blocks // 2
+        shift = (blocks - half) * 1280
+        value = (value & ((1 << shift) - 1)) ^ (value >> shift)
+        blocks -= half
+    return value
+
+class QuickXorHash:
+    """OneDrive's QuickXorHash
+
+    Byte n of the input is XORed into a 160-bit register at bit offset
+    11 * n (mod 160), and the length is XORed into the last 64 bits. Bytes
+    160 apart land on the same offset, so whole buffers are folded with big
+    integer XORs instead of a Python loop per byte.
+    """
+
+    def __init__(self):
+        self.blocks = 0
+        self.length = 0
+
+    def update(self, data):
+        offset = self.length % 160
+        self.length += len(data)
+        if offset:
+            data = bytes(offset) + bytes(data)
+        self.blocks ^= fold_blocks(int.from_bytes(data, 'little'), -(-len(data) // 160))
+
+    def digest(self):
+        value = 0
+        for position in range(160):
+            byte = (self.blocks >> (8 * position)) & 0xff
+            if byte:
+                shifted = byte << ((11 * position) % 160)
+                value ^= (shifted | (shifted >> 160)) & MASK_160
+
+        result = bytearray(value.to_bytes(20, 'little'))
+        for i, byte in enumerate(self.length.to_bytes(8, 'little')):
+            result[12 + i] ^= byte
+        return bytes(result)
+
+    def hexdigest(self):
+        # Like rclone, which hex-encodes the base64 value the OneDrive API returns
+        return self.digest().hex()
+
+def digest_bytes(text):
+    """Decode a hex or base64 digest, or return None if it is neither"""
+    try:
+        if all(char in string.hexdigits for char in text):
+            return bytes.fromhex(text)
+        return base64.b64decode(text, validate=True)
+    except ValueError:
+        return None
+
+def same_digest(first, second):
+    """Compare two digests whatever their spelling: hex in any case, or base64"""
+    first, second = digest_bytes(first), digest_bytes(second)
+    return first is not None and first == second
+
+def new_hasher(algorithm):
+    if algorithm == 'quickxor':
+        return QuickXorHash()
+    return hashlib.new(algorithm)
+
+def hash_job(job):
+    """Hash the concatenation of some files in a worker process
+
+    job is (key, paths, algorithm, bytes per second or 0). Returns
+    (key, digest or None, bytes read, error message or None).
+    """
+    key, paths, algorithm, rate = job
+    hasher = new_hasher(algorithm)
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    total = 0
+    start = time.monotonic()
+
+    try:
+        for path in paths:
+            with open(path, 'rb', buffering=0) as f:
+                while True:
+                    count = f.readinto(buffer)
+                    if not count:
+                        break
+                    hasher.update(view[:count])
+                    total += count
+                    if rate:
+                        ahead = total / rate - (time.monotonic() - start)
+                        if ahead > 0:
+                            time.sleep(ahead)
+    except OSError as e:
+        return key, None, total, str(e)
+
+    return key, hasher.hexdigest(), total, None
+
+def parse_modtime(value):
+    """Turn an rclone ModTime (RFC 3339, possibly with nanoseconds) or a timestamp into seconds"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    text = value.replace('Z', '+00:00')
+    if '.' in text:
+        head, tail = text.split('.', 1)
+        digits = len(tail) - len(tail.lstrip('0123456789'))
+        text = f"{head}.{tail[:min(digits, 6)]}{tail[digits:]}"
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        return None
+
+class Verifier:
+    """Checks snapshots against source hashes and scrubs stored data for bit rot
+
+    Digests of snapshot files are cached in index.db by (inode, size, mtime),
+    so a file version shared by many hardlinked snapshots is hashed once and
+    an unchanged file is never hashed again when verifying. Hashing runs on
+    a process pool; max_rate caps the total read rate in bytes per second.
+    """
+
+    def __init__(self, backup_dest, workers=0, logger=None, max_rate=0):
+        self.backup_dest = backup_dest
+        self.workers = workers or os.cpu_count() or 1
+        self.logger = logger
+        self.max_rate = max_rate
+        self.report = Counter()
+        self.problems = []
+
+    def log(self, level, message):
+        if self.logger:
+            getattr(self.logger, level)(message)
+
+    def run_jobs(self, jobs):
+        """Hash the jobs on the process pool, yielding results as they finish"""
+        rate = self.max_rate / self.workers if self.max_rate else 0
+        jobs = [(key, paths, algorithm, rate) for key, paths, algorithm in jobs]
+        if not jobs:
+            return
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for key, digest, size, error in executor.map(hash_job, jobs, chunksize=8):
+                self.report['bytes_hashed'] += size
+                if error:
+                    self.problems.append(('unreadable', key[1], error))
+                    self.report['unreadable'] += 1
+                yield key, digest
+
+    def problem(self, kind, path, detail=''):
+        self.problems.append((kind, path, detail))
+        self.report[kind] += 1
+
+    def verify_snapshot(self, snapshot_path, listing, algorithm, source_root=None):
+        """Compare a snapshot with a listing of the source taken now
+
+        listing maps path -> [size, modtime, hash]. Files changed at the
+        source after the snapshot was started are skipped. When the listing
+        has no hashes, source_root is hashed with the same algorithm instead.
+        """
+        snapshot_path = os.path.realpath(snapshot_path)
+        started = snapshot_index.snapshot_created(os.path.basename(snapshot_path)) or time.time()
+        index = snapshot_index.SnapshotIndex(self.backup_dest)
+        manifest = None
+        archived = archive_tier.is_archive_snapshot(snapshot_path)
+        if archived:
+            # Packed files are only compared by size; hash the snapshot before it is archived
+            local_files = {entry['path']: (entry['size'], None, entry['mtime'])
+                           for entry in archive_tier.iter_index(snapshot_path)}
+        elif dedup_store.is_manifest_snapshot(snapshot_path):
+            manifest = dedup_store.load_manifest(snapshot_path)
+            store = dedup_store.ObjectStore.for_snapshot(snapshot_path)
+            local_files = {path: (entry['size'], None, entry['mtime']) for path, entry in manifest.items()}
+        else:
+            local_files = {rel_path: (st.st_size, st.st_ino, st.st_mtime)
+                           for rel_path, st in snapshot_index.scan_tree(snapshot_path)}
+
+        expected = {}
+        local_digests = {}
+        jobs = []
+        for path, (size, modtime, *rest) in listing.items():
+            source_hash = rest[0] if rest else None
+            modified = parse_modtime(modtime)
+            if modified is not None and modified > started:
+                self.report['changed_since_backup'] += 1
+                continue
+
+            local = local_files.get(path)
+            if local is None:
+                self.problem('missing', path)
+                continue
+            local_size, inode, mtime = local
+            if size >= 0 and local_size != size:
+                self.problem('size_mismatch', path, f"{local_size} bytes, source has {size}")
+                continue
+
+            if archived:
+                self.report['archived_size_only'] += 1
+                continue
+            if source_hash:
+                expected[path] = source_hash
+            elif source_root:
+                jobs.append((('source', path), [os.path.join(source_root, path)], algorithm))
+            else:
+                self.report['no_source_hash'] += 1
+                continue
+
+            cached = index.cached_checksum(inode, local_size, mtime, algorithm) if inode else None
+            if cached:
+                local_digests[path] = cached
+                self.report['from_cache'] += 1
+            elif manifest is not None:
+                jobs.append((('local', path),
+                             [store.object_path(digest) for digest in manifest[path]['chunks']], algorithm))
+            else:
+                jobs.append((('local', path), [os.path.join(snapshot_path, path)], algorithm))
+
+        new_checksums = []
+        for (side, path), digest in self.run_jobs(jobs):
+            if digest is None:
+                continue
+            if side == 'source':
+                expected[path] = digest
+                continue
+            local_digests[path] = digest
+            local_size, inode, mtime = local_files[path]
+            if inode:
+                new_checksums.append((inode, local_size, mtime, algorithm, digest))
+        index.store_checksums(new_checksums)
+        index.close()
+
+        for path, digest in local_digests.items():
+            if path not in expected:
+                continue
+            if same_digest(digest, expected[path]):
+                self.report['verified'] += 1
+            else:
+                self.problem('hash_mismatch', path, f"{algorithm} {digest}, source has {expected[path]}")
+        return self.report
+
+    def scrub(self, budget_bytes, algorithm='sha256'):
+        """Re-read the stored file versions checked longest ago, up to budget_bytes
+
+        Each version is compared with its last verified digest (or the hash
+        recorded at backup time), then marked as verified now. Versions with
+        no digest yet only get one recorded.
+        """
+        index = snapshot_index.SnapshotIndex.open_existing(self.backup_dest)
+        if index is None:
+            self.log('warning', "No index.db in the backup destination, nothing to scrub")
+            return self.report
+
+        jobs = []
+        versions = {}
+        planned = 0
+        for snapshot, path, inode, size, mtime, digest in index.scrub_candidates(algorithm):
+            if planned + size > budget_bytes and jobs:
+                break
+            key = (snapshot, path)
+            versions[key] = (inode, size, mtime, digest)
+            jobs.append((key, [os.path.join(self.backup_dest, snapshot, path)], algorithm))
+            planned += size
+
+        checked = []
+        for key, digest in self.run_jobs(jobs):
+            if digest is None:
+                continue
+            inode, size, mtime, expected = versions[key]
+            if expected is None:
+                self.report['baseline'] += 1
+            elif not same_digest(digest, expected):
+                self.problem('corrupt', os.path.join(*key), f"{algorithm} {digest}, expected {expected}")
+                continue
+            else:
+                self.report['verified'] += 1
+            checked.append((inode, size, mtime, algorithm, digest))
+
+        index.store_checksums(checked)
+        index.close()
+
+        if budget_bytes > self.report['bytes_hashed']:
+            self.scrub_chunks(budget_bytes - self.report['bytes_hashed'])
+        return self.report
+
+    def scrub_chunks(self, budget_bytes):
+        """Check dedup-store chunks against their names, resuming where the last scrub stopped"""
+        store = dedup_store.ObjectStore(self.backup_dest)
+        if not os.path.isdir(store.objects_dir):
+            return
+
+        state_path = os.path.join(self.backup_dest, STATE_FILE)
+        try:
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+
+        prefixes = sorted(os.listdir(store.objects_dir))
+        start = state.get('next_prefix', '')
+        # Rotate so the scrub continues after the last prefix it finished
+        prefixes = [p for p in prefixes if p >= start] + [p for p in prefixes if p < start]
+
+        jobs = []
+        planned = 0
+        next_prefix = ''
+        for prefix in prefixes:
+            prefix_dir = os.path.join(store.objects_dir, prefix)
+            names = os.listdir(prefix_dir)
+            sizes = sum(os.path.getsize(os.path.join(prefix_dir, name)) for name in names)
+            if planned + sizes > budget_bytes and jobs:
+                next_prefix = prefix
+                break
+            jobs.extend(((prefix, name), [os.path.join(prefix_dir, name)], 'sha256') for name in names)
+            planned += sizes
+
+        for (prefix, name), digest in self.run_jobs(jobs):
+            if digest is None:
+                continue
+            if digest == name:
+                self.report['chunks_verified'] += 1
+            else:
+                self.problem('corrupt_chunk', os.path.join(prefix, name), f"sha256 {digest}")
+
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        with open(state_path, 'w') as f:
+            json.dump({'next_prefix': next_prefix, 'finished': time.time()}, f)
+
+    def write_history(self, mode, target=None):
+        """Append the outcome of this check to .state/integrity.jsonl"""
+        record = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'mode': mode,
+            'target': target,
+            'report': dict(self.report),
+            'problems': [list(problem) for problem in self.problems[:1000]],
+        }
+        path = os.path.join(self.backup_dest, HISTORY_FILE)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import stat
+import time
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import fileops
+
+# Files handed to a copy worker at once, so small files don't cost one future each
+BATCH_SIZE = 256
+
+def glob_to_regex(pattern):
+    """Translate an rsync-style glob: * and ? stay within one path component, ** does not"""
+    out = ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**', i):
+            out += '.*'
+            i += 2
+            continue
+        if char == '*':
+            out += '[^/]*'
+        elif char == '?':
+            out += '[^/]'
+        elif char == '[':
+            end = pattern.find(']', i + 2)
+            if end == -1:
+                out += re.escape(char)
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                out += '[' + body.replace('\\', '\\\\') + ']'
+                i = end
+        else:
+            out += re.escape(char)
+        i += 1
+    return out
+
+class ExcludeMatcher:
+    """exclude_patterns compiled into two regular expressions, one for any entry and one for folders
+
+    Follows rsync's rules: a pattern without a slash matches the last path
+    component, a leading '/' anchors it to the top of the source, and a
+    trailing '/' only matches folders. An excluded folder excludes its
+    whole subtree, since it is never scanned.
+    """
+
+    def __init__(self, patterns):
+        any_rules = []
+        dir_rules = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            rules = dir_rules if pattern.endswith('/') else any_rules
+            anchor = '^' if pattern.startswith('/') else '(?:^|/)'
+            rules.append(anchor + glob_to_regex(pattern.strip('/')) + '$')
+        self.any_regex = re.compile('|'.join(f"(?:{rule})" for rule in any_rules)) if any_rules else None
+        self.dir_regex = re.compile('|'.join(f"(?:{rule})" for rule in dir_rules)) if dir_rules else None
+
+    def excluded(self, rel_path, is_dir):
+        if self.any_regex is not None and self.any_regex.search(rel_path):
+            return True
+        return is_dir and self.dir_regex is not None and self.dir_regex.search(rel_path) is not None
+
+def scan_tree(root, workers, matcher=None):
+    """Walk a tree with parallel os.scandir calls
+
+    Returns (folders, entries): the relative folder paths, and a dict of
+    relative path -> lstat result for everything else. Excluded entries
+    are left out and excluded folders are not entered.
+    """
+    folders = []
+    entries = {}
+
+    def scan(rel_dir):
+        subdirs = []
+        found = []
+        try:
+            with os.scandir(os.path.join(root, rel_dir) if rel_dir else root) as it:
+                for entry in it:
+                    rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if matcher is not None and matcher.excluded(rel_path, is_dir):
+                        continue
+                    if is_dir:
+                        subdirs.append(rel_path)
+                    else:
+                        found.append((rel_path, entry.stat(follow_symlinks=False)))
+        except FileNotFoundError:
+            pass
+        return subdirs, found
+
+    if not os.path.isdir(root):
+        return folders, entries
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan, '')}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirs, found = future.result()
+                folders.extend(subdirs)
+                entries.update(found)
+                pending.update(executor.submit(scan, rel_dir) for rel_dir in subdirs)
+    return folders, entries
+
+def same_file(a, b):
+    # Like rsync's quick check: size and modification time to the second
+    return a.st_size == b.st_size and int(a.st_mtime) == int(b.st_mtime)
+
+class LocalSync:
+    """Mirrors a local source folder into a snapshot without spawning rsync
+
+    Source and destination are scanned with parallel os.scandir workers;
+    files whose size and mtime already match are left alone. The rest are
+    hardlinked from link_dest when unchanged there (like rsync --link-dest),
+    or copied on a thread pool with a reflink or copy_file_range into a
+    temporary name and renamed into place, so data shared with an older
+    snapshot is never written through. Entries missing from the source are
+    deleted afterwards, as with --delete-after; excluded ones are kept.
+    FIFOs, sockets and device files are skipped and counted, not copied.
+    """
+
+    def __init__(self, source, destination, exclude_patterns, workers=0, link_dest=None,
+                 dry_run=False, stream=None, logger=None):
+        self.source = source
+        self.destination = destination
+        self.matcher = ExcludeMatcher(exclude_patterns)
+        self.workers = workers or os.cpu_count() or 1
+        self.link_dest = link_dest
+        self.dry_run = dry_run
+        self.stream = stream
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.reflink_ok = True
+        self.report = {'copied': 0, 'linked': 0, 'unchanged': 0, 'deleted': 0, 'vanished': 0, 'special': 0,
+                       'errors': 0}
+
+    def count(self, key, size=0):
+        with self.lock:
+            self.report[key] += 1
+            if self.stream is None:
+                return
+            # Like rsync with --link-dest, only copied files count as transferred
+            if key == 'copied':
+                self.stream.stats['transfers'] += 1
+                self.stream.stats['bytes'] += size
+            else:
+                self.stream.stats['checks'] += 1
+
+    def error(self, rel_path, message):
+        with self.lock:
+            self.report['errors'] += 1
+            if self.stream is not None:
+                self.stream.record_error(rel_path, message)
+        if self.logger:
+            self.logger.warning(f"{rel_path}: {message}")
+
+    def run(self):
+        """Bring destination in line with source; return the report"""
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            source_scan = executor.submit(scan_tree, self.source, self.workers, self.matcher)
+            dest_scan = executor.submit(scan_tree, self.destination, self.workers, self.matcher)
+            source_dirs, source_entries = source_scan.result()
+            dest_dirs, dest_entries = dest_scan.result()
+        if self.logger:
+            self.logger.info(f"Scanned {len(source_entries)} source and {len(dest_entries)} destination "
+                             f"entries in {time.time() - start_time:.2f} seconds")
+
+        work = []
+        for rel_path, st in source_entries.items():
+            current = dest_entries.get(rel_path)
+            if stat.S_ISREG(st.st_mode):
+                if current is not None and stat.S_ISREG(current.st_mode) and same_file(st, current):
+                    self.count('unchanged')
+                else:
+                    work.append(rel_path)
+            elif stat.S_ISLNK(st.st_mode):
+                work.append(rel_path)
+            else:
+                # Like rsync without --specials/--devices; not an error, since there is nothing to back up
+                self.report['special'] += 1
+                if self.logger:
+                    self.logger.info(f"Skipping special file {rel_path}")
+
+        if self.stream is not None:
+            self.stream.stats['totalTransfers'] = len(work)
+            self.stream.stats['totalBytes'] = sum(source_entries[path].st_size for path in work)
+
+        if self.dry_run:
+            if self.logger:
+                self.logger.info(f"Would copy or link {len(work)} files, "
+                                 f"{len(self.extraneous(source_dirs, source_entries, dest_dirs, dest_entries))} "
+                                 f"entries would be deleted")
+            return self.report
+
+        os.makedirs(self.destination, exist_ok=True)
+        for rel_dir in sorted(source_dirs):
+            target = os.path.join(self.destination, rel_dir)
+            if os.path.islink(target) or (os.path.exists(target) and not os.path.isdir(target)):
+                os.remove(target)
+            os.makedirs(target, exist_ok=True)
+
+        batches = [work[i:i + BATCH_SIZE] for i in range(0, len(work), BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.sync_batch, batch, source_entries) for batch in batches]
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=1)
+                if self.stream is not None:
+                    self.stream.maybe_report()
+            for future in futures:
+                future.result()
+
+        self.delete_extraneous(source_dirs, source_entries, dest_dirs, dest_entries)
+        self.copy_folder_times(source_dirs)
+        return self.report
+
+    def sync_batch(self, batch, source_entries):
+        for rel_path in batch:
+            try:
+                self.sync_one(rel_path, source_entries[rel_path])
+            except FileNotFoundError:
+                # Changed while we were scanning, as rsync's "file has vanished"
+                with self.lock:
+                    self.report['vanished'] += 1
+            except OSError as e:
+                self.error(rel_path, str(e))
+
+    def sync_one(self, rel_path, st):
+        source = os.path.join(self.source, rel_path)
+        target = os.path.join(self.destination, rel_path)
+        if os.path.isdir(target) and not os.path.islink(target):
+            shutil.rmtree(target)
+
+        if stat.S_ISLNK(st.st_mode):
+            link = os.readlink(source)
+            if os.path.islink(target) and os.readlink(target) == link:
+                self.count('unchanged')
+                return
+            tmp_path = self.temp_name(target)
+            os.symlink(link, tmp_path)
+            os.replace(tmp_path, target)
+            self.count('copied')
+            return
+
+        if self.link_dest:
+            previous = os.path.join(self.link_dest, rel_path)
+            try:
+                previous_st = os.lstat(previous)
+            except FileNotFoundError:
+                previous_st = None
+            if previous_st is not None and stat.S_ISREG(previous_st.st_mode) and same_file(st, previous_st):
+                tmp_path = self.temp_name(target)
+                os.link(previous, tmp_path)
+                os.replace(tmp_path, target)
+                self.count('linked', st.st_size)
+                return
+
+        tmp_path = self.temp_name(target)
+        try:
+            method = fileops.copy_file(source, tmp_path, reflink=self.reflink_ok)
+        except BaseException:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        # Don't keep retrying the ioctl once the filesystem has refused it
+        if method != 'reflink':
+            self.reflink_ok = False
+        os.replace(tmp_path, target)
+        self.count('copied', st.st_size)
+
+    @staticmethod
+    def temp_name(target):
+        folder, name = os.path.split(target)
+        return os.path.join(folder, f".{name}.{threading.get_ident()}.tmp")
+
+    def extraneous(self, source_dirs, source_entries, dest_dirs, dest_entries):
+        wanted = set(source_dirs)
+        return [path for path in list(dest_entries) + dest_dirs
+                if path not in source_entries and path not in wanted]
+
+    def delete_extraneous(self, source_dirs, source_entries, dest_dirs, dest_entries):
+        # Deepest first, so folders are empty by the time they are removed
+        for rel_path in sorted(self.extraneous(source_dirs, source_entries, dest_dirs, dest_entries),
+                               key=lambda path: path.count('/'), reverse=True):
+            target = os.path.join(self.destination, rel_path)
+            try:
+                if os.path.isdir(target) and not os.path.islink(target):
+                    shutil.rmtree(target)
+                else:
+                    os.remove(target)
+                with self.lock:
+                    self.report['deleted'] += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.error(rel_path, f"could not delete: {e}")
+
+    def copy_folder_times(self, source_dirs):
+        for rel_dir in sorted(source_dirs, key=lambda path: path.count('/'), reverse=True):
+            try:
+                st = os.stat(os.path.join(self.source, rel_dir))
+                os.utime(os.path.join(self.destination, rel_dir), ns=(st.st_atime_ns, st.st_mtime_ns))
+            except OSError:
+                pass
@@ -10,12 +10,54 @@ from datetime import datetime
 from pathlib import Path
 import shutil
 import time
+import re
+import tempfile
+import fnmatch
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import fileops
+import dedup_store
+import snapshot_index
+import transfer_stream
+import change_tracker
+import trash
+import retention
+import daemon
+import integrity
+import transfer_scheduler
+import run_journal
+import run_metrics
+import archive_tier
+import orchestrator
+import local_sync
+import retry_queue
+import transfer_plan
 
 class OneDriveBackup:
-    def __init__(self, config_file='config.json'):
+    def __init__(self, config_file='config.json', config=None, account=None):
         self.config_file = config_file
-        self.config = self.load_config()
+        self.account = account
+        self.config = config if config is not None else self.load_config()
         self.setup_logging()
+        self.transfer_stream = None
+        self.seeded_from = None
+        self.sync_base = None
+        self.lister = None
+        self.pending_listing = None
+        self.pending_cursor_meta = None
+        self.prefetched_listing = None
+        self.environment_checked = False
+        self.atomic_rclone = None
+        self.scheduler = None
+        self.journal = None
+        self.resumed = False
+        self.metrics = run_metrics.RunMetrics()
+        self.last_record = None
+        self.budget = None
+        self.priority = 0
+        self.retry_queue = None
+        self.retry_report = None
         
     def load_config(self):
         """Load configuration from JSON file"""
@@ -25,9 +67,10 @@ class OneDriveBackup:
         else:
             return self.create_default_config()
     
-    def create_default_config(self):
-        """Create default configuration"""
-        config = {
+    @staticmethod
+    def default_config():
+        """Return the default configuration"""
+        return {
             "source_type": "rclone",  # "rclone" or "local"
             "rclone_remote": "onedrive:",  # Name of your rclone remote
             "local_source": "~/OneDrive",  # Path if OneDrive is mounted locally
@@ -58,9 +101,59 @@ class OneDriveBackup:
                 "--low-level-retries", "10"
             ],
             "log_file": "~/onedrive-backup/backup.log",
+            "progress_format": "json",  # "json" (periodic summaries) or "text" (every line)
+            "progress_interval": 30,
             "keep_versions": 3,
+            # Optional grandfather-father-son policy, replaces the keep_versions count
+            # e.g. {"daily": 7, "weekly": 4, "monthly": 12, "yearly": 2, "max_total_gb": 500}
+            "retention": {},
+            "background_prune": True,
+            "purge_workers": 4,
+            "purge_files_per_second": 0,  # 0 = unlimited
+            "parallel_workers": 1,  # >1 syncs top-level folders concurrently
+            "parallel_retries": 2,
+            "change_detection": "full",  # "full" or "listing"
+            "full_sync_every": 7,
+            "listing_options": ["--fast-list"],
+            "snapshot_mode": "full",  # "full", "hardlink" or "reflink"
+            "storage_backend": "files",  # "files" or "dedup"
+            "dedup_chunk_size_mb": 4,
+            "index_snapshots": True,
+            "index_hashes": True,
+            "daemon_interval_minutes": 60,  # Used with --daemon
+            "daemon_debounce_seconds": 60,
+            "daemon_watch": True,  # Run when local_source changes (needs inotify-tools)
+            "verify_hash_type": "quickxor",  # Remote hash compared by --verify
+            "verify_workers": 0,  # 0 = one per CPU
+            "scrub_gb_per_run": 50,  # Data re-read by each --scrub
+            "scrub_mb_per_second": 0,  # 0 = unlimited
+            # Time windows with their own rclone limits, first match wins, e.g.
+            # {"days": "mon-fri", "start": "08:00", "end": "18:00", "bwlimit": "10M", "transfers": 2}
+            "transfer_profiles": [],
+            "adaptive_throttle": True,  # Back off when OneDrive throttles (429/503)
+            "adaptive_min_bwlimit": "1M",
+            "resume_interrupted": True,  # Continue an interrupted run's snapshot instead of starting over
+            "resume_max_age_hours": 24,  # Older interrupted runs resync every folder
+            "metrics_textfile": "",  # .prom file for node_exporter; "" = .state/metrics.prom in the destination
+            "metrics_port": 0,  # HTTP /metrics endpoint in daemon mode, 0 = off
+            "metrics_address": "127.0.0.1",
+            "archive_after_days": 0,  # Pack snapshots older than this into compressed archives, 0 = never
+            "archive_compression_level": 10,  # zstd level, 1-19
+            "archive_threads": 0,  # Compression threads, 0 = one per CPU
+            "archive_block_mb": 16,  # Unit of random access when restoring single files
+            "local_sync_engine": "rsync",  # "rsync" or "builtin" (parallel, in-process) for local sources
+            "local_sync_workers": 0,  # Scan and copy threads of the builtin engine, 0 = one per CPU
+            "retry_attempts": 3,  # Targeted retries of failed paths after the main pass, 0 = off
+            "retry_backoff_seconds": 10,  # Wait before the second retry, doubled for each further one
+            "quarantine_after_runs": 3,  # Exclude paths still failing after this many runs, 0 = never
+            "quarantine_days": 30,  # Give quarantined paths another chance after this, 0 = never
+            "plan_max_age_minutes": 60,  # A --plan is executed by the next run if it starts within this time
             "dry_run": False
         }
+    
+    def create_default_config(self):
+        """Create default configuration"""
+        config = self.default_config()
         
         with open(self.config_file, 'w') as f:
             json.dump(config, f, indent=4)
@@ -74,6 +167,16 @@ class OneDriveBackup:
         log_file = os.path.expanduser(self.config['log_file'])
         os.makedirs(os.path.dirname(log_file), exist_ok=True)
         
+        if self.account:
+            # Several accounts share the process, so each gets its own logger and log file
+            self.logger = logging.getLogger(f"account.{self.account}")
+            self.logger.setLevel(logging.INFO)
+            if not self.logger.handlers:
+                handler = logging.FileHandler(log_file)
+                handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+                self.logger.addHandler(handler)
+            return
+        
         logging.basicConfig(
             level=logging.INFO,
             format='%(asctime)s - %(levelname)s - %(message)s',
@@ -90,7 +193,7 @@ class OneDriveBackup:
         
         if self.config['source_type'] == 'rclone':
             tools.append('rclone')
-        else:
+        elif self.config.get('local_sync_engine', 'rsync') != 'builtin':
             tools.append('rsync')
         
         missing_tools = []
@@ -108,13 +211,32 @@ class OneDriveBackup:
         
         return True
     
+    def check_environment(self):
+        """Check tools and the rclone remote once per process"""
+        if self.environment_checked:
+            return True
+        
+        with self.metrics.phase('dependencies'):
+            if not self.check_dependencies():
+                return False
+        
+        if self.config['source_type'] == 'rclone':
+            with self.metrics.phase('rclone_setup'):
+                if not self.setup_rclone():
+                    return False
+        
+        self.environment_checked = True
+        return True
+    
     def setup_rclone(self):
         """Check and setup rclone configuration"""
         try:
             result = subprocess.run(['rclone', 'listremotes'], 
                                   capture_output=True, text=True)
             
-            if self.config['rclone_remote'] not in result.stdout:
+            # rclone_remote may name a folder of the remote, e.g. "onedrive:Documents"
+            remote_name = self.config['rclone_remote'].split(':', 1)[0] + ':'
+            if remote_name not in result.stdout.split():
                 self.logger.warning(f"Remote '{self.config['rclone_remote']}' not found in rclone config")
                 self.logger.info("Run 'rclone config' to set up OneDrive remote")
                 return False
@@ -125,26 +247,329 @@ class OneDriveBackup:
             return False
     
     def create_backup_directory(self):
-        """Create backup directory structure"""
+        """Create backup directory structure
+        
+        Versioned snapshots are built under a hidden working name and only
+        renamed to backup_<timestamp> by complete_snapshot(). An interrupted
+        run's working directory is picked up again instead.
+        """
         backup_dest = os.path.expanduser(self.config['backup_destination'])
         
+        backup_path = self.resume_snapshot(backup_dest)
+        if backup_path:
+            return backup_path
+        
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         
         if self.config['keep_versions'] > 1:
-            backup_path = os.path.join(backup_dest, f"backup_{timestamp}")
+            name = f"backup_{timestamp}"
+            backup_path = os.path.join(backup_dest, run_journal.working_name(name))
         else:
-            backup_path = os.path.join(backup_dest, "current")
+            name = "current"
+            backup_path = os.path.join(backup_dest, name)
         
         os.makedirs(backup_path, exist_ok=True)
         
         self.logger.info(f"Backup destination: {backup_path}")
+        
+        if not self.config['dry_run']:
+            self.journal.start(name, self.source_description(), self.get_storage_backend())
+        
+        if self.config['keep_versions'] > 1 and not self.config['dry_run']:
+            self.seed_from_latest(backup_path)
+            self.journal.set(phase='seeded',
+                             seeded_from=os.path.basename(self.seeded_from) if self.seeded_from else None)
+        
         return backup_path
     
-    def build_exclude_file(self):
-        """Create temporary exclude file for rsync/rclone"""
-        exclude_file = '/tmp/onedrive_backup_exclude.txt'
-        with open(exclude_file, 'w') as f:
-            for pattern in self.config['exclude_patterns']:
+    def source_description(self):
+        """Identify what is backed up, so a journal from another configuration is not resumed"""
+        if self.config['source_type'] == 'rclone':
+            return f"rclone:{self.config['rclone_remote']}"
+        return f"local:{os.path.expanduser(self.config['local_source'])}"
+    
+    def resume_snapshot(self, backup_dest):
+        """Return the working directory of an interrupted run to continue, or None
+        
+        Also finishes a run that was interrupted after its snapshot was
+        complete, and moves working directories that cannot be resumed to
+        the trash.
+        """
+        journal = self.journal
+        state = None if self.config['dry_run'] else journal.load()
+        if state:
+            name = state['snapshot']
+            final_path = os.path.join(backup_dest, name)
+            working_path = final_path if name == 'current' else \
+                os.path.join(backup_dest, run_journal.working_name(name))
+            
+            if name != 'current' and not os.path.isdir(working_path) and os.path.isdir(final_path):
+                self.logger.info(f"Finishing {name}, completed by an interrupted run")
+                self.finish_snapshot(final_path)
+                journal.clear()
+            elif not os.path.isdir(working_path):
+                journal.clear()
+            elif not self.config.get('resume_interrupted', True):
+                self.logger.info(f"Not resuming interrupted run of {name} (resume_interrupted is off)")
+                journal.clear()
+            elif not journal.matches(self.source_description(), self.get_storage_backend()):
+                self.logger.warning(f"Interrupted run of {name} backed up a different source, not resuming it")
+                journal.clear()
+            else:
+                age = journal.age_hours()
+                self.logger.info(f"Resuming interrupted run of {name} (attempt {state.get('attempts', 1) + 1}, "
+                                 f"last progress {age:.1f} hours ago)")
+                if age > self.config.get('resume_max_age_hours', 24) and state['folders_done']:
+                    self.logger.info("Interrupted run is old, syncing all folders again")
+                    state['folders_done'] = []
+                journal.set(attempts=state.get('attempts', 1) + 1)
+                if state.get('seeded_from'):
+                    self.seeded_from = os.path.join(backup_dest, state['seeded_from'])
+                elif state.get('phase') == 'created' and name != 'current':
+                    # The crash may have hit while seeding; linking skips files that already exist
+                    self.seed_from_latest(working_path)
+                    journal.set(phase='seeded', seeded_from=os.path.basename(self.seeded_from)
+                                if self.seeded_from else None)
+                self.resumed = True
+                self.logger.info(f"Backup destination: {working_path}")
+                return working_path
+        
+        # Working directories nobody will resume would otherwise pile up unseen
+        if os.path.isdir(backup_dest) and not self.config['dry_run']:
+            for item in os.listdir(backup_dest):
+                if run_journal.is_working_dir(item):
+                    trashed = trash.move_to_trash(backup_dest, os.path.join(backup_dest, item))
+                    self.logger.info(f"Moved abandoned partial backup to trash: {item} -> {trashed}")
+        return None
+    
+    def complete_snapshot(self, backup_path):
+        """Give a finished snapshot its final backup_* name in one rename; return the new path"""
+        name = os.path.basename(backup_path)
+        if not run_journal.is_working_dir(name):
+            return backup_path
+        
+        final_path = os.path.join(os.path.dirname(backup_path), name[len(run_journal.WORKING_PREFIX):])
+        os.rename(backup_path, final_path)
+        run_journal.fsync_dir(os.path.dirname(final_path))
+        self.journal.set(phase='complete')
+        return final_path
+    
+    def finish_snapshot(self, backup_path):
+        """Update pruning, the index and 'latest' for a snapshot that is complete"""
+        with self.metrics.phase('prune'):
+            self.cleanup_old_backups()
+            self.prune_change_cursors()
+        with self.metrics.phase('index'):
+            self.index_snapshot(backup_path)
+        with self.metrics.phase('symlink'):
+            self.create_symlink_to_latest(backup_path)
+    
+    def archive_old_snapshots(self):
+        """Pack snapshots older than archive_after_days into compressed, seekable archives
+        
+        Runs from --archive, not as part of a backup. The original files go
+        to the trash afterwards, so the background purge deletes them.
+        """
+        days = self.config.get('archive_after_days', 0)
+        if not days or self.config['keep_versions'] <= 1 or self.get_storage_backend() == 'dedup':
+            return
+        mode = self.get_snapshot_mode()
+        if mode != 'full':
+            # Most of an old snapshot's inodes are shared with newer ones; packing would store them twice
+            self.logger.warning(f"Not archiving: with snapshot_mode '{mode}' old backups share their data "
+                                f"with newer ones, so an archive would add a second copy instead of saving space")
+            return
+        if not archive_tier.available():
+            self.logger.warning("archive_after_days is set but neither the zstandard module nor "
+                                "the zstd command is available; not archiving")
+            return
+        
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        latest = self.get_latest_backup()
+        cutoff = time.time() - days * 86400
+        threads = self.config.get('archive_threads', 0) or os.cpu_count() or 1
+        
+        for name in sorted(os.listdir(backup_dest)):
+            path = os.path.join(backup_dest, name)
+            if not name.startswith('backup_') or not os.path.isdir(path) or path == latest:
+                continue
+            
+            if archive_tier.is_archive_snapshot(path):
+                # A previous run may have stopped between packing and clearing the originals
+                if archive_tier.unpacked_items(path):
+                    archive_tier.trash_unpacked(backup_dest, path)
+                continue
+            
+            created = snapshot_index.snapshot_created(name)
+            if created is None or created > cutoff or dedup_store.is_manifest_snapshot(path):
+                continue
+            
+            self.logger.info(f"Archiving {name}")
+            start_time = time.time()
+            try:
+                stats = archive_tier.pack_snapshot(
+                    path, level=self.config.get('archive_compression_level', 10), threads=threads,
+                    block_size=int(self.config.get('archive_block_mb', 16) * 1024 * 1024))
+            except Exception as e:
+                self.logger.error(f"Could not archive {name}: {e}")
+                continue
+            
+            index = self.open_index()
+            if index:
+                index.detach_inodes(name)
+                index.close()
+            archive_tier.trash_unpacked(backup_dest, path)
+            self.logger.info(f"Archived {name}: {stats['files']} files, {stats['bytes'] / (1024 ** 3):.2f} GB "
+                             f"packed into {stats['archive_bytes'] / (1024 ** 3):.2f} GB "
+                             f"in {time.time() - start_time:.2f} seconds")
+    
+    def get_snapshot_mode(self):
+        """Return how a new versioned snapshot shares data with the previous one"""
+        # The dedup store shares data at chunk level already
+        if self.get_storage_backend() == 'dedup':
+            return 'full'
+        
+        mode = self.config.get('snapshot_mode', 'full')
+        if mode not in ('full', 'hardlink', 'reflink'):
+            self.logger.warning(f"Unknown snapshot_mode '{mode}', using 'full'")
+            return 'full'
+        return mode
+    
+    def get_storage_backend(self):
+        """Return whether snapshots are plain file trees or dedup manifests"""
+        return self.config.get('storage_backend', 'files')
+    
+    def get_object_store(self):
+        """Return the content-addressed store used by the dedup backend"""
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        chunk_size = int(self.config.get('dedup_chunk_size_mb', 4) * 1024 * 1024)
+        return dedup_store.ObjectStore(backup_dest, chunk_size)
+    
+    def get_sync_target(self, backup_path):
+        """Return the directory rclone/rsync should write into"""
+        if self.get_storage_backend() != 'dedup':
+            return backup_path
+        
+        # The dedup backend keeps one working copy that is synced in place and
+        # then ingested, so each run only downloads and stores changes
+        staging_dir = self.get_object_store().staging_dir
+        os.makedirs(staging_dir, exist_ok=True)
+        return staging_dir
+    
+    def ingest_snapshot(self, backup_path):
+        """Store the synced working copy and write the snapshot manifest; the caller holds the store lock"""
+        store = self.get_object_store()
+        
+        previous = self.get_latest_backup(exclude=backup_path)
+        if previous is None and dedup_store.is_manifest_snapshot(backup_path):
+            previous = backup_path
+        
+        self.logger.info(f"Storing snapshot in deduplicating store: {store.root}")
+        try:
+            stats = store.ingest(store.staging_dir, backup_path, previous, self.logger)
+        except Exception as e:
+            self.logger.error(f"Error writing snapshot manifest: {e}")
+            return False
+        
+        self.logger.info(f"Stored {stats['files']} files, {stats['hashed_files']} new or changed, "
+                         f"{stats['new_bytes'] / (1024 ** 3):.2f} GB of new data")
+        return True
+    
+    def get_latest_backup(self, exclude=None):
+        """Return the path of the most recent backup_* directory, or None"""
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        
+        latest_link = os.path.join(backup_dest, 'latest')
+        if os.path.islink(latest_link):
+            target = os.path.join(backup_dest, os.readlink(latest_link))
+            if os.path.isdir(target) and target != exclude:
+                return target
+        
+        if not os.path.isdir(backup_dest):
+            return None
+        
+        backup_dirs = sorted(
+            (os.path.join(backup_dest, item) for item in os.listdir(backup_dest)
+             if item.startswith('backup_')),
+            reverse=True)
+        for path in backup_dirs:
+            if path != exclude and os.path.isdir(path):
+                return path
+        return None
+    
+    def rclone_writes_atomically(self):
+        """Check that rclone replaces changed files instead of rewriting them in place
+        
+        Hardlinked snapshots are only safe if an updated file gets a new inode;
+        rclone does this (download to .partial, then rename) since v1.63
+        unless --inplace is given.
+        """
+        if '--inplace' in self.config['rclone_options']:
+            return False
+        
+        if self.atomic_rclone is None:
+            try:
+                result = subprocess.run(['rclone', 'version'], capture_output=True, text=True)
+            except Exception as e:
+                self.logger.warning(f"Could not determine rclone version: {e}")
+                return False
+            
+            match = re.search(r'rclone v(\d+)\.(\d+)', result.stdout)
+            self.atomic_rclone = bool(match) and (int(match.group(1)), int(match.group(2))) >= (1, 63)
+        return self.atomic_rclone
+    
+    def seed_from_latest(self, backup_path):
+        """Populate a new snapshot from the latest one so only changes are transferred"""
+        mode = self.get_snapshot_mode()
+        if mode == 'full':
+            return
+        
+        # rsync builds hardlinked snapshots itself via --link-dest
+        if mode == 'hardlink' and self.config['source_type'] != 'rclone':
+            return
+        
+        if mode == 'hardlink' and not self.rclone_writes_atomically():
+            self.logger.warning("snapshot_mode 'hardlink' needs rclone >= 1.63 without --inplace; "
+                                "falling back to a full download for this run")
+            return
+        
+        latest = self.get_latest_backup(exclude=backup_path)
+        if not latest:
+            self.logger.info("No previous snapshot to seed from, performing full backup")
+            return
+        if archive_tier.is_archive_snapshot(latest):
+            self.logger.info(f"Previous snapshot {os.path.basename(latest)} is archived, performing full backup")
+            return
+        
+        self.logger.info(f"Seeding {os.path.basename(backup_path)} from "
+                         f"{os.path.basename(latest)} using {mode}s")
+        start_time = time.time()
+        with self.metrics.phase('seed'):
+            file_count, total_bytes = fileops.link_tree(latest, backup_path, mode)
+        self.seeded_from = latest
+        self.logger.info(f"Seeded {file_count} files ({total_bytes / (1024 ** 3):.2f} GB) "
+                         f"in {time.time() - start_time:.2f} seconds")
+    
+    def build_exclude_file(self, subfolder=None, quarantine=True):
+        """Create temporary exclude file for rsync/rclone
+        
+        When syncing a single top-level folder, patterns anchored with a
+        leading '/' are rewritten relative to that folder, and anchored
+        patterns for other folders are dropped. Quarantined paths are
+        excluded too, unless quarantine is False.
+        """
+        patterns = list(self.config['exclude_patterns'])
+        if quarantine and self.config['source_type'] == 'rclone':
+            patterns.extend(self.get_retry_queue().exclude_patterns())
+        
+        fd, exclude_file = tempfile.mkstemp(prefix='onedrive_backup_exclude_', suffix='.txt')
+        with os.fdopen(fd, 'w') as f:
+            for pattern in patterns:
+                if subfolder is not None and pattern.startswith('/'):
+                    prefix = f"/{subfolder}/"
+                    if not pattern.startswith(prefix):
+                        continue
+                    pattern = '/' + pattern[len(prefix):]
                 f.write(f"{pattern}\n")
         return exclude_file
     
@@ -156,28 +581,44 @@ class OneDriveBackup:
             self.logger.error(f"Source directory not found: {source}")
             return False
         
+        if self.config.get('local_sync_engine', 'rsync') == 'builtin':
+            return self.backup_with_local_sync(source, backup_path)
+        
         exclude_file = self.build_exclude_file()
         
         cmd = ['rsync']
-        cmd.extend(self.config['rsync_options'])
+        if self.structured_progress():
+            cmd.extend(transfer_stream.structured_rsync_options(self.config['rsync_options']))
+        else:
+            cmd.extend(self.config['rsync_options'])
         cmd.extend(['--exclude-from', exclude_file])
         
         if self.config['dry_run']:
             cmd.append('--dry-run')
         
+        if self.config['keep_versions'] > 1 and self.get_snapshot_mode() == 'hardlink':
+            latest = self.get_latest_backup(exclude=backup_path)
+            if latest:
+                cmd.extend(['--link-dest', latest])
+        
         cmd.extend([f"{source}/", backup_path])
         
         self.logger.info(f"Running: {' '.join(cmd)}")
         
+        stream = transfer_stream.RsyncStream(
+            self.logger, interval=self.config.get('progress_interval', 30),
+            echo=not self.structured_progress())
+        self.transfer_stream = stream
+        
         try:
             process = subprocess.Popen(cmd, stdout=subprocess.PIPE, 
                                      stderr=subprocess.STDOUT, text=True)
             
             for line in process.stdout:
-                print(line.rstrip())
-                self.logger.debug(line.rstrip())
+                stream.feed(line)
             
             process.wait()
+            stream.maybe_report(force=True)
             
             if process.returncode == 0:
                 self.logger.info("Backup completed successfully")
@@ -192,58 +633,192 @@ class OneDriveBackup:
         finally:
             os.remove(exclude_file)
     
-    def backup_with_rclone(self, backup_path):
-        """Perform backup using rclone (for cloud OneDrive)"""
-        exclude_file = self.build_exclude_file()
+    def backup_with_local_sync(self, source, backup_path):
+        """Perform backup of a local source with the in-process parallel engine instead of rsync"""
+        link_dest = None
+        if self.config['keep_versions'] > 1 and self.get_snapshot_mode() == 'hardlink':
+            latest = self.get_latest_backup(exclude=backup_path)
+            if latest and not archive_tier.is_archive_snapshot(latest):
+                link_dest = latest
+        
+        stream = transfer_stream.TransferStats(self.logger, interval=self.config.get('progress_interval', 30))
+        self.transfer_stream = stream
+        engine = local_sync.LocalSync(
+            source, backup_path, self.config['exclude_patterns'],
+            workers=self.config.get('local_sync_workers', 0), link_dest=link_dest,
+            dry_run=self.config['dry_run'], stream=stream, logger=self.logger)
+        
+        self.logger.info(f"Syncing {source} with {engine.workers} workers"
+                         + (f", linking unchanged files to {os.path.basename(link_dest)}" if link_dest else ""))
+        try:
+            report = engine.run()
+        except Exception as e:
+            self.logger.error(f"Error during local sync: {e}")
+            return False
         
-        cmd = ['rclone', 'sync']
-        cmd.append(self.config['rclone_remote'])
-        cmd.append(backup_path)
-        cmd.extend(self.config['rclone_options'])
+        stream.maybe_report(force=True)
+        self.logger.info(f"Copied {report['copied']}, linked {report['linked']}, "
+                         f"unchanged {report['unchanged']}, deleted {report['deleted']} files")
+        if report['vanished']:
+            self.logger.warning(f"{report['vanished']} files vanished from the source during the backup")
+        if report['special']:
+            self.logger.warning(f"Skipped {report['special']} FIFOs, sockets or device files")
+        if report['errors']:
+            self.logger.error(f"Backup failed: {report['errors']} files could not be copied")
+            return False
+        self.logger.info("Backup completed successfully")
+        return True
+    
+    def structured_progress(self):
+        """Whether child output is ingested as structured progress instead of echoed"""
+        return self.config.get('progress_format', 'json') == 'json'
+    
+    def get_transfer_scheduler(self):
+        """Return the scheduler that picks rclone limits for the current time window"""
+        if self.scheduler is None:
+            self.scheduler = transfer_scheduler.TransferScheduler(
+                self.config.get('transfer_profiles', []), self.logger,
+                max_workers=self.config.get('parallel_workers', 1),
+                adaptive=self.config.get('adaptive_throttle', True),
+                min_bwlimit=self.config.get('adaptive_min_bwlimit', '1M'),
+                budget=self.budget, priority=self.priority)
+        return self.scheduler
+    
+    def run_rclone(self, cmd, label=None):
+        """Run an rclone command and ingest its output; return (returncode, stream)
+        
+        The limits of the current transfer profile are applied to cmd. When
+        a different profile starts mid-run, rclone is stopped and restarted
+        with the new limits; the files it already copied are not fetched again.
+        When several accounts share a budget, rclone waits for a process slot.
+        """
+        scheduler = self.get_transfer_scheduler()
+        stream = None
+        rc_failures = 0
+        while True:
+            with scheduler.process_slot():
+                profile = scheduler.profile()
+                extra, controller = scheduler.controller(
+                    profile, label, remote_control=rc_failures < transfer_scheduler.RC_START_ATTEMPTS)
+                run_cmd = scheduler.apply(cmd, profile) + extra
+                env = dict(os.environ, **controller.rc.environment()) if controller else None
+                if profile.get('name'):
+                    prefix = f"[{label}] " if label else ""
+                    self.logger.info(prefix + f"Transfer profile '{profile['name']}' applies")
+                
+                part = transfer_stream.RcloneStream(
+                    self.logger, label=label, interval=self.config.get('progress_interval', 30),
+                    echo=not self.structured_progress())
+                process = subprocess.Popen(run_cmd, stdout=subprocess.PIPE, 
+                                         stderr=subprocess.STDOUT, text=True, env=env)
+                
+                restarting = False
+                rc_failed = False
+                watch = scheduler.watch_profile(profile)
+                try:
+                    for line in process.stdout:
+                        if controller and transfer_scheduler.RC_START_FAILURE in line:
+                            # Another process took the rc port before rclone could; nothing was transferred
+                            rc_failed = True
+                            continue
+                        part.feed(line)
+                        if controller:
+                            controller.observe(part)
+                        if not restarting and watch.changed():
+                            self.logger.info("Transfer window changed, restarting rclone with the new limits")
+                            restarting = True
+                            process.terminate()
+                    
+                    process.wait()
+                finally:
+                    scheduler.release(controller)
+            if rc_failed:
+                rc_failures += 1
+                if rc_failures >= transfer_scheduler.RC_START_ATTEMPTS:
+                    self.logger.warning("rclone's remote control could not start, continuing without adaptive throttling")
+                continue
+            part.maybe_report(force=True)
+            if stream is None:
+                stream = part
+            else:
+                stream.merge(part)
+            if not restarting:
+                return process.returncode, stream
+    
+    def rclone_succeeded(self, returncode):
+        """Check an rclone exit code, allowing partial failures with --ignore-errors"""
+        # With --ignore-errors flag, rclone may still return 0 despite errors
+        return returncode == 0 or (returncode == 1 and '--ignore-errors' in self.config['rclone_options'])
+    
+    def report_rclone_errors(self, stream):
+        """Log a summary of the errors seen during the sync"""
+        if stream.objecthandle_errors:
+            self.logger.warning(f"Encountered {stream.objecthandle_count} ObjectHandle errors during backup")
+            self.logger.warning("These are typically caused by OneDrive sync issues or corrupted file metadata")
+            self.logger.warning("First few errors:")
+            for err in stream.objecthandle_errors[:5]:
+                self.logger.warning(f"  {err}")
+            self.logger.info("The failed paths are queued for a retry, see --failed")
+        
+        other_errors = {k: v for k, v in stream.errors_by_class.items() if k != 'objecthandle'}
+        if other_errors:
+            summary = ', '.join(f"{count} {name}" for name, count in sorted(other_errors.items()))
+            self.logger.warning(f"Other errors during backup: {summary}")
+    
+    def build_rclone_command(self, source, destination, exclude_file, extra=None, verb='sync'):
+        """Assemble an rclone sync (or copy) command line"""
+        cmd = ['rclone', verb]
+        cmd.append(source)
+        cmd.append(destination)
+        if self.structured_progress():
+            cmd.extend(transfer_stream.structured_rclone_options(
+                self.config['rclone_options'], self.config.get('progress_interval', 30)))
+        else:
+            cmd.extend(self.config['rclone_options'])
         cmd.extend(['--exclude-from', exclude_file])
+        if extra:
+            cmd.extend(extra)
         
         if self.config['dry_run']:
             cmd.append('--dry-run')
+        return cmd
+    
+    def backup_with_rclone(self, backup_path):
+        """Perform backup using rclone (for cloud OneDrive)"""
+        planned = self.take_plan()
+        if planned is not None:
+            return self.backup_changes_with_rclone(backup_path, *planned)
         
-        self.logger.info(f"Running: {' '.join(cmd)}")
+        if self.config.get('change_detection', 'full') == 'listing':
+            changes = self.detect_changes()
+            if changes is not None:
+                return self.backup_changes_with_rclone(backup_path, *changes)
         
-        error_count = 0
-        objecthandle_errors = []
+        if self.config.get('parallel_workers', 1) > 1:
+            return self.backup_with_rclone_parallel(backup_path)
+        
+        exclude_file = self.build_exclude_file()
+        
+        cmd = self.build_rclone_command(self.config['rclone_remote'], backup_path, exclude_file)
+        
+        self.logger.info(f"Running: {' '.join(cmd)}")
         
         try:
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, 
-                                     stderr=subprocess.STDOUT, text=True)
-            
-            for line in process.stdout:
-                print(line.rstrip())
-                self.logger.debug(line.rstrip())
-                
-                # Track ObjectHandle errors
-                if "ObjectHandle is Invalid" in line or "invalidResourceId" in line:
-                    error_count += 1
-                    if error_count <= 5:  # Only log first 5 occurrences
-                        objecthandle_errors.append(line.rstrip())
-            
-            process.wait()
+            returncode, stream = self.run_rclone(cmd)
+            self.transfer_stream = stream
+            error_count = sum(stream.errors_by_class.values())
             
-            if objecthandle_errors:
-                self.logger.warning(f"Encountered {error_count} ObjectHandle errors during backup")
-                self.logger.warning("These are typically caused by OneDrive sync issues or corrupted file metadata")
-                self.logger.warning("First few errors:")
-                for err in objecthandle_errors[:5]:
-                    self.logger.warning(f"  {err}")
-                self.logger.info("Consider running ./find_problem_files.py to identify problematic paths")
+            self.report_rclone_errors(stream)
             
-            # With --ignore-errors flag, rclone may still return 0 despite errors
             # Check if substantial portion of files were transferred
-            if process.returncode == 0 or (process.returncode == 1 and '--ignore-errors' in self.config['rclone_options']):
+            if self.rclone_succeeded(returncode):
                 if error_count > 0:
                     self.logger.warning(f"Backup completed with {error_count} errors (ignored)")
                 else:
                     self.logger.info("Backup completed successfully")
                 return True
             else:
-                self.logger.error(f"Backup failed with return code: {process.returncode}")
+                self.logger.error(f"Backup failed with return code: {returncode}")
                 return False
                 
         except Exception as e:
@@ -252,9 +827,603 @@ class OneDriveBackup:
         finally:
             os.remove(exclude_file)
     
+    def get_sync_base(self, backup_path):
+        """Return the snapshot whose files the sync target already holds, if any"""
+        if self.config['keep_versions'] <= 1:
+            return os.path.basename(backup_path)
+        if self.get_storage_backend() == 'dedup':
+            previous = self.get_latest_backup(exclude=backup_path)
+            return os.path.basename(previous) if previous else None
+        return os.path.basename(self.seeded_from) if self.seeded_from else None
+    
+    def change_detection_possible(self):
+        """Incremental runs need a sync target that starts out as the previous snapshot"""
+        return (self.config['keep_versions'] <= 1
+                or self.get_storage_backend() == 'dedup'
+                or self.get_snapshot_mode() != 'full')
+    
+    def uses_listing(self):
+        """Whether runs build on a remote listing, so listing ahead of a run is not wasted"""
+        return self.config.get('change_detection', 'full') == 'listing' and self.change_detection_possible()
+    
+    def get_cursor_store(self):
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        return change_tracker.CursorStore(backup_dest)
+    
+    def detect_changes(self):
+        """List the remote and diff it against the previous snapshot's cursor
+        
+        Returns (changed, deleted) paths for an incremental run, or None when
+        a full sync is needed: no usable cursor, or a periodic reconciliation
+        is due.
+        """
+        self.pending_listing = None
+        if not self.change_detection_possible():
+            self.logger.warning("change_detection 'listing' needs snapshot_mode 'hardlink'/'reflink', "
+                                "the dedup backend or keep_versions 1; performing full sync")
+            return None
+        
+        listing = self.prefetched_listing
+        self.prefetched_listing = None
+        if listing is None:
+            try:
+                listing = self.list_remote()
+            except Exception as e:
+                self.logger.warning(f"Could not list remote for change detection: {e}; performing full sync")
+                return None
+        
+        self.pending_listing = listing
+        self.pending_cursor_meta = {'runs_since_full': 0}
+        
+        meta, previous_listing = (None, None)
+        if self.sync_base:
+            meta, previous_listing = self.get_cursor_store().load(self.sync_base)
+        if previous_listing is None:
+            self.logger.info("No change cursor for the previous snapshot, performing full sync")
+            return None
+        
+        runs_since_full = meta.get('runs_since_full', 0) + 1
+        if runs_since_full >= self.config.get('full_sync_every', 7):
+            self.logger.info(f"Last full sync was {runs_since_full} runs ago, "
+                             "performing full reconciliation")
+            return None
+        
+        self.pending_cursor_meta = {'runs_since_full': runs_since_full}
+        return change_tracker.diff_listings(previous_listing, listing)
+    
+    def list_remote(self):
+        """Return {path: [size, modtime]} for every file on the remote, honouring the excludes"""
+        # Quarantined files stay in the cursor, so they don't look deleted and drop out of the snapshot
+        exclude_file = self.build_exclude_file(quarantine=False)
+        try:
+            lister = self.lister or change_tracker.RcloneLister(
+                self.config['rclone_remote'], self.config.get('listing_options', ['--fast-list']),
+                exclude_file)
+            start_time = time.time()
+            with self.metrics.phase('listing'):
+                listing = lister.list()
+        finally:
+            os.remove(exclude_file)
+        
+        self.logger.info(f"Listed {len(listing)} remote files in {time.time() - start_time:.2f} seconds")
+        return listing
+    
+    def backup_changes_with_rclone(self, backup_path, changed, deleted):
+        """Fetch only new or modified files and apply remote deletions locally"""
+        self.logger.info(f"Change detection: {len(changed)} new or modified, "
+                         f"{len(deleted)} deleted files since {self.sync_base}")
+        
+        if changed:
+            exclude_file = self.build_exclude_file()
+            fd, files_from = tempfile.mkstemp(prefix='onedrive_backup_changes_', suffix='.txt')
+            with os.fdopen(fd, 'w') as f:
+                for path in changed:
+                    f.write(f"{path}\n")
+            
+            cmd = self.build_rclone_command(self.config['rclone_remote'], backup_path, exclude_file,
+                                            extra=['--files-from', files_from, '--no-traverse'],
+                                            verb='copy')
+            self.logger.info(f"Running: {' '.join(cmd)}")
+            try:
+                returncode, stream = self.run_rclone(cmd)
+            except Exception as e:
+                self.logger.error(f"Error during rclone backup: {e}")
+                return False
+            finally:
+                os.remove(exclude_file)
+                os.remove(files_from)
+            
+            self.transfer_stream = stream
+            self.report_rclone_errors(stream)
+            if not self.rclone_succeeded(returncode):
+                self.logger.error(f"Backup failed with return code: {returncode}")
+                return False
+        
+        if deleted and not self.config['dry_run']:
+            self.apply_deletions(backup_path, deleted)
+        
+        self.logger.info("Backup completed successfully")
+        return True
+    
+    def apply_deletions(self, backup_path, deleted):
+        """Remove files deleted on the remote, and folders left empty by that"""
+        parents = set()
+        for path in deleted:
+            local_path = os.path.join(backup_path, path)
+            if os.path.lexists(local_path) and not os.path.isdir(local_path):
+                os.remove(local_path)
+                parents.add(os.path.dirname(local_path))
+        
+        # Deepest first so nested empty folders collapse
+        for parent in sorted(parents, key=len, reverse=True):
+            while parent != backup_path and parent.startswith(backup_path):
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+    
+    def save_change_cursor(self, backup_path):
+        """Store the listing this snapshot was built from as the next run's cursor"""
+        if self.pending_listing is None:
+            return
+        try:
+            self.get_cursor_store().save(os.path.basename(backup_path), self.pending_listing,
+                                         self.pending_cursor_meta or {})
+        except OSError as e:
+            self.logger.warning(f"Could not save change cursor: {e}")
+    
+    def planned_sync_base(self):
+        """Return the snapshot the next run will start from, if any"""
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        if self.config['keep_versions'] <= 1:
+            return 'current' if os.path.isdir(os.path.join(backup_dest, 'current')) else None
+        latest = self.get_latest_backup()
+        return os.path.basename(latest) if latest else None
+    
+    def plan_reference(self, base):
+        """Return (metadata, cursor meta, where it came from) for a snapshot, metadata as {path: (size, mtime)}
+        
+        Uses the snapshot's change cursor, else the index, else its manifest
+        or the files themselves.
+        """
+        if base is None:
+            return {}, None, 'no previous backup'
+        meta, listing = self.get_cursor_store().load(base)
+        if listing is not None:
+            return ({path: (size, transfer_plan.modtime_seconds(modtime)) for path, (size, modtime) in listing.items()},
+                    meta, 'change cursor')
+        
+        index = self.open_index()
+        if index is not None:
+            try:
+                metadata = index.file_metadata(base)
+            finally:
+                index.close()
+            if metadata:
+                return metadata, None, 'index'
+        
+        snapshot_path = os.path.join(os.path.expanduser(self.config['backup_destination']), base)
+        if dedup_store.is_manifest_snapshot(snapshot_path):
+            return ({entry['path']: (entry['size'], entry['mtime'])
+                     for entry in dedup_store.iter_manifest(snapshot_path)}, None, 'manifest')
+        if archive_tier.is_archive_snapshot(snapshot_path):
+            return ({entry['path']: (entry['size'], entry['mtime'])
+                     for entry in archive_tier.iter_index(snapshot_path)}, None, 'archive index')
+        return ({rel_path: (st.st_size, st.st_mtime) for rel_path, st in snapshot_index.scan_tree(snapshot_path)},
+                None, 'snapshot files')
+    
+    def plan(self):
+        """Estimate what the next run transfers, check the free space and save the plan for that run
+        
+        Returns False if the destination does not have enough free space.
+        """
+        if not self.check_environment():
+            return False
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        os.makedirs(backup_dest, exist_ok=True)
+        rclone = self.config['source_type'] == 'rclone'
+        
+        start_time = time.time()
+        try:
+            listing = self.list_remote() if rclone else self.source_listing()
+        except Exception as e:
+            self.logger.error(f"Could not list the source: {e}")
+            return False
+        list_time = time.time() - start_time
+        
+        base = self.planned_sync_base()
+        reference, cursor_meta, reference_name = self.plan_reference(base)
+        changed, deleted, folders = transfer_plan.compare(listing, reference)
+        transfer_bytes = sum(folder['transfer_bytes'] for folder in folders.values())
+        total_bytes = sum(folder['bytes'] for folder in folders.values())
+        
+        runs_since_full = cursor_meta.get('runs_since_full', 0) + 1 if cursor_meta else 1
+        full_sync_due = (self.config.get('change_detection', 'full') == 'listing' and cursor_meta is not None
+                         and runs_since_full >= self.config.get('full_sync_every', 7))
+        executable = rclone and base is not None and self.change_detection_possible() and not full_sync_due
+        
+        # A full-mode snapshot is a complete new copy; the other modes only store what changed
+        incremental = (self.config['keep_versions'] <= 1 or self.get_snapshot_mode() != 'full'
+                       or self.get_storage_backend() == 'dedup')
+        needed = transfer_bytes if incremental else total_bytes
+        free = shutil.disk_usage(backup_dest).free
+        
+        speed, check_rate, runs = transfer_plan.historical_rates(transfer_plan.read_history(backup_dest))
+        # Without the plan, the sync compares every file that is not transferred
+        check_files = 0 if executable else len(listing) - len(changed)
+        eta = transfer_plan.estimate_seconds(transfer_bytes, check_files, speed, check_rate)
+        
+        gb = 1024 ** 3
+        print(f"Listed {len(listing)} source files ({total_bytes / gb:.2f} GB) in {list_time:.2f} seconds, "
+              f"compared with {base or 'nothing'} ({reference_name})")
+        print(f"  {'Folder':<30} {'Files':>9} {'GB':>9} {'To copy':>9} {'GB':>9} {'Deleted':>8}")
+        for name, folder in sorted(folders.items(), key=lambda item: -item[1]['transfer_bytes']):
+            print(f"  {name[:30]:<30} {folder['files']:>9} {folder['bytes'] / gb:>9.2f} "
+                  f"{folder['transfer_files']:>9} {folder['transfer_bytes'] / gb:>9.2f} {folder['deleted']:>8}")
+        print(f"To transfer: {len(changed)} files, {transfer_bytes / gb:.2f} GB; {len(deleted)} files deleted")
+        enough = free >= needed
+        print(f"Space: the backup needs {needed / gb:.2f} GB, {free / gb:.2f} GB free in {backup_dest}"
+              + ("" if enough else " - NOT ENOUGH"))
+        if eta is None:
+            print("ETA: unknown, run_history.jsonl has no run that transferred data yet")
+        else:
+            duration = f"{eta / 60:.0f} minutes" if eta >= 120 else f"{eta:.0f} seconds"
+            print(f"ETA: about {duration} at {speed / 1024 ** 2:.1f} MB/s "
+                  f"(median of the last {runs} runs that transferred data)")
+        
+        if rclone:
+            meta = {
+                'created': time.time(),
+                'source': self.source_description(),
+                'base': base,
+                'executable': executable,
+                'runs_since_full': runs_since_full,
+                'changed': changed,
+                'deleted': deleted,
+                'transfer_bytes': transfer_bytes,
+            }
+            try:
+                transfer_plan.save_plan(backup_dest, meta, listing)
+            except OSError as e:
+                self.logger.warning(f"Could not save the plan: {e}")
+                executable = False
+            max_age = self.config.get('plan_max_age_minutes', 60)
+            if executable:
+                print(f"A run started within {max_age} minutes fetches exactly these files without listing again")
+            else:
+                print("The next run will still sync everything (a full snapshot, the first backup "
+                      "or a periodic full sync), reusing this listing only with change_detection 'listing'")
+        return enough
+    
+    def take_plan(self):
+        """Return (changed, deleted) of a fresh plan made against this run's sync base, or None
+        
+        A saved plan is used by one run at most.
+        """
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        meta, listing = transfer_plan.load_plan(backup_dest)
+        if meta is None:
+            return None
+        if not self.config['dry_run']:
+            transfer_plan.discard_plan(backup_dest)
+        
+        age_minutes = (time.time() - meta['created']) / 60
+        if (age_minutes > self.config.get('plan_max_age_minutes', 60) or self.resumed
+                or meta['source'] != self.source_description() or meta['base'] != self.sync_base):
+            self.logger.info("Ignoring the saved plan, it no longer matches the backup")
+            return None
+        
+        if not meta['executable'] or not self.change_detection_possible():
+            if self.config.get('change_detection', 'full') == 'listing':
+                self.prefetched_listing = listing
+            return None
+        
+        self.logger.info(f"Using the plan made {age_minutes:.0f} minutes ago instead of listing the remote")
+        self.pending_listing = listing
+        self.pending_cursor_meta = {'runs_since_full': meta['runs_since_full']}
+        return meta['changed'], meta['deleted']
+    
+    def join_remote(self, name):
+        """Return the rclone path of a top-level folder of the configured remote"""
+        remote = self.config['rclone_remote']
+        if remote.endswith(':') or remote.endswith('/'):
+            return remote + name
+        return f"{remote}/{name}"
+    
+    def list_remote_folders(self):
+        """Return the names of the top-level folders of the remote"""
+        cmd = ['rclone', 'lsjson', '--dirs-only', '--max-depth', '1', self.config['rclone_remote']]
+        with self.metrics.phase('listing'):
+            result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"rclone lsjson failed: {result.stderr.strip()}")
+        return [item['Name'] for item in json.loads(result.stdout or '[]')]
+    
+    def get_previous_folder_sizes(self, backup_path):
+        """Return top-level folder sizes from the latest indexed snapshot"""
+        previous = self.get_latest_backup(exclude=backup_path)
+        if previous is None and os.path.isdir(backup_path):
+            previous = backup_path
+        if previous is None:
+            return {}
+        
+        index = self.open_index()
+        if not index:
+            return {}
+        try:
+            return index.folder_sizes(os.path.basename(previous))
+        finally:
+            index.close()
+    
+    def sync_folder(self, name, backup_path):
+        """Sync one top-level folder (or the root-level files when name is None), with retries"""
+        attempts = self.config.get('parallel_retries', 2) + 1
+        label = name if name is not None else '/'
+        result = {'name': label, 'success': False, 'stream': None, 'elapsed': 0.0}
+        
+        if self.resumed and label in self.journal.finished_folders():
+            self.logger.info(f"[{label}] Completed before the interruption, skipping")
+            result['success'] = True
+            return result
+        
+        if name is None:
+            source = self.config['rclone_remote']
+            destination = backup_path
+            exclude_file = self.build_exclude_file()
+            # Root-level files only; folders have their own workers
+            extra = ['--exclude', '/*/**']
+        else:
+            source = self.join_remote(name)
+            destination = os.path.join(backup_path, name)
+            exclude_file = self.build_exclude_file(subfolder=name)
+            extra = None
+        
+        start_time = time.time()
+        try:
+            cmd = self.build_rclone_command(source, destination, exclude_file, extra)
+            with self.get_transfer_scheduler().slot():
+                self.run_folder_attempts(cmd, label, attempts, result)
+            if result['success'] and not self.config['dry_run']:
+                self.journal.folder_done(label)
+        except Exception as e:
+            self.logger.error(f"[{label}] Error during rclone backup: {e}")
+        finally:
+            os.remove(exclude_file)
+        
+        result['elapsed'] = time.time() - start_time
+        return result
+    
+    def run_folder_attempts(self, cmd, label, attempts, result):
+        """Run one folder's rclone sync until it succeeds or the attempts are used up"""
+        for attempt in range(1, attempts + 1):
+            self.logger.info(f"[{label}] Running (attempt {attempt}/{attempts}): {' '.join(cmd)}")
+            returncode, stream = self.run_rclone(cmd, label)
+            result['stream'] = stream
+            if self.rclone_succeeded(returncode):
+                result['success'] = True
+                return
+            self.logger.warning(f"[{label}] rclone exited with return code {returncode}")
+            if self.retry_can_fix(stream):
+                # Re-syncing the whole folder for a few bad files is what the retry pass avoids
+                self.logger.info(f"[{label}] {len(stream.failed_paths)} paths failed, leaving them to the retry pass")
+                return
+    
+    def backup_with_rclone_parallel(self, backup_path):
+        """Perform backup with several rclone workers, one per top-level folder
+        
+        Folders are started largest first (by their size in the previous
+        snapshot) so the longest transfers don't end up running last.
+        """
+        workers = self.config['parallel_workers']
+        
+        try:
+            folders = self.list_remote_folders()
+        except Exception as e:
+            self.logger.error(f"Could not list remote folders: {e}")
+            return False
+        
+        sizes = self.get_previous_folder_sizes(backup_path)
+        # Folders without history may be large; schedule them with the biggest
+        folders.sort(key=lambda name: sizes.get(name, float('inf')), reverse=True)
+        
+        self.logger.info(f"Syncing {len(folders)} folders with {workers} parallel workers")
+        
+        results = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.sync_folder, name, backup_path) for name in folders]
+            futures.append(executor.submit(self.sync_folder, None, backup_path))
+            for future in as_completed(futures):
+                result = future.result()
+                status = "done" if result['success'] else "FAILED"
+                self.logger.info(f"[{result['name']}] {status} in {result['elapsed']:.2f} seconds")
+                results.append(result)
+        
+        stream = transfer_stream.RcloneStream(self.logger)
+        for r in results:
+            if r['stream']:
+                stream.merge(r['stream'], prefix=None if r['name'] == '/' else r['name'])
+        self.transfer_stream = stream
+        error_count = sum(stream.errors_by_class.values())
+        self.report_rclone_errors(stream)
+        
+        failed = [r['name'] for r in results if not r['success']]
+        if failed:
+            self.logger.error(f"Backup failed for {len(failed)} folders: {', '.join(sorted(failed))}")
+            return False
+        
+        # Like rclone sync, only delete folders removed on the remote once everything succeeded
+        if not self.config['dry_run'] and os.path.isdir(backup_path):
+            remote_folders = set(folders)
+            for item in os.listdir(backup_path):
+                path = os.path.join(backup_path, item)
+                if os.path.isdir(path) and not os.path.islink(path) and item not in remote_folders:
+                    self.logger.info(f"Removing folder deleted from remote: {item}")
+                    shutil.rmtree(path)
+        
+        if error_count > 0:
+            self.logger.warning(f"Backup completed with {error_count} errors (ignored)")
+        else:
+            self.logger.info("Backup completed successfully")
+        return True
+    
+    def get_retry_queue(self):
+        """Load the destination's retry queue, releasing quarantined paths whose time is up"""
+        if self.retry_queue is None:
+            backup_dest = os.path.expanduser(self.config['backup_destination'])
+            self.retry_queue = retry_queue.RetryQueue(backup_dest)
+            released = self.retry_queue.release_expired(self.config.get('quarantine_days', 30))
+            if released:
+                self.logger.info(f"Released {len(released)} paths from quarantine to try them again")
+        return self.retry_queue
+    
+    def retry_can_fix(self, stream):
+        """Check that every error of a failed sync names a path, so retrying those paths can repair it"""
+        return stream is not None and bool(stream.failed_paths) and not stream.unattributed_errors
+    
+    def retry_failed_paths(self, sync_path, success):
+        """Fetch the paths that failed, in this run or earlier ones, on their own; return the run's success
+        
+        A run whose sync failed only because of errors on single paths still
+        succeeds if the retries fetch all of them. Paths that keep failing
+        over quarantine_after_runs runs are quarantined and excluded.
+        """
+        stream = self.transfer_stream
+        queue = self.get_retry_queue()
+        if stream:
+            queue.add({path: (error_class, stream.failure_messages.get(path, ''))
+                       for path, error_class in stream.failed_paths.items()})
+        pending = queue.pending()
+        
+        remaining = set()
+        quarantined = []
+        if pending and (success or self.retry_can_fix(stream)):
+            remaining = self.run_retry_rounds(sync_path, pending, queue)
+            queue.resolve(set(pending) - remaining)
+            quarantined = queue.end_run(sorted(remaining), self.config.get('quarantine_after_runs', 3))
+            self.retry_report = {'retried': len(pending), 'retry_fetched': len(pending) - len(remaining),
+                                 'retry_failed': len(remaining), 'quarantined': len(quarantined)}
+            self.logger.info(f"Retry pass fetched {len(pending) - len(remaining)} of {len(pending)} failed paths")
+            for path in quarantined:
+                self.logger.warning(f"Quarantined after failing in {self.config.get('quarantine_after_runs', 3)} "
+                                    f"runs, excluded from now on: {path}")
+        elif pending:
+            # The sync failed for reasons retrying single paths can't fix; keep them for the next run
+            remaining = set(pending)
+        
+        try:
+            queue.save()
+        except OSError as e:
+            self.logger.warning(f"Could not save the retry queue: {e}")
+        
+        if not success and not remaining and self.retry_can_fix(stream):
+            self.logger.info("All failed paths were fetched by the retry pass")
+            return True
+        return success
+    
+    def run_retry_rounds(self, sync_path, paths, queue):
+        """Retry paths with exponential backoff until they all succeed; return the ones still failing"""
+        attempts = self.config.get('retry_attempts', 3)
+        delay = self.config.get('retry_backoff_seconds', 10)
+        remaining = set(paths)
+        for attempt in range(1, attempts + 1):
+            if attempt > 1:
+                self.logger.info(f"Waiting {delay} seconds before retrying {len(remaining)} paths")
+                time.sleep(delay)
+                delay *= 2
+            self.logger.info(f"Retrying {len(remaining)} failed paths (attempt {attempt}/{attempts})")
+            remaining = self.retry_paths(sync_path, sorted(remaining), queue)
+            if not remaining:
+                break
+        return remaining
+    
+    def retry_paths(self, sync_path, paths, queue):
+        """Fetch the given files with --files-from and folders one by one; return the paths that failed again"""
+        files = [path for path in paths if not queue.is_folder(path)]
+        folders = [path for path in paths if queue.is_folder(path)]
+        failed = set()
+        exclude_file = self.build_exclude_file()
+        try:
+            if files:
+                fd, files_from = tempfile.mkstemp(prefix='onedrive_backup_retry_', suffix='.txt')
+                with os.fdopen(fd, 'w') as f:
+                    for path in files:
+                        f.write(f"{path}\n")
+                try:
+                    cmd = self.build_rclone_command(self.config['rclone_remote'], sync_path, exclude_file,
+                                                    extra=['--files-from', files_from, '--no-traverse'],
+                                                    verb='copy')
+                    failed.update(self.retry_command(cmd, files, 'retry'))
+                finally:
+                    os.remove(files_from)
+            
+            for folder in folders:
+                cmd = self.build_rclone_command(self.join_remote(folder), os.path.join(sync_path, folder),
+                                                exclude_file, verb='copy')
+                failed.update(self.retry_command(cmd, [folder], f"retry {folder}"))
+        finally:
+            os.remove(exclude_file)
+        return failed
+    
+    def retry_command(self, cmd, paths, label):
+        """Run one retry command; return which of paths still failed"""
+        self.logger.info(f"Running: {' '.join(cmd)}")
+        try:
+            returncode, stream = self.run_rclone(cmd, label)
+        except Exception as e:
+            self.logger.error(f"Error during retry: {e}")
+            return set(paths)
+        
+        errors = sum(stream.errors_by_class.values())
+        if len(paths) == 1 and paths[0] not in stream.failed_paths:
+            # A folder's errors are reported relative to the folder
+            return set(paths) if errors or returncode != 0 else set()
+        if returncode != 0 and not self.retry_can_fix(stream):
+            return set(paths)
+        # A file deleted on the remote since the main pass has nothing left to fetch
+        return {path for path in paths if stream.failed_paths.get(path, 'not_found') != 'not_found'}
+    
+    def show_failed_paths(self):
+        """Print the paths waiting for a retry and the quarantined ones"""
+        queue = self.get_retry_queue()
+        print(f"{len(queue.queue)} paths waiting for a retry:")
+        for path, entry in sorted(queue.queue.items()):
+            print(f"  {path}  ({entry['class']}, failed in {entry['failed_runs']} runs): {entry['message']}")
+        print(f"{len(queue.quarantine)} quarantined paths, excluded from backups:")
+        for path, entry in sorted(queue.quarantine.items()):
+            since = datetime.fromtimestamp(entry['quarantined']).strftime('%Y-%m-%d')
+            print(f"  {path}  ({entry['class']}, since {since}): {entry['message']}")
+    
+    def release_quarantine(self, path=None):
+        """Take one path, or all of them, out of the quarantine so the next run fetches it again"""
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        journal = run_journal.RunJournal(backup_dest)
+        if not journal.acquire():
+            self.logger.error("A backup run is writing to this destination, try again later")
+            return False
+        try:
+            queue = retry_queue.RetryQueue(backup_dest)
+            released = queue.release(path)
+            queue.save()
+        finally:
+            journal.release()
+        if path and not released:
+            self.logger.error(f"{path} is not quarantined")
+            return False
+        self.logger.info(f"Released {len(released)} paths from quarantine")
+        return True
+    
     def cleanup_old_backups(self):
-        """Remove old backup versions"""
+        """Remove old backup versions
+        
+        With background_prune, expired snapshots are only renamed into the
+        trash area here; a separate low-priority process deletes them.
+        """
+        background = self.config.get('background_prune', True)
+        
         if self.config['keep_versions'] <= 1:
+            if self.get_storage_backend() == 'dedup' and not background:
+                self.collect_garbage()
             return
         
         backup_dest = os.path.expanduser(self.config['backup_destination'])
@@ -268,9 +1437,283 @@ class OneDriveBackup:
         
         backup_dirs.sort(reverse=True)
         
-        for old_backup in backup_dirs[self.config['keep_versions']:]:
-            self.logger.info(f"Removing old backup: {old_backup}")
-            shutil.rmtree(old_backup)
+        # Never prune the snapshot 'latest' points at, even if its name sorts oldest
+        latest = self.get_latest_backup()
+        
+        for old_backup in self.plan_pruning(backup_dest, backup_dirs):
+            if old_backup == latest:
+                continue
+            # Hardlinked files are only unlinked here; data shared with the
+            # remaining snapshots stays in place
+            if background:
+                trashed = trash.move_to_trash(backup_dest, old_backup)
+                self.logger.info(f"Moved old backup to trash: {old_backup} -> {trashed}")
+            else:
+                self.logger.info(f"Removing old backup: {old_backup}")
+                shutil.rmtree(old_backup)
+            self.forget_indexed_snapshot(old_backup)
+        
+        if self.get_storage_backend() == 'dedup' and not background:
+            self.collect_garbage()
+    
+    def plan_pruning(self, backup_dest, backup_dirs):
+        """Return the backup directories the retention settings say to remove"""
+        policy = self.config.get('retention')
+        if not policy:
+            return backup_dirs[self.config['keep_versions']:]
+        
+        names = [os.path.basename(path) for path in backup_dirs]
+        keep, delete = retention.plan_retention(names, policy)
+        
+        estimator = retention.SpaceEstimator(backup_dest, names, self.get_storage_backend())
+        try:
+            max_total_gb = policy.get('max_total_gb')
+            if max_total_gb:
+                extra = retention.apply_budget(keep, delete, estimator, max_total_gb * 1024 ** 3)
+                for name in extra:
+                    self.logger.info(f"Pruning {name} to stay within {max_total_gb} GB")
+                    keep.pop(name)
+                    delete.append(name)
+            
+            if delete:
+                total, each = estimator.freed_report(delete)
+                for name in sorted(delete):
+                    self.logger.info(f"Pruning {name}: {each[name] / (1024 ** 3):.2f} GB not shared "
+                                     "with any other backup")
+                self.logger.info(f"Pruning {len(delete)} backups frees {total / (1024 ** 3):.2f} GB")
+        finally:
+            estimator.close()
+        
+        return [os.path.join(backup_dest, name) for name in sorted(delete, reverse=True)]
+    
+    def show_prune_plan(self):
+        """Print which backups the retention settings keep or remove, without deleting anything"""
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        names = sorted((item for item in os.listdir(backup_dest)
+                        if item.startswith('backup_') and os.path.isdir(os.path.join(backup_dest, item))),
+                       reverse=True)
+        policy = self.config.get('retention') or {'keep_last': self.config['keep_versions']}
+        keep, delete = retention.plan_retention(names, policy)
+        
+        estimator = retention.SpaceEstimator(backup_dest, names, self.get_storage_backend())
+        try:
+            max_total_gb = policy.get('max_total_gb')
+            if max_total_gb:
+                for name in retention.apply_budget(keep, delete, estimator, max_total_gb * 1024 ** 3):
+                    keep.pop(name)
+                    delete.append(name)
+            total, each = estimator.freed_report(delete)
+            used = estimator.used_bytes()
+        finally:
+            estimator.close()
+        
+        for name in names:
+            if name in keep:
+                print(f"  keep    {name}  ({', '.join(keep[name])})")
+            else:
+                print(f"  delete  {name}  (frees {each[name] / (1024 ** 3):.2f} GB alone)")
+        print(f"Backups use {used / (1024 ** 3):.2f} GB; pruning would free {total / (1024 ** 3):.2f} GB")
+    
+    def start_background_purge(self):
+        """Launch a detached, low-priority process that empties the trash"""
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        if not trash.pending_items(backup_dest) and self.get_storage_backend() != 'dedup':
+            return
+        
+        cmd = []
+        if shutil.which('ionice'):
+            cmd.extend(['ionice', '-c3'])
+        if shutil.which('nice'):
+            cmd.extend(['nice', '-n', '19'])
+        cmd.extend([sys.executable, os.path.abspath(__file__)])
+        if self.account:
+            cmd.extend(['--accounts', os.path.abspath(self.config_file), '--account', self.account])
+        else:
+            cmd.extend(['--config', os.path.abspath(self.config_file)])
+        cmd.append('--purge-trash')
+        
+        try:
+            subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL, start_new_session=True)
+            self.logger.info("Started background deletion of pruned backups")
+        except Exception as e:
+            self.logger.warning(f"Could not start background deletion: {e}")
+    
+    def purge_trash(self):
+        """Delete everything in the trash area; safe to rerun after an interruption"""
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        lock = trash.PurgeLock(backup_dest)
+        if not lock.acquire():
+            self.logger.info("Another process is already emptying the trash")
+            return
+        
+        try:
+            limiter = trash.RateLimiter(self.config.get('purge_files_per_second', 0))
+            workers = self.config.get('purge_workers', 4)
+            for item in trash.pending_items(backup_dest):
+                start_time = time.time()
+                removed = trash.purge_item(item, workers, limiter)
+                self.logger.info(f"Deleted {os.path.basename(item)} from trash ({removed} files) "
+                                 f"in {time.time() - start_time:.2f} seconds")
+            
+            if self.get_storage_backend() == 'dedup':
+                self.collect_garbage()
+        finally:
+            lock.release()
+    
+    def prune_change_cursors(self):
+        """Drop change cursors of snapshots that no longer exist"""
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        existing = set(os.listdir(backup_dest))
+        try:
+            self.get_cursor_store().prune(existing)
+        except OSError as e:
+            self.logger.warning(f"Could not prune change cursors: {e}")
+    
+    def collect_garbage(self):
+        """Delete stored chunks that no remaining snapshot references"""
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        store = self.get_object_store()
+        with store.locked():
+            # Listed under the lock, so no snapshot is being ingested or renamed meanwhile
+            snapshots = [os.path.join(backup_dest, item) for item in os.listdir(backup_dest)
+                         if item.startswith('backup_') or item == 'current' or run_journal.is_working_dir(item)]
+            try:
+                removed, freed_bytes = store.garbage_collect(snapshots)
+            except RuntimeError as e:
+                self.logger.warning(f"Skipping garbage collection: {e}")
+                return
+        if removed:
+            self.logger.info(f"Removed {removed} unreferenced chunks, "
+                             f"freed {freed_bytes / (1024 ** 3):.2f} GB")
+    
+    def open_index(self, create=False):
+        """Open the snapshot index of the backup destination"""
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        if create:
+            return snapshot_index.SnapshotIndex(backup_dest)
+        return snapshot_index.SnapshotIndex.open_existing(backup_dest)
+    
+    def index_snapshot(self, backup_path):
+        """Record the files of a finished snapshot in the index"""
+        if not self.config.get('index_snapshots', True):
+            return
+        
+        start_time = time.time()
+        try:
+            index = self.open_index(create=True)
+            try:
+                if dedup_store.is_manifest_snapshot(backup_path):
+                    stats = index.index_manifest(backup_path)
+                else:
+                    previous = self.get_latest_backup(exclude=backup_path)
+                    stats = index.index_tree(
+                        backup_path,
+                        previous=os.path.basename(previous) if previous else None,
+                        hash_files=self.config.get('index_hashes', True),
+                        logger=self.logger)
+            finally:
+                index.close()
+        except Exception as e:
+            self.logger.warning(f"Could not index snapshot: {e}")
+            return
+        
+        self.logger.info(f"Indexed {stats['files']} files ({stats['hashed_files']} hashed) "
+                         f"in {time.time() - start_time:.2f} seconds")
+    
+    def forget_indexed_snapshot(self, backup_path):
+        """Remove a pruned snapshot from the index"""
+        try:
+            index = self.open_index()
+            if index:
+                index.forget_snapshot(os.path.basename(backup_path))
+                index.close()
+        except Exception as e:
+            self.logger.warning(f"Could not update snapshot index: {e}")
+    
+    def get_verifier(self):
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        rate = self.config.get('scrub_mb_per_second', 0) * 1024 * 1024
+        return integrity.Verifier(backup_dest, self.config.get('verify_workers', 0), self.logger, rate)
+    
+    def source_listing(self):
+        """List local_source like the remote listing, without hashes"""
+        source = os.path.expanduser(self.config['local_source'])
+        # Only name patterns are applied here; anchored rsync patterns are not interpreted
+        patterns = [p for p in self.config['exclude_patterns'] if '/' not in p]
+        return {rel_path: [st.st_size, st.st_mtime, None]
+                for rel_path, st in snapshot_index.scan_tree(source)
+                if not any(fnmatch.fnmatch(os.path.basename(rel_path), p) for p in patterns)}
+    
+    def verify_backup(self, name=None):
+        """Check a snapshot (default: the latest) against the hashes of the source files"""
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        backup_path = os.path.join(backup_dest, name) if name else self.get_latest_backup()
+        if not backup_path or not os.path.isdir(backup_path):
+            self.logger.error(f"Backup not found: {name or 'latest'}")
+            return False
+        
+        start_time = time.time()
+        verifier = self.get_verifier()
+        if self.config['source_type'] == 'rclone':
+            algorithm = self.config.get('verify_hash_type', 'quickxor')
+            self.logger.info(f"Verifying {os.path.basename(backup_path)} against {algorithm} hashes "
+                             f"of {self.config['rclone_remote']}")
+            exclude_file = self.build_exclude_file()
+            try:
+                lister = change_tracker.RcloneLister(
+                    self.config['rclone_remote'], self.config.get('listing_options', ['--fast-list']),
+                    exclude_file, hash_type=algorithm)
+                listing = lister.list()
+            except Exception as e:
+                self.logger.error(f"Could not list remote hashes: {e}")
+                return False
+            finally:
+                os.remove(exclude_file)
+            verifier.verify_snapshot(backup_path, listing, algorithm)
+        else:
+            source = os.path.expanduser(self.config['local_source'])
+            self.logger.info(f"Verifying {os.path.basename(backup_path)} against {source}")
+            verifier.verify_snapshot(backup_path, self.source_listing(), 'sha256', source)
+        
+        verifier.write_history('verify', os.path.basename(backup_path))
+        return self.report_integrity(verifier, start_time)
+    
+    def scrub(self):
+        """Re-read the part of the archive checked longest ago to detect silent corruption"""
+        start_time = time.time()
+        budget = self.config.get('scrub_gb_per_run', 50) * 1024 ** 3
+        self.logger.info(f"Scrubbing up to {budget / (1024 ** 3):.2f} GB")
+        verifier = self.get_verifier()
+        verifier.scrub(budget)
+        verifier.write_history('scrub')
+        return self.report_integrity(verifier, start_time)
+    
+    def report_integrity(self, verifier, start_time):
+        """Log the outcome of a verify or scrub; return True if no problems were found"""
+        report = verifier.report
+        elapsed = max(time.time() - start_time, 1e-6)
+        self.logger.info(f"Checked {report['verified'] + report['chunks_verified']} files or chunks "
+                         f"({report['from_cache']} from checksum cache), read "
+                         f"{report['bytes_hashed'] / (1024 ** 3):.2f} GB in {elapsed:.2f} seconds "
+                         f"({report['bytes_hashed'] / elapsed / (1024 ** 2):.1f} MB/s)")
+        for key in ('changed_since_backup', 'no_source_hash', 'baseline'):
+            if report[key]:
+                self.logger.info(f"{key.replace('_', ' ').capitalize()}: {report[key]} files")
+        
+        if not verifier.problems:
+            self.logger.info("No integrity problems found")
+            return True
+        
+        problems = Counter(kind for kind, path, detail in verifier.problems)
+        self.logger.error("Integrity problems: " + ", ".join(f"{count} {kind.replace('_', ' ')}"
+                                                             for kind, count in problems.items()))
+        for kind, path, detail in verifier.problems[:20]:
+            self.logger.error(f"  {kind}: {path} {detail}")
+        if len(verifier.problems) > 20:
+            self.logger.error(f"  ... and {len(verifier.problems) - 20} more "
+                              f"(see {integrity.HISTORY_FILE} in the backup destination)")
+        return False
     
     def create_symlink_to_latest(self, backup_path):
         """Create a symlink to the latest backup"""
@@ -280,34 +1723,164 @@ class OneDriveBackup:
         backup_dest = os.path.expanduser(self.config['backup_destination'])
         latest_link = os.path.join(backup_dest, 'latest')
         
-        if os.path.exists(latest_link):
-            os.remove(latest_link)
-        
-        os.symlink(os.path.basename(backup_path), latest_link)
+        # Replace the link in one rename, so 'latest' never points nowhere
+        tmp_link = latest_link + '.tmp'
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.basename(backup_path), tmp_link)
+        os.replace(tmp_link, latest_link)
         self.logger.info(f"Created symlink 'latest' -> {os.path.basename(backup_path)}")
     
     def get_backup_stats(self, backup_path):
         """Get statistics about the backup"""
+        stats = None
+        index = self.open_index()
+        if index:
+            stats = index.snapshot_stats(os.path.basename(backup_path))
+            index.close()
+        if stats:
+            size_gb = stats['bytes'] / (1024 ** 3)
+            self.logger.info(f"Backup statistics: {stats['files']} files, {size_gb:.2f} GB")
+            if stats['unique_bytes'] < stats['bytes'] and not dedup_store.is_manifest_snapshot(backup_path):
+                self.logger.info(f"New data in this snapshot: {stats['unique_bytes'] / (1024 ** 3):.2f} GB")
+            return stats['files'], size_gb
+        
+        if dedup_store.is_manifest_snapshot(backup_path):
+            return self.get_manifest_stats(backup_path)
+        
         total_size = 0
+        unique_size = 0
         file_count = 0
+        seen_inodes = set()
         
         for root, dirs, files in os.walk(backup_path):
             for file in files:
                 file_path = os.path.join(root, file)
                 try:
-                    total_size += os.path.getsize(file_path)
-                    file_count += 1
+                    st = os.lstat(file_path)
                 except:
-                    pass
+                    continue
+                file_count += 1
+                total_size += st.st_size
+                # Files with a single link exist only in this snapshot; the
+                # rest are shared with other snapshots via hardlinks
+                if st.st_nlink == 1:
+                    unique_size += st.st_size
+                elif (st.st_dev, st.st_ino) not in seen_inodes:
+                    seen_inodes.add((st.st_dev, st.st_ino))
+        
+        size_gb = total_size / (1024 ** 3)
+        self.logger.info(f"Backup statistics: {file_count} files, {size_gb:.2f} GB")
+        if seen_inodes:
+            self.logger.info(f"New data in this snapshot: {unique_size / (1024 ** 3):.2f} GB "
+                             f"({len(seen_inodes)} files shared with other snapshots)")
+        
+        return file_count, size_gb
+    
+    def get_manifest_stats(self, backup_path):
+        """Get statistics about a deduplicated snapshot from its manifest"""
+        total_size = 0
+        file_count = 0
+        for entry in dedup_store.iter_manifest(backup_path):
+            total_size += entry['size']
+            file_count += 1
         
         size_gb = total_size / (1024 ** 3)
         self.logger.info(f"Backup statistics: {file_count} files, {size_gb:.2f} GB")
         
         return file_count, size_gb
     
+    def write_run_record(self, backup_path, success, start_time, elapsed_time, snapshot_stats=None):
+        """Append a compact metrics record for this run to run_history.jsonl and export it"""
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        record = {
+            'started': datetime.fromtimestamp(start_time).isoformat(timespec='seconds'),
+            'timestamp': int(start_time),
+            'snapshot': os.path.basename(backup_path),
+            'source_type': self.config['source_type'],
+            'success': success,
+            'elapsed': round(elapsed_time, 2),
+            'phases': self.metrics.as_record(),
+        }
+        if self.transfer_stream:
+            record.update(self.transfer_stream.as_record())
+            transfer_time = self.metrics.phases.get('transfer', 0)
+            if transfer_time:
+                record['checks_per_second'] = round(self.transfer_stream.stats['checks'] / transfer_time, 1)
+        scheduler = self.scheduler
+        record['peak_concurrency'] = max(scheduler.peak_active if scheduler else 0,
+                                         1 if self.transfer_stream else 0)
+        record['throttle_backoffs'] = scheduler.throttle_backoffs if scheduler else 0
+        if self.retry_report:
+            record.update(self.retry_report)
+        if snapshot_stats:
+            record['snapshot_files'] = snapshot_stats[0]
+            record['snapshot_bytes'] = int(snapshot_stats[1] * 1024 ** 3)
+        self.last_record = record
+        
+        try:
+            with open(os.path.join(backup_dest, 'run_history.jsonl'), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        except OSError as e:
+            self.logger.warning(f"Could not write run history: {e}")
+        
+        textfile = self.config.get('metrics_textfile') or os.path.join(backup_dest, run_metrics.TEXTFILE)
+        try:
+            run_metrics.write_textfile(os.path.expanduser(textfile), run_metrics.render(record))
+        except OSError as e:
+            self.logger.warning(f"Could not write metrics file {textfile}: {e}")
+        
+        phases = ', '.join(f"{name} {seconds:.1f}s" for name, seconds in
+                           sorted(self.metrics.phases.items(), key=lambda item: -item[1]))
+        self.logger.info(f"Time per phase: {phases}")
+    
+    def read_last_run_record(self):
+        """Return the newest run_history.jsonl record, or None"""
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        record = None
+        try:
+            with open(os.path.join(backup_dest, 'run_history.jsonl'), 'r') as f:
+                for line in f:
+                    if line.strip():
+                        record = line
+        except OSError:
+            return None
+        try:
+            return json.loads(record) if record else None
+        except ValueError:
+            return None
+    
+    def reset_run_state(self):
+        """Forget what the previous run in this process left behind"""
+        self.transfer_stream = None
+        self.seeded_from = None
+        self.sync_base = None
+        self.pending_listing = None
+        self.pending_cursor_meta = None
+        self.scheduler = None
+        self.resumed = False
+        self.retry_queue = None
+        self.retry_report = None
+        self.metrics = run_metrics.RunMetrics()
+    
+    def run_archive(self):
+        """Run the archive tier on its own, under the destination's run lock"""
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        journal = run_journal.RunJournal(backup_dest)
+        if not journal.acquire():
+            self.logger.error("A backup run is writing to this destination, try again later")
+            return False
+        try:
+            self.archive_old_snapshots()
+            self.start_background_purge()
+        finally:
+            journal.release()
+        return True
+    
     def run(self, dry_run=False):
         """Run the backup process"""
         start_time = time.time()
+        self.reset_run_state()
         
         if dry_run:
             self.config['dry_run'] = True
@@ -315,28 +1888,73 @@ class OneDriveBackup:
         
         self.logger.info("Starting OneDrive backup")
         
-        if not self.check_dependencies():
+        if not self.check_environment():
             return False
         
-        if self.config['source_type'] == 'rclone':
-            if not self.setup_rclone():
-                return False
+        backup_dest = os.path.expanduser(self.config['backup_destination'])
+        self.journal = run_journal.RunJournal(backup_dest)
+        if not self.journal.acquire():
+            self.logger.error("Another backup run is already writing to this destination")
+            return False
         
+        try:
+            return self.run_locked(start_time)
+        finally:
+            self.journal.release()
+    
+    def run_locked(self, start_time):
+        """The backup run itself, while holding the destination's run lock"""
         backup_path = self.create_backup_directory()
+        sync_path = self.get_sync_target(backup_path)
+        self.sync_base = self.get_sync_base(backup_path)
+        self.journal.set(phase='syncing')
         
-        if self.config['source_type'] == 'rclone':
-            success = self.backup_with_rclone(backup_path)
-        else:
-            success = self.backup_with_rsync(backup_path)
+        with self.metrics.phase('transfer'):
+            if self.config['source_type'] == 'rclone':
+                success = self.backup_with_rclone(sync_path)
+            else:
+                success = self.backup_with_rsync(sync_path)
+        
+        if self.config['source_type'] == 'rclone' and not self.config['dry_run']:
+            self.journal.set(phase='retrying')
+            with self.metrics.phase('retry'):
+                success = self.retry_failed_paths(sync_path, success)
         
+        if success and not self.config['dry_run'] and sync_path != backup_path:
+            self.journal.set(phase='ingesting')
+            # Garbage collection must not list the snapshot between ingest and its rename
+            with self.get_object_store().locked():
+                with self.metrics.phase('ingest'):
+                    success = self.ingest_snapshot(backup_path)
+                if success:
+                    backup_path = self.complete_snapshot(backup_path)
+        
+        snapshot_stats = None
         if success and not self.config['dry_run']:
-            self.cleanup_old_backups()
-            self.create_symlink_to_latest(backup_path)
-            self.get_backup_stats(backup_path)
+            # Only a complete snapshot gets a backup_* name, the index, 'latest' and a say in pruning
+            backup_path = self.complete_snapshot(backup_path)
+            self.save_change_cursor(backup_path)
+            self.finish_snapshot(backup_path)
+            self.journal.clear()
+            with self.metrics.phase('stats'):
+                snapshot_stats = self.get_backup_stats(backup_path)
+        elif not self.config['dry_run'] and self.config.get('resume_interrupted', True):
+            self.logger.info("The next run will resume this backup")
+        
+        if self.config['dry_run']:
+            try:
+                os.rmdir(backup_path)
+            except OSError:
+                pass
         
         elapsed_time = time.time() - start_time
         self.logger.info(f"Backup {'completed' if success else 'failed'} in {elapsed_time:.2f} seconds")
         
+        if not self.config['dry_run']:
+            self.write_run_record(backup_path, success, start_time, elapsed_time, snapshot_stats)
+            if self.config.get('background_prune', True):
+                self.start_background_purge()
+        
         return success
 
 def main():
@@ -347,15 +1965,76 @@ def main():
                        help='Perform a dry run without making changes')
     parser.add_argument('--setup', action='store_true',
                        help='Create default configuration and exit')
+    parser.add_argument('--prune-plan', action='store_true',
+                       help='Show which backups the retention policy would remove and exit')
+    parser.add_argument('--purge-trash', action='store_true',
+                       help='Delete pruned backups waiting in the trash and exit')
+    parser.add_argument('--verify', nargs='?', const='', metavar='BACKUP',
+                       help='Check a backup (default: latest) against the source file hashes and exit')
+    parser.add_argument('--scrub', action='store_true',
+                       help='Re-read the least recently checked part of the archive to find corruption and exit')
+    parser.add_argument('--archive', action='store_true',
+                       help='Pack backups older than archive_after_days into compressed archives and exit')
+    parser.add_argument('--daemon', action='store_true',
+                       help='Stay resident and back up on an interval or when files change')
+    parser.add_argument('--plan', action='store_true',
+                       help='Estimate the files, bytes, space and time the next run needs, save the plan and exit')
+    parser.add_argument('--failed', action='store_true',
+                       help='List the paths waiting for a retry and the quarantined ones and exit')
+    parser.add_argument('--release-quarantine', nargs='?', const='', metavar='PATH',
+                       help='Let the next run try a quarantined path (default: all of them) again and exit')
+    parser.add_argument('--accounts', metavar='FILE',
+                       help='Back up every account listed in FILE, sharing one concurrency and bandwidth budget')
+    parser.add_argument('--account', metavar='NAME',
+                       help='With --accounts, apply the other options to this account only')
     
     args = parser.parse_args()
     
-    backup = OneDriveBackup(args.config)
+    if args.accounts:
+        accounts = orchestrator.AccountOrchestrator(args.accounts, OneDriveBackup, dry_run=args.dry_run)
+        if not args.account:
+            sys.exit(0 if accounts.run() else 1)
+        backup = accounts.account_backup(args.account)
+        if backup is None:
+            sys.exit(1)
+    else:
+        backup = OneDriveBackup(args.config)
     
     if args.setup:
         print("Configuration file created. Please edit it before running backup.")
         return
     
+    if args.purge_trash:
+        backup.purge_trash()
+        return
+    
+    if args.prune_plan:
+        backup.show_prune_plan()
+        return
+    
+    if args.plan:
+        sys.exit(0 if backup.plan() else 1)
+    
+    if args.failed:
+        backup.show_failed_paths()
+        return
+    
+    if args.release_quarantine is not None:
+        sys.exit(0 if backup.release_quarantine(args.release_quarantine or None) else 1)
+    
+    if args.verify is not None:
+        sys.exit(0 if backup.verify_backup(args.verify or None) else 1)
+    
+    if args.scrub:
+        sys.exit(0 if backup.scrub() else 1)
+    
+    if args.archive:
+        sys.exit(0 if backup.run_archive() else 1)
+    
+    if args.daemon:
+        success = daemon.BackupDaemon(backup, dry_run=args.dry_run).run()
+        sys.exit(0 if success else 1)
+    
     success = backup.run(dry_run=args.dry_run)
     sys.exit(0 if success else 1)
 
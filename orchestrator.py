@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import run_metrics
+import transfer_scheduler
+
+# Keys of an accounts entry that are not backup settings
+ACCOUNT_KEYS = ('name', 'config', 'priority')
+HISTORY_FILE = 'accounts_history.jsonl'
+TEXTFILE = 'accounts.prom'
+
+class AccountOrchestrator:
+    """Backs up several OneDrive accounts or remotes in one process
+
+    Accounts start in priority order and, within a priority, longest
+    expected run first (the last run's duration from its run history), so a
+    big account is not left running alone at the end. All rclone processes
+    draw from one GlobalBudget: at most max_rclone_processes at once,
+    sharing total_bwlimit. Each account keeps its own destination, log,
+    run history and journal, and a failing account does not stop the others.
+    """
+
+    def __init__(self, accounts_file, backup_class, dry_run=False):
+        self.accounts_file = accounts_file
+        self.base_dir = os.path.dirname(os.path.abspath(accounts_file))
+        self.backup_class = backup_class
+        self.dry_run = dry_run
+        with open(accounts_file, 'r') as f:
+            self.settings = json.load(f)
+        self.setup_logging()
+        self.budget = transfer_scheduler.GlobalBudget(
+            self.settings.get('max_rclone_processes', 4), self.settings.get('total_bwlimit') or None, self.logger)
+        self.results = {}
+
+    def path(self, value):
+        """Resolve a path from the accounts file relative to that file"""
+        return os.path.join(self.base_dir, os.path.expanduser(value))
+
+    def setup_logging(self):
+        log_file = self.path(self.settings.get('log_file', 'accounts.log'))
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+
+        # Account loggers propagate here, so this log and the console show every account
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+            handlers=[
+                logging.FileHandler(log_file),
+                logging.StreamHandler()
+            ]
+        )
+        self.logger = logging.getLogger('accounts')
+
+    def account_config(self, account):
+        """Merge the built-in defaults, the shared defaults, the account's config file and its own settings"""
+        own = {}
+        if account.get('config'):
+            with open(self.path(account['config']), 'r') as f:
+                own.update(json.load(f))
+        own.update({key: value for key, value in account.items() if key not in ACCOUNT_KEYS})
+
+        config = self.backup_class.default_config()
+        config.update(self.settings.get('defaults', {}))
+        config.update(own)
+        if 'log_file' not in own:
+            config['log_file'] = os.path.join(config['backup_destination'], 'backup.log')
+        return config
+
+    def build_backups(self):
+        """Create one backup object per account; None if the accounts file is inconsistent"""
+        backups = []
+        names = set()
+        destinations = {}
+        for account in self.settings.get('accounts', []):
+            name = account.get('name')
+            if not name or name in names:
+                self.logger.error(f"Every account needs a unique name, found {name!r}")
+                return None
+            names.add(name)
+
+            try:
+                config = self.account_config(account)
+            except (OSError, ValueError) as e:
+                self.logger.error(f"Could not read the configuration of account {name}: {e}")
+                return None
+            destination = os.path.realpath(os.path.expanduser(config['backup_destination']))
+            if destination in destinations:
+                self.logger.error(f"Accounts {destinations[destination]} and {name} "
+                                  f"share the backup destination {destination}")
+                return None
+            destinations[destination] = name
+
+            backup = self.backup_class(self.accounts_file, config=config, account=name)
+            backup.budget = self.budget
+            backup.priority = account.get('priority', 0)
+            backups.append(backup)
+        return backups
+
+    def account_backup(self, name):
+        """Return the backup object of one account, for commands that act on a single account"""
+        for backup in self.build_backups() or []:
+            if backup.account == name:
+                return backup
+        self.logger.error(f"No account named {name} in {self.accounts_file}")
+        return None
+
+    def expected_duration(self, backup):
+        record = backup.read_last_run_record()
+        # An account without history may be the biggest, so it starts early
+        return record.get('elapsed', 0) if record else float('inf')
+
+    def run_account(self, backup):
+        started = time.time()
+        try:
+            success = backup.run(dry_run=self.dry_run)
+        except Exception as e:
+            backup.logger.exception(f"Backup of account {backup.account} failed: {e}")
+            success = False
+        record = dict(backup.last_record or {'timestamp': int(started)})
+        record['success'] = bool(success)
+        record.setdefault('elapsed', round(time.time() - started, 2))
+        return record
+
+    def run(self):
+        """Back up every account; return True if all of them succeeded"""
+        start_time = time.time()
+        backups = self.build_backups()
+        if not backups:
+            self.logger.error(f"No accounts to back up in {self.accounts_file}")
+            return False
+
+        order = sorted(backups, key=lambda backup: (-backup.priority, -self.expected_duration(backup)))
+        workers = self.settings.get('max_concurrent_accounts', 0) or len(order)
+        self.logger.info(f"Backing up {len(order)} accounts, {workers} at a time, "
+                         f"in this order: {', '.join(backup.account for backup in order)}")
+
+        # Tasks start in submission order, so the pool follows the schedule
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for backup, record in zip(order, executor.map(self.run_account, order)):
+                self.results[backup.account] = record
+
+        elapsed = time.time() - start_time
+        self.report(elapsed)
+        if not self.dry_run:
+            self.write_history(start_time, elapsed)
+        return all(record['success'] for record in self.results.values())
+
+    def report(self, elapsed):
+        """Log one summary line per account"""
+        self.logger.info(f"{'Account':<20} {'Result':<7} {'Time':>9} {'Files':>8} {'GB':>9} {'Errors':>7}")
+        for name, record in self.results.items():
+            self.logger.info(f"{name:<20} {'ok' if record['success'] else 'FAILED':<7} "
+                             f"{record.get('elapsed', 0):>8.0f}s {record.get('files', 0):>8} "
+                             f"{record.get('bytes', 0) / 1024 ** 3:>9.2f} {record.get('errors', 0):>7}")
+        failed = [name for name, record in self.results.items() if not record['success']]
+        self.logger.info(f"All accounts finished in {elapsed:.2f} seconds, "
+                         f"at most {self.budget.peak_active} rclone processes at once"
+                         + (f"; failed: {', '.join(failed)}" if failed else ""))
+
+    def write_history(self, start_time, elapsed):
+        """Append this run to the accounts history and export every account's metrics"""
+        record = {
+            'started': datetime.fromtimestamp(start_time).isoformat(timespec='seconds'),
+            'elapsed': round(elapsed, 2),
+            'peak_rclone_processes': self.budget.peak_active,
+            'accounts': {name: {key: record.get(key, 0) for key in ('success', 'elapsed', 'files', 'bytes', 'errors')}
+                         for name, record in self.results.items()},
+        }
+        try:
+            with open(self.path(self.settings.get('history_file', HISTORY_FILE)), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        except OSError as e:
+            self.logger.warning(f"Could not write accounts history: {e}")
+
+        extra = {
+            'accounts_duration_seconds': ('gauge', 'Duration of the last run over all accounts', round(elapsed, 2)),
+            'accounts_failed': ('gauge', 'Accounts whose last backup failed',
+                                sum(not record['success'] for record in self.results.values())),
+            'accounts_peak_rclone_processes': ('gauge', 'Most rclone processes running at once over all accounts',
+                                               self.budget.peak_active),
+        }
+        text = run_metrics.render_many([({'account': name}, record) for name, record in self.results.items()], extra)
+        textfile = self.path(self.settings.get('metrics_textfile', TEXTFILE))
+        try:
+            run_metrics.write_textfile(textfile, text)
+        except OSError as e:
+            self.logger.warning(f"Could not write metrics file {textfile}: {e}")
@@ -8,6 +8,13 @@ import json
 from datetime import datetime
 from pathlib import Path
 
+import dedup_store
+import archive_tier
+import snapshot_index
+import restore_engine
+import snapshot_diff
+import snapshot_export
+
 def load_config(config_file='config.json'):
     """Load configuration from JSON file"""
     if os.path.exists(config_file):
@@ -38,42 +45,302 @@ def list_backups(backup_dir):
     
     return sorted(backups, reverse=True)
 
-def restore_files(source_path, destination, files=None, dry_run=False):
+def restore_files(source_path, destination, files=None, dry_run=False, workers=8):
     """Restore files from backup to destination"""
+    if files or dedup_store.is_manifest_snapshot(source_path) or archive_tier.is_archive_snapshot(source_path):
+        engine = restore_engine.RestoreEngine(source_path, destination, workers, dry_run)
+        if files:
+            paths, missing = engine.expand(files)
+            for request in missing:
+                print(f"Not found in backup: {request}")
+        else:
+            print(f"Restoring entire backup to {destination}")
+            paths = engine.all_paths()
+        print(f"Restoring {len(paths)} files with {engine.workers} workers")
+        stats = engine.restore(paths)
+        return not stats['errors']
     
+    # A whole plain-file backup is one rsync run, which skips files that are already in place
     cmd = ['rsync', '-avh', '--progress']
     
     if dry_run:
         cmd.append('--dry-run')
     
+    cmd.extend([f"{source_path}/", destination])
+    print(f"Restoring entire backup to {destination}")
+    return subprocess.run(cmd).returncode == 0
+
+def read_files_from(list_file):
+    """Read restore requests from a file, one path, folder or pattern per line"""
+    with open(list_file, 'r') as f:
+        return [line.rstrip('\n') for line in f if line.strip() and not line.startswith('#')]
+
+def parse_time(text):
+    """Parse an --as-of time such as '2025-01-21', '2025-01-21 14:00' or a backup name"""
+    created = snapshot_index.snapshot_created(os.path.basename(text.rstrip('/')))
+    if created is not None:
+        return created
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        print(f"Cannot parse time: {text} (use YYYY-MM-DD or 'YYYY-MM-DD HH:MM')")
+        sys.exit(1)
+
+def resolve_as_of(backups, when):
+    """Map every path to the newest backup at or before `when` that holds it"""
+    candidates = [os.path.realpath(path) for name, path in backups
+                  if (snapshot_index.snapshot_created(os.path.basename(path)) or float('inf')) <= when]
+    if not candidates:
+        return {}
+    
+    backup_dest = os.path.dirname(candidates[0])
+    index = snapshot_index.SnapshotIndex.open_existing(backup_dest)
+    if index and all(index.has_snapshot(os.path.basename(path)) for path in candidates):
+        rows = index.latest_versions(when)
+        index.close()
+        return {path: os.path.join(backup_dest, snapshot) for path, snapshot, created in rows}
+    if index:
+        index.close()
+    
+    # Not every backup is indexed: merge their trees, newest first
+    resolved = {}
+    for backup_path in sorted(candidates, reverse=True):
+        if dedup_store.is_manifest_snapshot(backup_path):
+            rel_paths = (entry['path'] for entry in dedup_store.iter_manifest(backup_path))
+        elif archive_tier.is_archive_snapshot(backup_path):
+            rel_paths = (entry['path'] for entry in archive_tier.iter_index(backup_path))
+        else:
+            rel_paths = (rel_path for rel_path, st in snapshot_index.scan_tree(backup_path))
+        for rel_path in rel_paths:
+            resolved.setdefault(rel_path, backup_path)
+    return resolved
+
+def select_as_of(backups, when, files=None):
+    """Map every (requested) path to the newest backup at or before `when` that holds it"""
+    sources = resolve_as_of(backups, when)
     if files:
-        for file in files:
-            file_source = os.path.join(source_path, file)
-            if os.path.exists(file_source):
-                file_dest = os.path.join(destination, file)
-                os.makedirs(os.path.dirname(file_dest), exist_ok=True)
-                
-                file_cmd = cmd + [file_source, file_dest]
-                print(f"Restoring: {file}")
-                subprocess.run(file_cmd)
+        sources = {path: source for path, source in sources.items()
+                   if any(restore_engine.path_matches(path, request) for request in files)}
+    return sources
+
+def restore_as_of(backups, when, destination, files=None, dry_run=False, workers=8):
+    """Restore the newest version at or before `when` of every (requested) file, in one pass"""
+    sources = select_as_of(backups, when, files)
+    if not sources:
+        print("No backed up files at or before that time")
+        return False
+    
+    used = sorted(set(sources.values()))
+    print(f"Restoring {len(sources)} files as of {datetime.fromtimestamp(when):%Y-%m-%d %H:%M:%S}, "
+          f"taken from {len(used)} backups")
+    engine = restore_engine.RestoreEngine(used[-1], destination, workers, dry_run)
+    stats = engine.restore(sorted(sources), sources)
+    return not stats['errors']
+
+def export_backup(backup_path, output, files=None, compress=False, level=3, workers=8, dry_run=False,
+                  sources=None):
+    """Stream a backup, or the requested files of it, to output (a path or binary file) as tar or tar.zst
+    
+    sources maps paths to the backups they come from, for --as-of.
+    """
+    if sources:
+        backup_path = sorted(set(sources.values()))[-1]
+    engine = restore_engine.RestoreEngine(backup_path, None, workers, dry_run)
+    if sources:
+        paths = sorted(sources)
+    elif files:
+        paths, missing = engine.expand(files)
+        for request in missing:
+            print(f"Not found in backup: {request}")
+    else:
+        paths = engine.all_paths()
+    
+    if not paths:
+        print("No files to export")
+        return False
+    if dry_run:
+        for path in paths:
+            print(f"  {path}")
+        print(f"Would export {len(paths)} files")
+        return True
+    
+    print(f"Exporting {len(paths)} files as {'tar.zst' if compress else 'tar'} "
+          f"to {output if isinstance(output, str) else 'standard output'}")
+    out = open(output, 'wb') if isinstance(output, str) else output
+    exporter = snapshot_export.SnapshotExporter(engine, out, compress, level, workers)
+    try:
+        stats = exporter.export(paths, sources)
+    except OSError as e:
+        print(f"Export failed: {e}")
+        if isinstance(output, str):
+            out.close()
+            os.remove(output)
+        return False
+    if isinstance(output, str):
+        out.close()
+    return not stats['errors']
+
+def file_history(backups, path):
+    """Return every stored version of a file as (backup name, size, mtime, hash), oldest first"""
+    path = path.strip('/')
+    if backups:
+        backup_dest = os.path.dirname(os.path.realpath(backups[0][1]))
+        index = snapshot_index.SnapshotIndex.open_existing(backup_dest)
+        if index:
+            names = [os.path.basename(os.path.realpath(p)) for name, p in backups]
+            if all(index.has_snapshot(name) for name in names):
+                versions = index.versions(path)
+                index.close()
+                return versions
+            index.close()
+    
+    versions = []
+    for name, backup_path in sorted(backups, key=lambda backup: os.path.realpath(backup[1])):
+        snapshot = os.path.basename(os.path.realpath(backup_path))
+        if dedup_store.is_manifest_snapshot(backup_path):
+            for entry in dedup_store.iter_manifest(backup_path):
+                if entry['path'] == path:
+                    versions.append((snapshot, entry['size'], entry['mtime'], entry['sha256']))
+                    break
+            continue
+        if archive_tier.is_archive_snapshot(backup_path):
+            for entry in archive_tier.iter_index(backup_path):
+                if entry['path'] == path:
+                    versions.append((snapshot, entry['size'], entry['mtime'], None))
+                    break
+            continue
+        try:
+            st = os.stat(os.path.join(backup_path, path))
+        except OSError:
+            continue
+        versions.append((snapshot, st.st_size, st.st_mtime, None))
+    return versions
+
+def show_history(backups, path):
+    """Print every stored version of a file, marking where its content changed"""
+    versions = file_history(backups, path)
+    if not versions:
+        print(f"No versions of {path} found")
+        return
+    
+    print(f"Versions of {path}:")
+    previous = None
+    for snapshot, size, mtime, file_hash in versions:
+        key = (size, mtime, file_hash)
+        marker = "  (changed)" if previous is not None and key != previous else ""
+        modified = datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
+        print(f"  {snapshot}: {size / (1024 ** 2):.2f} MB, modified {modified}"
+              + (f", sha256 {file_hash[:12]}" if file_hash else "") + marker)
+        previous = key
+
+def find_backup(backups, text):
+    """Return the path of the first (newest) backup whose name or path contains text"""
+    for name, path in backups:
+        if text in name or text in path:
+            return path
+    print(f"Backup not found: {text}")
+    sys.exit(1)
+
+def show_diff(old_path, new_path, as_json=False, alert_percent=None):
+    """Stream the changes between two backups; return False if the alert threshold is exceeded"""
+    diff = snapshot_diff.SnapshotDiff(old_path, new_path)
+    symbols = {'added': '+', 'removed': '-', 'modified': 'M', 'renamed': 'R'}
+    
+    if not as_json:
+        print(f"Changes from {os.path.basename(os.path.realpath(old_path))} "
+              f"to {os.path.basename(os.path.realpath(new_path))}:")
+    for change in diff.changes():
+        if as_json:
+            print(json.dumps(change))
+        elif change['change'] == 'renamed':
+            print(f"R  {change['old_path']} -> {change['path']}")
+        else:
+            print(f"{symbols[change['change']]}  {change['path']}")
+    
+    counts = diff.counts
+    summary = {key: counts[key] for key in ('added', 'removed', 'modified', 'renamed')}
+    summary['changed_bytes'] = counts['added_bytes'] + counts['modified_bytes']
+    summary['changed_percent'] = round(diff.changed_fraction() * 100, 2)
+    alert = alert_percent is not None and summary['changed_percent'] >= alert_percent
+    
+    if as_json:
+        print(json.dumps({'summary': summary, 'alert': alert}))
     else:
-        cmd.extend([f"{source_path}/", destination])
-        print(f"Restoring entire backup to {destination}")
-        subprocess.run(cmd)
+        print(f"{summary['added']} added, {summary['removed']} removed, {summary['modified']} modified, "
+              f"{summary['renamed']} renamed ({summary['changed_bytes'] / (1024 ** 3):.2f} GB new data, "
+              f"{summary['changed_percent']}% of files changed)")
+    if alert:
+        print(f"ALERT: {summary['changed_percent']}% of files were modified, removed or renamed "
+              f"(threshold {alert_percent}%)", file=sys.stderr)
+    return not alert
+
+def open_index(backup_path):
+    """Open the index that covers a backup, or None if the backup is not indexed"""
+    backup_path = os.path.realpath(backup_path)
+    index = snapshot_index.SnapshotIndex.open_existing(os.path.dirname(backup_path))
+    if index and not index.has_snapshot(os.path.basename(backup_path)):
+        index.close()
+        return None
+    return index
+
+def backup_size(backup_path):
+    """Total size of the files in a backup in bytes"""
+    index = open_index(backup_path)
+    if index:
+        stats = index.snapshot_stats(os.path.basename(os.path.realpath(backup_path)))
+        index.close()
+        return stats['bytes']
+    
+    if dedup_store.is_manifest_snapshot(backup_path):
+        return sum(entry['size'] for entry in dedup_store.iter_manifest(backup_path))
+    
+    if archive_tier.is_archive_snapshot(backup_path):
+        return sum(entry['size'] for entry in archive_tier.iter_index(backup_path))
+    
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+               for dirpath, dirnames, filenames in os.walk(backup_path)
+               for filename in filenames)
 
 def search_in_backup(backup_path, pattern):
     """Search for files in backup"""
     import fnmatch
     
+    index = open_index(backup_path)
+    if index:
+        name = os.path.basename(os.path.realpath(backup_path))
+        matches = [path for snapshot, path in index.search(pattern, snapshot=name)]
+        index.close()
+        return matches
+    
+    # Patterns with a '/' match the relative path, others just the file name
+    match_path = '/' in pattern
+    
+    if dedup_store.is_manifest_snapshot(backup_path):
+        return [entry['path'] for entry in dedup_store.iter_manifest(backup_path)
+                if fnmatch.fnmatch(entry['path'] if match_path else os.path.basename(entry['path']), pattern)]
+    
+    if archive_tier.is_archive_snapshot(backup_path):
+        return [entry['path'] for entry in archive_tier.iter_index(backup_path)
+                if fnmatch.fnmatch(entry['path'] if match_path else os.path.basename(entry['path']), pattern)]
+    
     matches = []
     for root, dirs, files in os.walk(backup_path):
         for filename in files:
-            if fnmatch.fnmatch(filename, pattern):
-                rel_path = os.path.relpath(os.path.join(root, filename), backup_path)
+            rel_path = os.path.relpath(os.path.join(root, filename), backup_path)
+            if fnmatch.fnmatch(rel_path if match_path else filename, pattern):
                 matches.append(rel_path)
     
     return matches
 
+def search_all_backups(backups, pattern):
+    """Search every backup; return a list of (backup name, matching paths)"""
+    results = []
+    for name, path in backups:
+        matches = search_in_backup(path, pattern)
+        if matches:
+            results.append((name, matches))
+    return results
+
 def main():
     parser = argparse.ArgumentParser(description='Restore files from OneDrive backup')
     parser.add_argument('--config', default='config.json', 
@@ -85,14 +352,44 @@ def main():
     parser.add_argument('--destination', 
                        help='Restore destination (default: original location)')
     parser.add_argument('--files', nargs='+',
-                       help='Specific files to restore')
+                       help='Specific files, folders or glob patterns to restore')
+    parser.add_argument('--files-from',
+                       help='Read files, folders or patterns to restore from this file, one per line')
+    parser.add_argument('--workers', type=int, default=8,
+                       help='Number of parallel copy workers (default: 8)')
     parser.add_argument('--search', 
                        help='Search for files matching pattern')
+    parser.add_argument('--all-backups', action='store_true',
+                       help='With --search, show which backups contain matching files')
+    parser.add_argument('--as-of',
+                       help='Restore the newest version of each file at or before this time '
+                            '("YYYY-MM-DD HH:MM"), taken from all backups')
+    parser.add_argument('--history', metavar='PATH',
+                       help='List every stored version of a file')
+    parser.add_argument('--diff', nargs=2, metavar=('OLD', 'NEW'),
+                       help='Show files added, removed, modified or renamed between two backups')
+    parser.add_argument('--json', action='store_true',
+                       help='With --diff, print one JSON object per change')
+    parser.add_argument('--alert-percent', type=float,
+                       help='With --diff, exit with status 2 if at least this percentage of files changed')
+    parser.add_argument('--export', metavar='FILE',
+                       help='Instead of restoring, write the selected files as a tar archive to FILE '
+                            '("-" for standard output)')
+    parser.add_argument('--zstd', action='store_true',
+                       help='With --export, compress with zstd (implied by a .zst or .tzst file name)')
+    parser.add_argument('--zstd-level', type=int, default=3,
+                       help='zstd compression level for --export (default: 3)')
     parser.add_argument('--dry-run', action='store_true',
                        help='Show what would be restored without doing it')
     
     args = parser.parse_args()
     
+    export_stream = None
+    if args.export == '-':
+        # The archive goes to standard output, so every message goes to stderr
+        export_stream = sys.stdout.buffer
+        sys.stdout = sys.stderr
+    
     config = load_config(args.config)
     backup_dir = os.path.expanduser(config['backup_destination'])
     
@@ -105,21 +402,22 @@ def main():
     if args.list:
         print("Available backups:")
         for name, path in backups:
-            size = sum(os.path.getsize(os.path.join(dirpath, filename))
-                      for dirpath, dirnames, filenames in os.walk(path)
-                      for filename in filenames) / (1024**3)
+            size = backup_size(path) / (1024**3)
             print(f"  {name}: {size:.2f} GB")
         return
     
+    if args.history:
+        show_history(backups, args.history)
+        return
+    
+    if args.diff:
+        old_path, new_path = (find_backup(backups, text) for text in args.diff)
+        if not show_diff(old_path, new_path, args.json, args.alert_percent):
+            sys.exit(2)
+        return
+    
     if args.backup:
-        backup_path = None
-        for name, path in backups:
-            if args.backup in name or args.backup in path:
-                backup_path = path
-                break
-        if not backup_path:
-            print(f"Backup not found: {args.backup}")
-            sys.exit(1)
+        backup_path = find_backup(backups, args.backup)
     else:
         if backups:
             backup_path = backups[0][1]
@@ -129,6 +427,18 @@ def main():
     
     print(f"Using backup: {backup_path}")
     
+    if args.search and args.all_backups:
+        results = search_all_backups(backups, args.search)
+        if not results:
+            print("No matching files found")
+        for name, matches in results:
+            print(f"{name}: {len(matches)} matching files")
+            for match in matches[:20]:
+                print(f"  {match}")
+            if len(matches) > 20:
+                print(f"  ... and {len(matches) - 20} more")
+        return
+    
     if args.search:
         matches = search_in_backup(backup_path, args.search)
         if matches:
@@ -141,6 +451,25 @@ def main():
             print("No matching files found")
         return
     
+    files = args.files or []
+    if args.files_from:
+        files.extend(read_files_from(args.files_from))
+    
+    if args.export:
+        sources = None
+        if args.as_of:
+            sources = select_as_of(backups, parse_time(args.as_of), files)
+            if not sources:
+                print("No backed up files at or before that time")
+                sys.exit(1)
+        compress = args.zstd or args.export.endswith(('.zst', '.tzst'))
+        if compress and not archive_tier.available():
+            print("zstd compression needs the zstandard Python module or the zstd command")
+            sys.exit(1)
+        success = export_backup(backup_path, export_stream or args.export, files, compress,
+                                args.zstd_level, args.workers, args.dry_run, sources)
+        sys.exit(0 if success else 1)
+    
     destination = args.destination
     if not destination:
         if config['source_type'] == 'local':
@@ -156,10 +485,16 @@ def main():
             print("Restore cancelled")
             return
     
-    restore_files(backup_path, destination, args.files, args.dry_run)
+    if args.as_of:
+        success = restore_as_of(backups, parse_time(args.as_of), destination, files,
+                                args.dry_run, args.workers)
+    else:
+        success = restore_files(backup_path, destination, files, args.dry_run, args.workers)
     
     if not args.dry_run:
         print(f"Restore complete to: {destination}")
+    if not success:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
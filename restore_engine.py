@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import fnmatch
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import fileops
+import dedup_store
+import archive_tier
+import snapshot_index
+
+GLOB_CHARS = '*?['
+BATCH_SIZE = 256
+
+def is_glob(pattern):
+    return any(char in pattern for char in GLOB_CHARS)
+
+def path_matches(path, request):
+    """Check whether a snapshot path is selected by a restore request (path, folder or glob)"""
+    request = request.strip().strip('/')
+    if is_glob(request):
+        return fnmatch.fnmatch(path if '/' in request else os.path.basename(path), request)
+    return path == request or path.startswith(request + '/')
+
+class RestoreEngine:
+    """Restores many files from one snapshot on a pool of copy threads
+
+    Requests may be exact paths, folders or glob patterns. They are expanded
+    up front (from the index when the snapshot has one), the parent folders
+    are created once, and the files are copied in batches, using reflinks or
+    copy_file_range instead of one rsync process per file. Each path can
+    come from a different snapshot, for point-in-time restores.
+    """
+
+    def __init__(self, backup_path, destination, workers=8, dry_run=False):
+        self.backup_path = os.path.realpath(backup_path)
+        self.destination = destination
+        self.workers = max(1, workers)
+        self.dry_run = dry_run
+        self.manifests = {}
+        self.archives = {}
+        self.store = None
+        self.manifest = self.manifest_for(self.backup_path)
+        self.sources = {}
+        self.reflink_ok = True
+        self.lock = threading.Lock()
+        self.stats = {'files': 0, 'bytes': 0, 'skipped': 0, 'reflinked': 0, 'errors': []}
+
+    def manifest_for(self, snapshot_path):
+        """Return {path: entry} for a dedup or archived snapshot (cached), or None for a plain one"""
+        if snapshot_path not in self.manifests:
+            manifest = None
+            if archive_tier.is_archive_snapshot(snapshot_path):
+                self.archives[snapshot_path] = archive_tier.ArchiveReader(snapshot_path)
+                manifest = self.archives[snapshot_path].entries
+            elif dedup_store.is_manifest_snapshot(snapshot_path):
+                manifest = dedup_store.load_manifest(snapshot_path)
+                if self.store is None:
+                    self.store = dedup_store.ObjectStore.for_snapshot(snapshot_path)
+            self.manifests[snapshot_path] = manifest
+        return self.manifests[snapshot_path]
+
+    def open_index(self):
+        name = os.path.basename(self.backup_path)
+        index = snapshot_index.SnapshotIndex.open_existing(os.path.dirname(self.backup_path))
+        if index and not index.has_snapshot(name):
+            index.close()
+            return None
+        return index
+
+    def all_paths(self):
+        """Return every file of the snapshot"""
+        if self.manifest is not None:
+            return sorted(self.manifest)
+        return sorted(rel_path for rel_path, st in snapshot_index.scan_tree(self.backup_path))
+
+    def expand(self, requests):
+        """Turn requested paths, folders and globs into (sorted file paths, requests that matched nothing)"""
+        index = None if self.manifest is not None else self.open_index()
+        name = os.path.basename(self.backup_path)
+        paths = set()
+        missing = []
+
+        try:
+            for request in requests:
+                request = request.strip().strip('/')
+                if not request:
+                    continue
+
+                if is_glob(request):
+                    matches = self.match_glob(request, index, name)
+                elif self.manifest is not None:
+                    matches = [request] if request in self.manifest else \
+                        [path for path in self.manifest if path.startswith(request + '/')]
+                else:
+                    source = os.path.join(self.backup_path, request)
+                    if os.path.isdir(source) and not os.path.islink(source):
+                        matches = index.paths_under(name, request) if index else None
+                        if not matches:
+                            matches = [os.path.join(request, rel_path)
+                                       for rel_path, st in snapshot_index.scan_tree(source)]
+                    elif os.path.lexists(source):
+                        matches = [request]
+                    else:
+                        matches = []
+
+                if matches:
+                    paths.update(matches)
+                else:
+                    missing.append(request)
+        finally:
+            if index:
+                index.close()
+
+        return sorted(paths), missing
+
+    def match_glob(self, pattern, index, name):
+        # Patterns with a '/' match the relative path, others just the file name
+        if index:
+            return [path for snapshot, path in index.search(pattern, snapshot=name)]
+
+        match_path = '/' in pattern
+        candidates = self.manifest if self.manifest is not None else self.all_paths()
+        return [path for path in candidates
+                if fnmatch.fnmatch(path if match_path else os.path.basename(path), pattern)]
+
+    def restore(self, paths, sources=None, progress_interval=10):
+        """Copy the given snapshot paths to the destination; return the stats
+
+        sources optionally maps a path to the snapshot it is taken from;
+        other paths come from the engine's own snapshot.
+        """
+        start_time = time.time()
+        self.sources = sources or {}
+
+        if self.dry_run:
+            for path in paths:
+                source = self.sources.get(path)
+                print(f"  {path}" + (f"  ({os.path.basename(source)})" if source else ""))
+            print(f"Would restore {len(paths)} files")
+            return self.stats
+
+        # Load manifests before the workers start, so they only read the cache
+        for snapshot_path in set(self.sources.values()):
+            self.manifest_for(snapshot_path)
+
+        # Each parent folder is created once here instead of once per file
+        for parent in sorted({os.path.dirname(path) for path in paths}):
+            os.makedirs(os.path.join(self.destination, parent), exist_ok=True)
+
+        batches = [paths[i:i + BATCH_SIZE] for i in range(0, len(paths), BATCH_SIZE)]
+        last_report = start_time
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.restore_batch, batch) for batch in batches]
+            for future in as_completed(futures):
+                future.result()
+                if time.time() - last_report >= progress_interval:
+                    last_report = time.time()
+                    print(self.summary(len(paths), start_time))
+
+        print(self.summary(len(paths), start_time))
+        errors = self.stats['errors']
+        if errors:
+            print(f"{len(errors)} files could not be restored:")
+            for path, error in errors[:10]:
+                print(f"  {path}: {error}")
+            if len(errors) > 10:
+                print(f"  ... and {len(errors) - 10} more")
+        return self.stats
+
+    def restore_batch(self, batch):
+        for path in batch:
+            try:
+                copied, method = self.restore_one(path)
+            except OSError as e:
+                with self.lock:
+                    self.stats['errors'].append((path, e))
+                continue
+
+            with self.lock:
+                if copied is None:
+                    self.stats['skipped'] += 1
+                    continue
+                self.stats['files'] += 1
+                self.stats['bytes'] += copied
+                if method == 'reflink':
+                    self.stats['reflinked'] += 1
+
+    def restore_one(self, path):
+        """Restore one file; return (bytes copied, method), or (None, None) if it is already up to date"""
+        destination = os.path.join(self.destination, path)
+        snapshot_path = self.sources.get(path, self.backup_path)
+
+        manifest = self.manifests[snapshot_path]
+        if manifest is not None:
+            entry = manifest[path]
+            if self.unchanged(destination, entry['size'], entry['mtime']):
+                return None, None
+            archive = self.archives.get(snapshot_path)
+            if archive is None:
+                self.store.restore_entry(entry, destination)
+                return entry['size'], 'chunks'
+            if 'link' in entry:
+                archive.extract(entry, destination)
+                return 0, 'symlink'
+            tmp_path = f"{destination}.restore-tmp"
+            archive.extract(entry, tmp_path)
+            os.replace(tmp_path, destination)
+            return entry['size'], 'archive'
+
+        source = os.path.join(snapshot_path, path)
+        st = os.lstat(source)
+        if os.path.islink(source):
+            if os.path.lexists(destination):
+                os.remove(destination)
+            os.symlink(os.readlink(source), destination)
+            return 0, 'symlink'
+
+        if self.unchanged(destination, st.st_size, st.st_mtime):
+            return None, None
+
+        # Copy next to the target and rename, so an interrupted restore never leaves a truncated file
+        tmp_path = f"{destination}.restore-tmp"
+        method = fileops.copy_file(source, tmp_path, reflink=self.reflink_ok)
+        os.replace(tmp_path, destination)
+        if method != 'reflink':
+            # The filesystem refused the clone; don't try again for every file
+            self.reflink_ok = False
+        return st.st_size, method
+
+    @staticmethod
+    def unchanged(destination, size, mtime):
+        try:
+            st = os.lstat(destination)
+        except OSError:
+            return False
+        return not os.path.islink(destination) and st.st_size == size and st.st_mtime == mtime
+
+    def summary(self, total, start_time):
+        elapsed = max(time.time() - start_time, 1e-6)
+        stats = self.stats
+        done = stats['files'] + stats['skipped'] + len(stats['errors'])
+        text = (f"Restored {stats['files']}/{total} files, {stats['bytes'] / (1024 ** 3):.2f} GB "
+                f"in {elapsed:.1f} seconds ({stats['bytes'] / elapsed / (1024 ** 2):.1f} MB/s, "
+                f"{stats['files'] / elapsed:.0f} files/s)")
+        if stats['reflinked']:
+            text += f", {stats['reflinked']} as reflinks"
+        if stats['skipped']:
+            text += f", {stats['skipped']} already up to date"
+        if done < total:
+            text = "Progress: " + text
+        return text
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import os
+from datetime import datetime
+
+import dedup_store
+import snapshot_index
+import archive_tier
+
+# Buckets in the order they are filled; the key decides which snapshots share a bucket
+PERIODS = [
+    ('hourly', lambda dt: dt.strftime('%Y%m%d%H')),
+    ('daily', lambda dt: dt.strftime('%Y%m%d')),
+    ('weekly', lambda dt: '%d-%02d' % dt.isocalendar()[:2]),
+    ('monthly', lambda dt: dt.strftime('%Y%m')),
+    ('yearly', lambda dt: dt.strftime('%Y')),
+]
+
+def parse_snapshot_time(name):
+    """Return the datetime encoded in a backup_YYYYMMDD_HHMMSS name, or None"""
+    try:
+        return datetime.strptime(name.replace('backup_', ''), '%Y%m%d_%H%M%S')
+    except ValueError:
+        return None
+
+def plan_retention(names, policy):
+    """Decide which snapshots a grandfather-father-son policy keeps
+
+    One pass over the snapshots, newest first: a snapshot is kept if it is
+    among the newest keep_last, or is the newest one in a bucket of a period
+    that still has slots left. Snapshots whose name carries no date are
+    always kept. Returns ({kept name: [reasons]}, [names to delete]).
+    """
+    remaining = {period: int(policy.get(period, 0) or 0) for period, _ in PERIODS}
+    seen = {period: set() for period, _ in PERIODS}
+    keep_last = max(1, int(policy.get('keep_last', 1) or 1))
+
+    keep = {}
+    delete = []
+    for position, name in enumerate(sorted(names, reverse=True)):
+        dt = parse_snapshot_time(name)
+        if dt is None:
+            keep[name] = ['undated']
+            continue
+
+        reasons = []
+        if position < keep_last:
+            reasons.append('last')
+        for period, key_func in PERIODS:
+            key = key_func(dt)
+            if remaining[period] > 0 and key not in seen[period]:
+                seen[period].add(key)
+                remaining[period] -= 1
+                reasons.append(period)
+
+        if reasons:
+            keep[name] = reasons
+        else:
+            delete.append(name)
+
+    return keep, delete
+
+class SpaceEstimator:
+    """Works out how much disk space deleting a set of snapshots actually frees
+
+    Snapshots can share data (hardlinks, or chunks in the dedup store), so the
+    space freed is only what no remaining snapshot still uses. Without an
+    index each snapshot is walked at most once; its inodes are kept so
+    further estimates (one per budget step) are answered from memory.
+    """
+
+    def __init__(self, backup_dest, names, backend='files'):
+        self.backup_dest = backup_dest
+        self.names = list(names)
+        self.backend = backend
+        self.index = None
+        self.chunk_refs = None
+        self.inodes = {}  # (dev, ino) -> [nlink, size, names of the snapshots holding its links]
+        self.exclusive = {}  # walked snapshot -> bytes in files with a single link
+
+        if backend != 'dedup':
+            index = snapshot_index.SnapshotIndex.open_existing(backup_dest)
+            # The index can only answer if it knows every snapshot that might share an inode
+            if index and all(index.has_snapshot(name) for name in self.names):
+                self.index = index
+            elif index:
+                index.close()
+
+    def close(self):
+        if self.index:
+            self.index.close()
+
+    def path(self, name):
+        return os.path.join(self.backup_dest, name)
+
+    def freed_bytes(self, deleted):
+        """Bytes freed by deleting all of `deleted` together"""
+        deleted = list(deleted)
+        if not deleted:
+            return 0
+        if self.backend == 'dedup':
+            return self._dedup_freed(deleted)
+        if self.index:
+            # Archived snapshots have no inodes in the index; their archive files are theirs alone
+            return self.index.exclusive_bytes(deleted) + sum(
+                archive_tier.archive_bytes(self.path(name)) for name in deleted
+                if archive_tier.is_archive_snapshot(self.path(name)))
+        return self._walk_freed(deleted)
+
+    def freed_report(self, deleted):
+        """Return (bytes freed by deleting all of `deleted`, {name: bytes only that snapshot holds})"""
+        deleted = list(deleted)
+        if self.backend != 'dedup' and not self.index:
+            return self._walk_freed(deleted, per_snapshot=True)
+        return self.freed_bytes(deleted), {name: self.freed_bytes([name]) for name in deleted}
+
+    def used_bytes(self):
+        """Disk space taken by all snapshots, counting shared data once"""
+        return self.freed_bytes(self.names)
+
+    def _walk(self, names):
+        for name in names:
+            if name in self.exclusive:
+                continue
+            exclusive = 0
+            for rel_path, st in snapshot_index.scan_tree(self.path(name)):
+                entry = self.inodes.setdefault((st.st_dev, st.st_ino), [st.st_nlink, st.st_size, []])
+                entry[2].append(name)
+                if st.st_nlink == 1:
+                    exclusive += st.st_size
+            self.exclusive[name] = exclusive
+
+    def _walk_freed(self, deleted, per_snapshot=False):
+        # An inode is freed when every one of its links lives in a deleted snapshot
+        self._walk(deleted)
+        deleted_names = set(deleted)
+        total = sum(size for nlink, size, holders in self.inodes.values()
+                    if len(holders) >= nlink and sum(name in deleted_names for name in holders) >= nlink)
+        if per_snapshot:
+            return total, {name: self.exclusive[name] for name in deleted}
+        return total
+
+    def _load_chunk_refs(self):
+        if self.chunk_refs is None:
+            self.chunk_refs = {}
+            for name in self.names:
+                refs = set()
+                if dedup_store.is_manifest_snapshot(self.path(name)):
+                    for entry in dedup_store.iter_manifest(self.path(name)):
+                        refs.update(entry['chunks'])
+                self.chunk_refs[name] = refs
+        return self.chunk_refs
+
+    def _dedup_freed(self, deleted):
+        refs = self._load_chunk_refs()
+        deleted = set(deleted)
+        still_used = set()
+        for name, chunks in refs.items():
+            if name not in deleted:
+                still_used |= chunks
+        freed = set()
+        for name in deleted:
+            freed |= refs.get(name, set()) - still_used
+
+        store = dedup_store.ObjectStore(self.backup_dest)
+        total = 0
+        for digest in freed:
+            try:
+                total += os.path.getsize(store.object_path(digest))
+            except OSError:
+                pass
+        return total
+
+def apply_budget(keep, delete, estimator, max_bytes):
+    """Delete more of the oldest kept snapshots until the rest fit in max_bytes
+
+    The newest snapshot is never removed. Returns the extra names deleted.
+    """
+    extra = []
+    used = estimator.used_bytes() - estimator.freed_bytes(delete)
+    candidates = sorted(name for name in keep if parse_snapshot_time(name))[:-1]
+
+    for name in candidates:
+        if used <= max_bytes:
+            break
+        before = estimator.freed_bytes(delete + extra)
+        extra.append(name)
+        used -= estimator.freed_bytes(delete + extra) - before
+
+    return extra
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+
+QUEUE_FILE = os.path.join('.state', 'retry_queue.json')
+QUARANTINE_FILE = os.path.join('.state', 'quarantine.json')
+# Messages of errors that concern a whole folder rather than one file
+FOLDER_MARKERS = ('directory', 'error listing', 'list failed')
+FILTER_SPECIAL = '\\*?[]{}'
+
+def is_folder_error(message):
+    lowered = message.lower()
+    return any(marker in lowered for marker in FOLDER_MARKERS)
+
+def escape_filter(path):
+    """Escape a literal path for rclone's filter syntax"""
+    return ''.join('\\' + char if char in FILTER_SPECIAL else char for char in path)
+
+def load_json(path):
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class RetryQueue:
+    """Paths that failed to transfer, kept across runs until a retry fetches them
+
+    Every path the sync reported an error for is queued with its error
+    class and last message, and retried on its own after the main pass of
+    this and later runs. A path counts one failed run each time it is still
+    failing after a run's retries; after quarantine_after such runs it moves
+    to the quarantine, whose paths are excluded from the backup until they
+    are released by hand or quarantine_days have passed.
+    """
+
+    def __init__(self, backup_dest):
+        self.queue_path = os.path.join(backup_dest, QUEUE_FILE)
+        self.quarantine_path = os.path.join(backup_dest, QUARANTINE_FILE)
+        self.queue = load_json(self.queue_path)
+        self.quarantine = load_json(self.quarantine_path)
+
+    def add(self, failures):
+        """Queue {path: (error class, message)} from a transfer"""
+        now = int(time.time())
+        for path, (error_class, message) in failures.items():
+            if path in self.quarantine:
+                continue
+            entry = self.queue.setdefault(path, {'first_seen': now, 'failed_runs': 0})
+            entry.update({'class': error_class, 'message': message[:500], 'last_seen': now,
+                          'folder': is_folder_error(message)})
+
+    def pending(self):
+        return sorted(self.queue)
+
+    def is_folder(self, path):
+        return self.queue.get(path, {}).get('folder', False)
+
+    def resolve(self, paths):
+        for path in paths:
+            self.queue.pop(path, None)
+
+    def end_run(self, still_failing, quarantine_after):
+        """Count a failed run for each path; return the paths moved to the quarantine"""
+        now = int(time.time())
+        moved = []
+        for path in still_failing:
+            entry = self.queue.get(path)
+            if entry is None:
+                continue
+            entry['failed_runs'] += 1
+            if quarantine_after and entry['failed_runs'] >= quarantine_after:
+                entry['quarantined'] = now
+                self.quarantine[path] = self.queue.pop(path)
+                moved.append(path)
+        return moved
+
+    def release(self, path=None):
+        """Take one path, or every path, out of the quarantine; return the released paths"""
+        paths = [path] if path else list(self.quarantine)
+        released = [path for path in paths if self.quarantine.pop(path, None) is not None]
+        return released
+
+    def release_expired(self, days):
+        """Release quarantined paths older than days, so they get another chance"""
+        if not days:
+            return []
+        cutoff = time.time() - days * 86400
+        return [path for path in list(self.quarantine)
+                if self.quarantine[path].get('quarantined', 0) < cutoff and self.release(path)]
+
+    def exclude_patterns(self):
+        """rclone filter patterns for the quarantined paths, anchored at the remote's root"""
+        return ['/' + escape_filter(path) + ('/**' if entry.get('folder') else '')
+                for path, entry in sorted(self.quarantine.items())]
+
+    def save(self):
+        write_json(self.queue_path, self.queue)
+        write_json(self.quarantine_path, self.quarantine)
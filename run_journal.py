@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+JOURNAL_FILE = os.path.join('.state', 'journal.json')
+LOCK_FILE = os.path.join('.state', 'run.lock')
+# Snapshots are built under this prefix and renamed to backup_* once complete
+WORKING_PREFIX = '.inprogress-'
+
+def working_name(name):
+    return WORKING_PREFIX + name
+
+def is_working_dir(name):
+    return name.startswith(WORKING_PREFIX)
+
+def fsync_dir(path):
+    """Make a rename inside path durable"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class RunJournal:
+    """Records the snapshot a run is building and the work already finished
+
+    The journal is a small JSON file that is rewritten atomically (temporary
+    file, fsync, rename) after every step, so after a crash, sleep or power
+    loss the next run finds the same snapshot and continues it. It is
+    removed once the snapshot has been renamed to its final name and the
+    'latest' link, index and pruning have been updated.
+    """
+
+    def __init__(self, backup_dest):
+        self.backup_dest = backup_dest
+        self.path = os.path.join(backup_dest, JOURNAL_FILE)
+        self.lock_path = os.path.join(backup_dest, LOCK_FILE)
+        self.lock_handle = None
+        self.state = None
+        self.write_lock = threading.Lock()
+
+    def acquire(self):
+        """Take the run lock without blocking; False if another run holds it"""
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        self.lock_handle = open(self.lock_path, 'w')
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(self.lock_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            self.lock_handle.close()
+            self.lock_handle = None
+            return False
+
+    def release(self):
+        if self.lock_handle:
+            self.lock_handle.close()
+            self.lock_handle = None
+
+    def load(self):
+        """Return the journal of an unfinished run, or None"""
+        try:
+            with open(self.path, 'r') as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = None
+        return self.state
+
+    def start(self, snapshot, source, storage_backend):
+        self.state = {
+            'snapshot': snapshot,
+            'source': source,
+            'storage_backend': storage_backend,
+            'started': time.time(),
+            'updated': time.time(),
+            'attempts': 1,
+            'phase': 'created',
+            'seeded_from': None,
+            'folders_done': [],
+        }
+        self.save()
+
+    def matches(self, source, storage_backend):
+        """Check that the unfinished run backed up the same source the same way"""
+        return (self.state is not None and self.state.get('source') == source
+                and self.state.get('storage_backend') == storage_backend)
+
+    def age_hours(self):
+        return (time.time() - self.state.get('updated', 0)) / 3600
+
+    def save(self):
+        # Parallel folder workers report completions from several threads
+        with self.write_lock:
+            if self.state is None:
+                return
+            self.state['updated'] = time.time()
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+    def set(self, **values):
+        if self.state is None:
+            return
+        self.state.update(values)
+        self.save()
+
+    def folder_done(self, name):
+        with self.write_lock:
+            if self.state is None or name in self.state['folders_done']:
+                return
+            self.state['folders_done'].append(name)
+        self.save()
+
+    def finished_folders(self):
+        return set(self.state['folders_done']) if self.state else set()
+
+    def clear(self):
+        self.state = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import json
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PREFIX = 'onedrive_backup'
+TEXTFILE = os.path.join('.state', 'metrics.prom')
+
+class RunMetrics:
+    """Wall-clock time per phase of one backup run
+
+    Phases may nest (listing happens inside the transfer phase); each phase
+    is charged only its own time, so the phases add up to the run.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.local = threading.local()
+
+    @contextmanager
+    def phase(self, name):
+        stack = self.local.__dict__.setdefault('stack', [])
+        start = time.monotonic()
+        stack.append(0.0)
+        try:
+            yield
+        finally:
+            nested = stack.pop()
+            elapsed = time.monotonic() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed - nested
+            if stack:
+                stack[-1] += elapsed
+
+    def as_record(self):
+        return {name: round(seconds, 3) for name, seconds in self.phases.items()}
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def record_samples(record):
+    """Yield (name, kind, help text, labels, value) for one run_history record"""
+    yield ('last_run_timestamp_seconds', 'gauge', 'Start time of the last backup run',
+           {}, record.get('timestamp', 0))
+    yield ('last_run_success', 'gauge', 'Whether the last backup run succeeded',
+           {}, int(bool(record.get('success'))))
+    yield ('last_run_duration_seconds', 'gauge', 'Duration of the last backup run',
+           {}, record.get('elapsed', 0))
+    for name, seconds in sorted(record.get('phases', {}).items()):
+        yield ('phase_duration_seconds', 'gauge', 'Time spent in each phase of the last run',
+               {'phase': name}, seconds)
+    yield ('transferred_bytes', 'gauge', 'Bytes transferred by the last run',
+           {}, record.get('bytes', 0))
+    yield ('transferred_files', 'gauge', 'Files transferred by the last run',
+           {}, record.get('files', 0))
+    yield ('checks_per_second', 'gauge', 'Files checked per second during the transfer phase',
+           {}, record.get('checks_per_second', 0))
+    for name, count in sorted(record.get('errors_by_class', {}).items()) or [('other', 0)]:
+        yield ('errors', 'gauge', 'Errors in the last run by class', {'class': name}, count)
+    yield ('throttle_backoffs', 'gauge', 'Times the last run backed off because of throttling',
+           {}, record.get('throttle_backoffs', 0))
+    yield ('retry_failed_paths', 'gauge', 'Paths still failing after the last run\'s retry pass',
+           {}, record.get('retry_failed', 0))
+    yield ('quarantined_paths', 'gauge', 'Paths the last run moved to the quarantine',
+           {}, record.get('quarantined', 0))
+    yield ('peak_concurrency', 'gauge', 'Most rclone workers running at once in the last run',
+           {}, record.get('peak_concurrency', 0))
+    yield ('snapshot_files', 'gauge', 'Files in the latest snapshot',
+           {}, record.get('snapshot_files', 0))
+    yield ('snapshot_bytes', 'gauge', 'Size of the latest snapshot',
+           {}, record.get('snapshot_bytes', 0))
+
+def render(record, extra=None):
+    """Turn a run_history record into Prometheus text exposition format"""
+    return render_many([({}, record)], extra)
+
+def render_many(records, extra=None):
+    """Render several run_history records, each as (labels, record), as one exposition
+
+    The labels (e.g. the account name) are added to every sample of their
+    record; extra maps name -> (kind, help text, value) for unlabelled gauges.
+    """
+    metrics = {}
+    for record_labels, record in records:
+        for name, kind, help_text, labels, value in record_samples(record):
+            metrics.setdefault(name, (kind, help_text, []))[2].append(({**record_labels, **labels}, value))
+    for name, (kind, help_text, value) in sorted((extra or {}).items()):
+        metrics[name] = (kind, help_text, [({}, value)])
+
+    lines = []
+    for name, (kind, help_text, samples) in metrics.items():
+        lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{escape(val)}"' for key, val in labels.items())
+            lines.append(f"{PREFIX}_{name}{{{label_text}}} {value}" if label_text
+                         else f"{PREFIX}_{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+def write_textfile(path, text):
+    """Write a node_exporter textfile-collector file in one rename, so it is never read half-written"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+class MetricsServer:
+    """Serves the last run's metrics over HTTP while the daemon is resident
+
+    GET /metrics returns Prometheus text, GET /metrics.json the last
+    run_history record. status() supplies live daemon gauges.
+    """
+
+    def __init__(self, address, port, record_source, status, logger):
+        self.address = address
+        self.port = port
+        self.record_source = record_source
+        self.status = status
+        self.logger = logger
+        self.server = None
+
+    def start(self):
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                record = owner.record_source() or {}
+                if self.path.split('?')[0] == '/metrics':
+                    body = render(record, owner.status()).encode()
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                elif self.path.split('?')[0] == '/metrics.json':
+                    body = json.dumps(record).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer((self.address, self.port), Handler)
+        except OSError as e:
+            self.logger.warning(f"Could not start metrics endpoint on {self.address}:{self.port}: {e}")
+            return False
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.logger.info(f"Serving metrics on http://{self.address}:{self.port}/metrics")
+        return True
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
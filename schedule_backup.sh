@@ -12,8 +12,11 @@ echo "2. Daily backup (at 2 AM)"
 echo "3. Weekly backup (Sunday at 2 AM)"
 echo "4. Custom cron schedule"
 echo "5. Remove scheduled backup"
+echo "6. Resident daemon (started at boot, backs up when files change)"
 echo ""
-read -p "Enter option (1-5): " option
+read -p "Enter option (1-6): " option
+
+BACKUP_ARGS=""
 
 case $option in
     1)
@@ -39,13 +42,18 @@ case $option in
         echo "Scheduled backup removed."
         exit 0
         ;;
+    6)
+        CRON_SCHEDULE="@reboot"
+        BACKUP_ARGS=" --daemon"
+        DESCRIPTION="as a daemon started at boot"
+        ;;
     *)
         echo "Invalid option"
         exit 1
         ;;
 esac
 
-CRON_JOB="$CRON_SCHEDULE /usr/bin/python3 $BACKUP_SCRIPT >> $SCRIPT_DIR/cron.log 2>&1"
+CRON_JOB="$CRON_SCHEDULE /usr/bin/python3 $BACKUP_SCRIPT$BACKUP_ARGS >> $SCRIPT_DIR/cron.log 2>&1"
 
 (crontab -l 2>/dev/null | grep -v "$BACKUP_SCRIPT"; echo "$CRON_JOB") | crontab -
 
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sys
+import time
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import archive_tier
+
+READ_SIZE = 4 * 1024 * 1024
+# Files up to this size are read whole by the prefetch threads, larger ones are streamed
+SMALL_FILE = 8 * 1024 * 1024
+DEFAULT_PREFETCH_MB = 256
+# Unit of parallel compression; output appears one block at a time
+BLOCK_SIZE = 8 * 1024 * 1024
+
+def read_file(path):
+    """Yield a file's content in large sequential reads"""
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                return
+            yield data
+
+class ChunkStream:
+    """Read-only file object over an iterator of byte strings, for tarfile.addfile"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+class CountingWriter:
+    """Passes writes through to a binary file and counts the bytes"""
+
+    def __init__(self, out):
+        self.out = out
+        self.compressed = 0
+
+    def write(self, data):
+        self.out.write(data)
+        self.compressed += len(data)
+        return len(data)
+
+    def close(self):
+        self.out.flush()
+
+class SnapshotExporter:
+    """Streams files of a snapshot into a tar archive, optionally zstd-compressed, without staging them
+
+    Paths are written in sorted order, so reads stay sequential within each
+    folder. Small files are read ahead on a thread pool, up to prefetch_mb
+    held in memory, while earlier ones are written; large files are read in
+    READ_SIZE pieces as they are written. With compression, the tar stream
+    is cut into blocks compressed in parallel as independent zstd frames,
+    which together are one ordinary .tar.zst stream. Files come from plain,
+    dedup or archived snapshots through a RestoreEngine.
+    """
+
+    def __init__(self, engine, out, compress=False, level=3, threads=4, prefetch_mb=DEFAULT_PREFETCH_MB):
+        self.engine = engine
+        self.out = out
+        self.compress = compress
+        self.level = level
+        self.threads = max(1, threads)
+        self.prefetch_bytes = prefetch_mb * 1024 * 1024
+        self.stats = {'files': 0, 'bytes': 0, 'errors': []}
+
+    def describe(self, path):
+        """Return (TarInfo, function yielding the content) for a snapshot path; the function is None for symlinks"""
+        snapshot_path = self.engine.sources.get(path, self.engine.backup_path)
+        manifest = self.engine.manifest_for(snapshot_path)
+        info = tarfile.TarInfo(path)
+
+        if manifest is None:
+            source = os.path.join(snapshot_path, path)
+            st = os.lstat(source)
+            info.mtime = st.st_mtime
+            info.mode = st.st_mode & 0o7777
+            if os.path.islink(source):
+                info.type = tarfile.SYMTYPE
+                info.linkname = os.readlink(source)
+                return info, None
+            info.size = st.st_size
+            return info, lambda: read_file(source)
+
+        entry = manifest[path]
+        info.mtime = entry['mtime']
+        info.mode = entry.get('mode', 0o644) & 0o7777
+        if 'link' in entry:
+            info.type = tarfile.SYMTYPE
+            info.linkname = entry['link']
+            return info, None
+        info.size = entry['size']
+        archive = self.engine.archives.get(snapshot_path)
+        if archive is not None:
+            return info, lambda: archive.read_chunks(entry)
+        return info, lambda: self.engine.store.read_entry(entry)
+
+    def export(self, paths, sources=None, progress_interval=10):
+        """Write the given snapshot paths as a tar stream; return the stats"""
+        start_time = time.time()
+        self.engine.sources = sources or {}
+        for snapshot_path in set(self.engine.sources.values()):
+            self.engine.manifest_for(snapshot_path)
+
+        if self.compress:
+            writer = archive_tier.BlockWriter(self.out, BLOCK_SIZE, self.level, self.threads)
+        else:
+            writer = CountingWriter(self.out)
+        tar = tarfile.open(fileobj=writer, mode='w|', format=tarfile.PAX_FORMAT, bufsize=1024 * 1024)
+        tar.copybufsize = READ_SIZE
+
+        window = deque()
+        window_bytes = 0
+        pending = iter(paths)
+        last_report = start_time
+        try:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                while True:
+                    # Keep the read-ahead window full before writing the next file
+                    while window_bytes < self.prefetch_bytes:
+                        path = next(pending, None)
+                        if path is None:
+                            break
+                        try:
+                            info, reader = self.describe(path)
+                        except (OSError, KeyError) as e:
+                            self.stats['errors'].append((path, e))
+                            continue
+                        if reader is not None and info.size <= SMALL_FILE:
+                            content = executor.submit(lambda reader=reader: b''.join(reader()))
+                            window_bytes += info.size
+                        else:
+                            content = reader
+                        window.append((path, info, content))
+                    if not window:
+                        break
+
+                    path, info, content = window.popleft()
+                    if content is None:
+                        tar.addfile(info)
+                    elif callable(content):
+                        tar.addfile(info, ChunkStream(content()))
+                    else:
+                        window_bytes -= info.size
+                        try:
+                            data = content.result()
+                        except OSError as e:
+                            self.stats['errors'].append((path, e))
+                            continue
+                        tar.addfile(info, io.BytesIO(data))
+                    self.stats['files'] += 1
+                    self.stats['bytes'] += info.size
+
+                    if time.time() - last_report >= progress_interval:
+                        last_report = time.time()
+                        self.report(len(paths), start_time, writer)
+        finally:
+            tar.close()
+            writer.close()
+
+        self.report(len(paths), start_time, writer)
+        errors = self.stats['errors']
+        if errors:
+            print(f"{len(errors)} files could not be exported:", file=sys.stderr)
+            for path, error in errors[:10]:
+                print(f"  {path}: {error}", file=sys.stderr)
+            if len(errors) > 10:
+                print(f"  ... and {len(errors) - 10} more", file=sys.stderr)
+        return self.stats
+
+    def report(self, total, start_time, writer):
+        # stdout may be the archive itself, so progress goes to stderr
+        elapsed = max(time.time() - start_time, 1e-6)
+        stats = self.stats
+        text = (f"Exported {stats['files']}/{total} files, {stats['bytes'] / (1024 ** 3):.2f} GB "
+                f"in {elapsed:.1f} seconds ({stats['bytes'] / elapsed / (1024 ** 2):.1f} MB/s), "
+                f"{writer.compressed / (1024 ** 3):.2f} GB written")
+        if stats['files'] + len(stats['errors']) < total:
+            text = "Progress: " + text
+        print(text, file=sys.stderr)
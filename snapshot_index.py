@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+import hashlib
+import time
+from datetime import datetime
+
+import dedup_store
+
+INDEX_NAME = 'index.db'
+BATCH_SIZE = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    name TEXT PRIMARY KEY,
+    created REAL,
+    file_count INTEGER,
+    total_bytes INTEGER,
+    unique_bytes INTEGER,
+    indexed_at REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    snapshot TEXT NOT NULL,
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    hash TEXT,
+    inode INTEGER,
+    PRIMARY KEY (snapshot, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_path ON files(path);
+CREATE INDEX IF NOT EXISTS files_name ON files(name);
+CREATE INDEX IF NOT EXISTS files_inode ON files(inode);
+CREATE TABLE IF NOT EXISTS checksums (
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    algorithm TEXT NOT NULL,
+    digest TEXT,
+    verified REAL,
+    PRIMARY KEY (inode, size, mtime, algorithm)
+) WITHOUT ROWID;
+"""
+
+def snapshot_created(name):
+    """Parse the creation time out of a backup_YYYYMMDD_HHMMSS name"""
+    try:
+        return datetime.strptime(name.replace('backup_', ''), '%Y%m%d_%H%M%S').timestamp()
+    except ValueError:
+        return None
+
+def hash_file(path, buffer_size=1024 * 1024):
+    """Return the SHA-256 of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(buffer_size)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+def glob_to_sqlite(pattern):
+    """Translate an fnmatch pattern to SQLite GLOB syntax"""
+    return pattern.replace('[!', '[^')
+
+def scan_tree(root_path):
+    """Yield (relative path, stat result) for every regular file under root_path"""
+    stack = [root_path]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            yield os.path.relpath(entry.path, root_path), entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+
+class SnapshotIndex:
+    """SQLite catalog of the files in every snapshot of a backup destination"""
+
+    def __init__(self, backup_dest):
+        self.path = os.path.join(backup_dest, INDEX_NAME)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+    @classmethod
+    def open_existing(cls, backup_dest):
+        """Open the index of a backup destination, or return None if it has none"""
+        if not os.path.exists(os.path.join(backup_dest, INDEX_NAME)):
+            return None
+        try:
+            return cls(backup_dest)
+        except sqlite3.Error:
+            return None
+
+    def close(self):
+        self.conn.close()
+
+    def has_snapshot(self, name):
+        """Check whether a snapshot has been indexed"""
+        row = self.conn.execute('SELECT 1 FROM snapshots WHERE name = ?', (name,)).fetchone()
+        return row is not None
+
+    def snapshot_names(self):
+        """Return the names of all indexed snapshots, newest first"""
+        rows = self.conn.execute('SELECT name FROM snapshots ORDER BY name DESC')
+        return [row[0] for row in rows]
+
+    def snapshot_stats(self, name):
+        """Return the totals recorded for a snapshot, or None if it is not indexed"""
+        row = self.conn.execute(
+            'SELECT file_count, total_bytes, unique_bytes FROM snapshots WHERE name = ?',
+            (name,)).fetchone()
+        if row is None:
+            return None
+        return {'files': row[0], 'bytes': row[1], 'unique_bytes': row[2]}
+
+    def _insert_rows(self, rows):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO files (snapshot, path, name, size, mtime, hash, inode) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def _commit_snapshot(self, name, tmp_name, stats):
+        """Replace a snapshot's rows with the freshly written ones in one transaction"""
+        with self.conn:
+            self.conn.execute('DELETE FROM files WHERE snapshot = ?', (name,))
+            self.conn.execute('UPDATE files SET snapshot = ? WHERE snapshot = ?', (name, tmp_name))
+            self.conn.execute(
+                'INSERT OR REPLACE INTO snapshots '
+                '(name, created, file_count, total_bytes, unique_bytes, indexed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (name, snapshot_created(name), stats['files'], stats['bytes'],
+                 stats['unique_bytes'], time.time()))
+
+    def index_tree(self, snapshot_path, previous=None, hash_files=True, logger=None):
+        """Index a plain-file snapshot
+
+        Hashes are copied from the previous snapshot's rows for files whose
+        size and mtime are unchanged, so only new or modified files are read.
+        """
+        name = os.path.basename(snapshot_path)
+        tmp_name = f"{name}.indexing"
+        stats = {'files': 0, 'bytes': 0, 'unique_bytes': 0, 'hashed_files': 0}
+
+        with self.conn:
+            self.conn.execute('DELETE FROM files WHERE snapshot = ?', (tmp_name,))
+
+        batch = []
+        for rel_path, st in scan_tree(snapshot_path):
+            batch.append((tmp_name, rel_path, os.path.basename(rel_path),
+                          st.st_size, st.st_mtime, None, st.st_ino))
+            stats['files'] += 1
+            stats['bytes'] += st.st_size
+            # Files hardlinked into other snapshots don't cost this one any space
+            if st.st_nlink == 1:
+                stats['unique_bytes'] += st.st_size
+            if len(batch) >= BATCH_SIZE:
+                with self.conn:
+                    self._insert_rows(batch)
+                batch = []
+        with self.conn:
+            self._insert_rows(batch)
+
+        if previous is None:
+            previous = name
+        with self.conn:
+            self.conn.execute(
+                'UPDATE files SET hash = ('
+                '  SELECT p.hash FROM files p WHERE p.snapshot = ? AND p.path = files.path'
+                '  AND p.size = files.size AND p.mtime = files.mtime'
+                ') WHERE snapshot = ?', (previous, tmp_name))
+
+        if hash_files:
+            pending = self.conn.execute(
+                'SELECT path FROM files WHERE snapshot = ? AND hash IS NULL', (tmp_name,)).fetchall()
+            updates = []
+            for (rel_path,) in pending:
+                try:
+                    digest = hash_file(os.path.join(snapshot_path, rel_path))
+                except OSError as e:
+                    if logger:
+                        logger.warning(f"Could not hash {rel_path}: {e}")
+                    continue
+                updates.append((digest, tmp_name, rel_path))
+                stats['hashed_files'] += 1
+                if len(updates) >= BATCH_SIZE:
+                    with self.conn:
+                        self.conn.executemany(
+                            'UPDATE files SET hash = ? WHERE snapshot = ? AND path = ?', updates)
+                    updates = []
+            with self.conn:
+                self.conn.executemany(
+                    'UPDATE files SET hash = ? WHERE snapshot = ? AND path = ?', updates)
+
+        self._commit_snapshot(name, tmp_name, stats)
+        return stats
+
+    def index_manifest(self, snapshot_path):
+        """Index a deduplicated snapshot from its manifest"""
+        name = os.path.basename(snapshot_path)
+        tmp_name = f"{name}.indexing"
+        stats = {'files': 0, 'bytes': 0, 'unique_bytes': 0, 'hashed_files': 0}
+
+        with self.conn:
+            self.conn.execute('DELETE FROM files WHERE snapshot = ?', (tmp_name,))
+
+        batch = []
+        for entry in dedup_store.iter_manifest(snapshot_path):
+            batch.append((tmp_name, entry['path'], os.path.basename(entry['path']),
+                          entry['size'], entry['mtime'], entry['sha256'], None))
+            stats['files'] += 1
+            stats['bytes'] += entry['size']
+            if len(batch) >= BATCH_SIZE:
+                with self.conn:
+                    self._insert_rows(batch)
+                batch = []
+        with self.conn:
+            self._insert_rows(batch)
+
+        self._commit_snapshot(name, tmp_name, stats)
+        return stats
+
+    def forget_snapshot(self, name):
+        """Drop a snapshot and its files from the index"""
+        with self.conn:
+            self.conn.execute('DELETE FROM files WHERE snapshot = ?', (name,))
+            self.conn.execute('DELETE FROM snapshots WHERE name = ?', (name,))
+
+    def detach_inodes(self, name):
+        """Forget the inodes of a snapshot whose files no longer exist on disk (e.g. after archiving)"""
+        with self.conn:
+            self.conn.execute('UPDATE files SET inode = NULL WHERE snapshot = ?', (name,))
+
+    def folder_sizes(self, name):
+        """Return the total size of each top-level folder of a snapshot"""
+        rows = self.conn.execute(
+            "SELECT substr(path, 1, instr(path, '/') - 1) AS folder, SUM(size) FROM files "
+            "WHERE snapshot = ? AND instr(path, '/') > 0 GROUP BY folder", (name,))
+        return {folder: size for folder, size in rows}
+
+    def file_metadata(self, name):
+        """Return {path: (size, mtime)} for every file of a snapshot"""
+        rows = self.conn.execute('SELECT path, size, mtime FROM files WHERE snapshot = ?', (name,))
+        return {path: (size, mtime) for path, size, mtime in rows}
+
+    def paths_under(self, name, folder):
+        """Return the paths of all files below a folder of a snapshot"""
+        prefix = folder.strip('/') + '/'
+        # '0' sorts right after '/', so this is a range scan on the primary key
+        rows = self.conn.execute(
+            'SELECT path FROM files WHERE snapshot = ? AND path >= ? AND path < ? ORDER BY path',
+            (name, prefix, prefix[:-1] + '0'))
+        return [row[0] for row in rows]
+
+    def exclusive_bytes(self, names):
+        """Bytes held only by the given snapshots, i.e. freed if they were all deleted
+
+        Hardlinked copies share an inode (with the same size and mtime), so a
+        file only counts if no other snapshot has a row for the same inode.
+        """
+        placeholders = ', '.join('?' for _ in names)
+        row = self.conn.execute(
+            f'SELECT COALESCE(SUM(d.size), 0) FROM ('
+            f'  SELECT DISTINCT inode, size, mtime FROM files'
+            f'  WHERE snapshot IN ({placeholders}) AND inode IS NOT NULL'
+            f') d WHERE NOT EXISTS ('
+            f'  SELECT 1 FROM files g WHERE g.inode = d.inode AND g.size = d.size'
+            f'  AND g.mtime = d.mtime AND g.snapshot NOT IN ({placeholders})'
+            f')', list(names) * 2).fetchone()
+        return row[0]
+
+    def only_in(self, name, other):
+        """Yield (path, size, mtime, hash) for files of a snapshot that have no row at the same path in another"""
+        return self.conn.execute(
+            'SELECT a.path, a.size, a.mtime, a.hash FROM files a WHERE a.snapshot = ? AND NOT EXISTS ('
+            '  SELECT 1 FROM files b WHERE b.snapshot = ? AND b.path = a.path'
+            ') ORDER BY a.path', (name, other))
+
+    def modified_between(self, old, new):
+        """Yield (path, old size, new size, old mtime, new mtime) for files whose content differs
+
+        Rows sharing an inode are hardlinks to the same data and are skipped
+        without comparing anything else.
+        """
+        return self.conn.execute(
+            'SELECT a.path, a.size, b.size, a.mtime, b.mtime FROM files a '
+            'JOIN files b ON b.snapshot = ? AND b.path = a.path '
+            'WHERE a.snapshot = ? AND (a.inode IS NULL OR b.inode IS NULL OR a.inode != b.inode) '
+            'AND (a.size != b.size OR a.mtime != b.mtime OR COALESCE(a.hash != b.hash, 0)) '
+            'ORDER BY a.path', (new, old))
+
+    def cached_checksum(self, inode, size, mtime, algorithm):
+        """Return the stored digest of a file version, or None if it was never hashed"""
+        row = self.conn.execute(
+            'SELECT digest FROM checksums WHERE inode = ? AND size = ? AND mtime = ? AND algorithm = ?',
+            (inode, size, mtime, algorithm)).fetchone()
+        return row[0] if row else None
+
+    def store_checksums(self, rows):
+        """Record (inode, size, mtime, algorithm, digest) rows as verified now"""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO checksums (inode, size, mtime, algorithm, digest, verified) '
+                'VALUES (?, ?, ?, ?, ?, ?)', [row + (now,) for row in rows])
+
+    def scrub_candidates(self, algorithm='sha256'):
+        """Yield (snapshot, path, inode, size, mtime, expected digest) once per stored file version
+
+        Versions never checked come first, then the ones checked longest ago.
+        The expected digest is the last verified one, else the hash recorded
+        at backup time.
+        """
+        return self.conn.execute(
+            'SELECT f.snapshot, f.path, f.inode, f.size, f.mtime, COALESCE(c.digest, MAX(f.hash)) '
+            'FROM files f LEFT JOIN checksums c ON c.inode = f.inode AND c.size = f.size '
+            'AND c.mtime = f.mtime AND c.algorithm = ? '
+            'WHERE f.inode IS NOT NULL GROUP BY f.inode, f.size, f.mtime '
+            'ORDER BY c.verified IS NOT NULL, c.verified', (algorithm,))
+
+    def search(self, pattern, snapshot=None):
+        """Return (snapshot, path) pairs matching a glob
+
+        Patterns containing '/' match the whole relative path, others match
+        the file name only, like restore.search_in_backup.
+        """
+        column = 'path' if '/' in pattern else 'name'
+        query = (f'SELECT f.snapshot, f.path FROM files f JOIN snapshots s ON s.name = f.snapshot '
+                 f'WHERE f.{column} GLOB ?')
+        params = [glob_to_sqlite(pattern)]
+        if snapshot is not None:
+            query += ' AND f.snapshot = ?'
+            params.append(snapshot)
+        query += ' ORDER BY f.snapshot DESC, f.path'
+        return self.conn.execute(query, params).fetchall()
+
+    def latest_versions(self, before):
+        """Return (path, snapshot) for every path, taken from the newest snapshot created at or before a time"""
+        # SQLite returns the bare snapshot column from the row holding MAX(created)
+        return self.conn.execute(
+            'SELECT f.path, f.snapshot, MAX(s.created) FROM files f '
+            'JOIN snapshots s ON s.name = f.snapshot WHERE s.created <= ? GROUP BY f.path',
+            (before,)).fetchall()
+
+    def versions(self, path):
+        """Return every indexed version of a file as (snapshot, size, mtime, hash), oldest first"""
+        return self.conn.execute(
+            'SELECT f.snapshot, f.size, f.mtime, f.hash FROM files f '
+            'JOIN snapshots s ON s.name = f.snapshot WHERE f.path = ? ORDER BY f.snapshot',
+            (path.strip('/'),)).fetchall()
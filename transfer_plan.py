@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import gzip
+import statistics
+from datetime import datetime
+
+PLAN_FILE = os.path.join('.state', 'plan.jsonl.gz')
+# Times this close count as equal, like rclone's modify window on OneDrive
+MODIFY_WINDOW = 1
+# Recent runs the throughput estimate is based on
+HISTORY_RUNS = 10
+MODTIME_RE = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|[+-]\d\d:\d\d)?$')
+
+def modtime_seconds(value):
+    """Turn an rclone ModTime string (or a Unix time) into seconds since the epoch"""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    match = MODTIME_RE.match(value)
+    if not match:
+        return None
+    zone = match.group(3) or 'Z'
+    stamp = datetime.fromisoformat(match.group(1) + ('+00:00' if zone == 'Z' else zone))
+    return stamp.timestamp() + float(match.group(2) or 0)
+
+def top_folder(path):
+    return path.split('/', 1)[0] if '/' in path else '/'
+
+def unchanged(entry, previous):
+    if previous is None or entry[0] != previous[0]:
+        return False
+    mtime = modtime_seconds(entry[1])
+    return mtime is not None and previous[1] is not None and abs(mtime - previous[1]) <= MODIFY_WINDOW
+
+def compare(listing, reference):
+    """Diff a source listing with a snapshot's {path: (size, mtime)}
+
+    Returns (changed paths, deleted paths, totals per top-level folder).
+    """
+    folders = {}
+
+    def totals(path):
+        return folders.setdefault(top_folder(path), {'files': 0, 'bytes': 0, 'transfer_files': 0,
+                                                     'transfer_bytes': 0, 'deleted': 0})
+
+    changed = []
+    for path, entry in listing.items():
+        size = max(entry[0], 0)
+        folder = totals(path)
+        folder['files'] += 1
+        folder['bytes'] += size
+        if not unchanged(entry, reference.get(path)):
+            changed.append(path)
+            folder['transfer_files'] += 1
+            folder['transfer_bytes'] += size
+    deleted = [path for path in reference if path not in listing]
+    for path in deleted:
+        totals(path)['deleted'] += 1
+    return sorted(changed), sorted(deleted), folders
+
+def read_history(backup_dest):
+    records = []
+    try:
+        with open(os.path.join(backup_dest, 'run_history.jsonl'), 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return records
+
+def historical_rates(records):
+    """Median download speed (bytes/s) and check rate (files/s) of the recent runs that moved data
+
+    Returns (speed, check rate, number of runs); rates are None without history.
+    """
+    runs = [record for record in records
+            if record.get('success') and record.get('bytes', 0) >= 1024 ** 2
+            and record.get('phases', {}).get('transfer')][-HISTORY_RUNS:]
+    speed = statistics.median(run['bytes'] / run['phases']['transfer'] for run in runs) if runs else None
+    check_rates = [run['checks_per_second'] for run in runs if run.get('checks_per_second')]
+    return speed, statistics.median(check_rates) if check_rates else None, len(runs)
+
+def estimate_seconds(transfer_bytes, check_files, speed, check_rate):
+    """Expected transfer time, or None when there is no throughput history"""
+    if not speed:
+        return None
+    return transfer_bytes / speed + (check_files / check_rate if check_rate else 0)
+
+def save_plan(backup_dest, meta, listing):
+    """Store a plan and the listing it was made from, for the next run"""
+    path = os.path.join(backup_dest, PLAN_FILE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        f.write(json.dumps(meta) + '\n')
+        for path_name, entry in listing.items():
+            f.write(json.dumps([path_name, entry[0], entry[1]]) + '\n')
+    os.replace(tmp_path, path)
+
+def load_plan(backup_dest):
+    """Return (meta, listing) of the saved plan, or (None, None)"""
+    try:
+        with gzip.open(os.path.join(backup_dest, PLAN_FILE), 'rt', encoding='utf-8') as f:
+            meta = json.loads(f.readline())
+            listing = {}
+            for line in f:
+                path, size, modtime = json.loads(line)
+                listing[path] = [size, modtime]
+        return meta, listing
+    except (OSError, ValueError, EOFError):
+        return None, None
+
+def discard_plan(backup_dest):
+    try:
+        os.remove(os.path.join(backup_dest, PLAN_FILE))
+    except FileNotFoundError:
+        pass
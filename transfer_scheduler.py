@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+
+import json
+import base64
+import heapq
+import time
+import socket
+import secrets
+import itertools
+import threading
+import urllib.request
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+UNITS = {'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# Throttling errors per check interval that make the controller back off
+THROTTLE_THRESHOLD = 3
+CHECK_INTERVAL = 60
+# Quiet intervals before the controller gives back some bandwidth
+RECOVER_AFTER = 5
+# What rclone logs when its rc server cannot listen, e.g. because another process took the port
+RC_START_FAILURE = 'Failed to start remote control'
+RC_START_ATTEMPTS = 3
+# Any Monday: timetable boundaries are turned into moments of this week to find the profile covering them
+REFERENCE_MONDAY = datetime(2024, 1, 1)
+
+def parse_days(text):
+    """Turn 'mon-fri' or 'sat,sun' into a list of weekday numbers (Monday = 0)"""
+    if not text:
+        return list(range(7))
+    days = []
+    for part in text.lower().replace(' ', '').split(','):
+        if '-' in part:
+            first, last = (DAYS.index(day[:3]) for day in part.split('-', 1))
+            days.extend(range(first, last + 1) if first <= last else list(range(first, 7)) + list(range(last + 1)))
+        else:
+            days.append(DAYS.index(part[:3]))
+    return days
+
+def parse_rate(text):
+    """Turn an rclone bandwidth like '10M' or '512k' into bytes per second; None for 'off'"""
+    if text is None or str(text).lower() in ('off', '0', ''):
+        return None
+    text = str(text).strip()
+    unit = text[-1].upper()
+    if unit in UNITS:
+        return float(text[:-1]) * UNITS[unit]
+    return float(text) * 1024  # rclone's default unit is KiB/s
+
+def format_rate(rate):
+    return 'off' if rate is None else f"{max(1, int(rate / 1024))}K"
+
+def lower_rate(first, second):
+    """The stricter of two bandwidth limits, where None means unlimited"""
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return min(first, second)
+
+def in_window(profile, now):
+    """Check whether a profile's days and start/end times cover a moment"""
+    start = profile.get('start', '00:00')
+    end = profile.get('end', '24:00')
+    clock = now.strftime('%H:%M')
+    days = parse_days(profile.get('days'))
+    if start <= end:
+        return now.weekday() in days and start <= clock < end
+    # The window runs past midnight: the morning part belongs to the previous day's window
+    if clock >= start:
+        return now.weekday() in days
+    return clock < end and (now - timedelta(days=1)).weekday() in days
+
+def replace_option(cmd, option, value):
+    """Set an option's value in an argument list, adding it if missing"""
+    cmd = list(cmd)
+    for i, arg in enumerate(cmd):
+        if arg == option and i + 1 < len(cmd):
+            cmd[i + 1] = str(value)
+            return cmd
+        if arg.startswith(option + '='):
+            cmd[i] = f"{option}={value}"
+            return cmd
+    return cmd + [option, str(value)]
+
+class RemoteControl:
+    """rclone's remote-control API on a free local port, used to change limits mid-run
+
+    Each process gets its own random user and password. They are handed to
+    rclone through the environment rather than the command line, so other
+    local users can neither see them nor call the API.
+    """
+
+    def __init__(self):
+        # The port is only free when checked; if rclone loses the race it fails to start (RC_START_FAILURE)
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.user = 'backup'
+        self.password = secrets.token_urlsafe(24)
+
+    def options(self):
+        return ['--rc', '--rc-addr', f"127.0.0.1:{self.port}"]
+
+    def environment(self):
+        """Environment for the rclone process, carrying the rc credentials"""
+        return {'RCLONE_RC_USER': self.user, 'RCLONE_RC_PASS': self.password}
+
+    def call(self, command, **params):
+        token = base64.b64encode(f"{self.user}:{self.password}".encode()).decode()
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{self.port}/{command}", data=json.dumps(params).encode(),
+            headers={'Content-Type': 'application/json', 'Authorization': f"Basic {token}"})
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return json.load(response)
+
+    def set_bwlimit(self, rate):
+        try:
+            self.call('core/bwlimit', rate=format_rate(rate))
+            return True
+        except (OSError, ValueError):
+            return False
+
+class AdaptiveThrottle:
+    """Watches one rclone process's stream and steers its bandwidth through the rc API
+
+    Repeated throttling (429/503) halves the bandwidth, starting from the
+    observed speed, and takes a worker slot away. After several quiet
+    intervals the bandwidth grows back by a quarter, up to the cap: the
+    profile's limit or, with a global budget, this process's share of it.
+    """
+
+    def __init__(self, scheduler, remote_control, cap, label='', react=True):
+        self.scheduler = scheduler
+        self.rc = remote_control
+        self.cap = cap
+        self.profile_cap = cap
+        self.rate = cap
+        self.react = react
+        self.backed_off = False
+        self.prefix = f"[{label}] " if label else ""
+        self.last_check = time.monotonic()
+        self.last_throttled = 0
+        self.quiet = 0
+
+    def set_cap(self, cap):
+        """Move the ceiling, e.g. when the global bandwidth budget is shared out again"""
+        self.cap = cap
+        if cap is not None and (self.rate is None or self.rate > cap):
+            self.apply(cap, "bandwidth budget shared out again")
+        elif not self.backed_off and self.rate != cap:
+            self.apply(cap, "bandwidth budget shared out again")
+
+    def observe(self, stream):
+        if not self.react:
+            return
+        now = time.monotonic()
+        if now - self.last_check < CHECK_INTERVAL:
+            return
+        self.last_check = now
+
+        throttled = stream.errors_by_class['throttled'] - self.last_throttled
+        self.last_throttled = stream.errors_by_class['throttled']
+        if throttled >= THROTTLE_THRESHOLD:
+            self.quiet = 0
+            self.backed_off = True
+            current = self.rate or stream.stats['speed'] or self.scheduler.min_rate * 2
+            self.apply(max(self.scheduler.min_rate, current / 2),
+                       f"{throttled} throttling errors in the last minute")
+            self.scheduler.reduce_workers()
+            return
+
+        self.quiet += 1
+        if self.quiet >= RECOVER_AFTER and self.rate is not None and self.rate != self.cap:
+            self.quiet = 0
+            raised = self.rate * 1.25
+            if self.cap is not None:
+                raised = min(raised, self.cap)
+            elif raised > 2 * max(stream.stats['speed'], 1):
+                raised = None  # the link, not the limit, is the bottleneck again
+            self.apply(raised, "no throttling for a while")
+            self.backed_off = raised != self.cap
+            self.scheduler.restore_worker()
+
+    def apply(self, rate, reason):
+        if self.rc.set_bwlimit(rate):
+            self.rate = rate
+            self.scheduler.logger.info(self.prefix + f"Bandwidth limit set to {format_rate(rate)} ({reason})")
+
+class GlobalBudget:
+    """Concurrency and bandwidth shared by the rclone processes of several accounts
+
+    At most max_processes rclone processes run at once across all accounts,
+    and total_bwlimit is split evenly between the running ones; when one
+    starts or finishes, the others' limits are changed through the rc API.
+    """
+
+    def __init__(self, max_processes=0, total_bwlimit=None, logger=None):
+        self.max_processes = max_processes
+        self.total_rate = parse_rate(total_bwlimit)
+        self.logger = logger
+        self.condition = threading.Condition()
+        self.active = 0
+        self.peak_active = 0
+        self.throttles = []
+        self.waiting = []
+        self.tickets = itertools.count()
+
+    def share(self):
+        if self.total_rate is None:
+            return None
+        with self.condition:
+            return self.total_rate / max(1, self.active)
+
+    @contextmanager
+    def process_slot(self, priority=0):
+        with self.condition:
+            # Waiting processes of higher-priority accounts get the next free slot
+            ticket = (-priority, next(self.tickets))
+            heapq.heappush(self.waiting, ticket)
+            while (self.max_processes and self.active >= self.max_processes) or self.waiting[0] != ticket:
+                self.condition.wait()
+            heapq.heappop(self.waiting)
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+            self.condition.notify_all()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+            self.rebalance()
+
+    def register(self, throttle):
+        with self.condition:
+            self.throttles.append(throttle)
+        self.rebalance()
+
+    def unregister(self, throttle):
+        with self.condition:
+            if throttle in self.throttles:
+                self.throttles.remove(throttle)
+
+    def rebalance(self):
+        if self.total_rate is None:
+            return
+        share = self.share()
+        with self.condition:
+            throttles = list(self.throttles)
+        # rc calls go over HTTP, so they are made outside the lock
+        for throttle in throttles:
+            throttle.set_cap(lower_rate(throttle.profile_cap, share))
+
+class ProfileWatch:
+    """Notices when a different profile applies than the one an rclone process started with
+
+    Each process has its own, so every parallel worker sees a window change.
+    """
+
+    def __init__(self, scheduler, profile):
+        self.scheduler = scheduler
+        self.profile = profile
+        self.last_check = time.monotonic()
+
+    def changed(self):
+        """Check (at most once a minute) whether a different profile now applies"""
+        now = time.monotonic()
+        if now - self.last_check < CHECK_INTERVAL:
+            return False
+        self.last_check = now
+        return self.scheduler.profile() != self.profile
+
+class TransferScheduler:
+    """Chooses rclone limits per time window and adapts them to throttling at run time
+
+    A profile is a dict such as {"days": "mon-fri", "start": "08:00",
+    "end": "18:00", "bwlimit": "10M", "transfers": 2, "checkers": 4,
+    "workers": 1}; the first profile covering the current time applies,
+    otherwise rclone_options and parallel_workers are used unchanged.
+    """
+
+    def __init__(self, profiles, logger, max_workers=1, adaptive=True, min_bwlimit='1M', budget=None, priority=0):
+        self.profiles = profiles or []
+        self.budget = budget
+        self.priority = priority
+        self.logger = logger
+        self.max_workers = max_workers
+        self.adaptive = adaptive
+        self.min_rate = parse_rate(min_bwlimit) or 1024 ** 2
+        self.adaptive_workers = max_workers
+        self.active = 0
+        self.peak_active = 0
+        self.throttle_backoffs = 0
+        self.condition = threading.Condition()
+
+    def profile(self, now=None):
+        now = now or datetime.now()
+        for profile in self.profiles:
+            if in_window(profile, now):
+                return profile
+        return {}
+
+    def bwlimit_timetable(self):
+        """Build an rclone --bwlimit timetable, so window boundaries take effect mid-run"""
+        if not any('bwlimit' in profile for profile in self.profiles):
+            return None
+
+        use_days = any(profile.get('days') for profile in self.profiles)
+        boundaries = set()
+        for profile in self.profiles:
+            start = profile.get('start', '00:00')
+            end = profile.get('end', '24:00')
+            for day in (parse_days(profile.get('days')) if use_days else [None]):
+                boundaries.add((day, start))
+                end_day = day if day is None or start < end else (day + 1) % 7
+                if end == '24:00':
+                    end_day, end = (None if day is None else (day + 1) % 7), '00:00'
+                boundaries.add((end_day, end))
+
+        # At every start or end, the rate is the one of the first profile covering that moment
+        entries = {}
+        for day, clock in boundaries:
+            hour, minute = (int(part) for part in clock.split(':'))
+            moment = REFERENCE_MONDAY + timedelta(days=day or 0, hours=hour, minutes=minute)
+            entries[(day, clock)] = self.profile(moment).get('bwlimit', 'off')
+
+        ordered = sorted(entries.items(), key=lambda item: (item[0][0] or 0, item[0][1]))
+        slots = []
+        previous = ordered[-1][1]  # the week wraps around
+        for (day, clock), rate in ordered:
+            if rate == previous and slots:
+                continue
+            prefix = f"{DAYS[day].capitalize()}-" if day is not None else ''
+            slots.append(f"{prefix}{clock},{rate}")
+            previous = rate
+        return ' '.join(slots)
+
+    def apply(self, cmd, profile):
+        """Return cmd with the profile's transfers, checkers and bandwidth limit"""
+        for key in ('transfers', 'checkers'):
+            if key in profile:
+                cmd = replace_option(cmd, f"--{key}", profile[key])
+        if self.budget and self.budget.total_rate:
+            # A share of the global budget is a single rate; window changes restart rclone anyway
+            rate = lower_rate(parse_rate(profile.get('bwlimit')), self.budget.share())
+            return replace_option(cmd, '--bwlimit', format_rate(rate))
+        timetable = self.bwlimit_timetable()
+        if timetable:
+            cmd = replace_option(cmd, '--bwlimit', timetable)
+        return cmd
+
+    def watch_profile(self, profile):
+        """Return a ProfileWatch for one rclone process started under profile"""
+        return ProfileWatch(self, profile)
+
+    def controller(self, profile, label='', remote_control=True):
+        """Return (extra rclone options, AdaptiveThrottle or None) for one rclone process"""
+        shared = self.budget is not None and self.budget.total_rate is not None
+        if not remote_control or (not self.adaptive and not shared):
+            return [], None
+        remote_control = RemoteControl()
+        cap = parse_rate(profile.get('bwlimit'))
+        throttle = AdaptiveThrottle(self, remote_control, lower_rate(cap, self.budget.share()) if shared else cap,
+                                    label, react=self.adaptive)
+        throttle.profile_cap = cap
+        if shared:
+            self.budget.register(throttle)
+        return remote_control.options(), throttle
+
+    def release(self, controller):
+        """Forget a finished rclone process's controller"""
+        if controller and self.budget:
+            self.budget.unregister(controller)
+
+    @contextmanager
+    def process_slot(self):
+        """Hold one of the global budget's rclone process slots, if there is a budget"""
+        if self.budget is None:
+            yield
+            return
+        with self.budget.process_slot(self.priority):
+            yield
+
+    def allowed_workers(self):
+        return max(1, min(self.max_workers, self.profile().get('workers', self.max_workers),
+                          self.adaptive_workers))
+
+    @contextmanager
+    def slot(self):
+        """Hold one of the parallel worker slots the current profile and throttling allow"""
+        with self.condition:
+            while self.active >= self.allowed_workers():
+                self.condition.wait(timeout=CHECK_INTERVAL)
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def reduce_workers(self):
+        with self.condition:
+            self.throttle_backoffs += 1
+            if self.adaptive_workers > 1:
+                self.adaptive_workers -= 1
+                self.logger.info(f"Throttled by the remote: at most {self.adaptive_workers} parallel workers")
+
+    def restore_worker(self):
+        with self.condition:
+            if self.adaptive_workers < self.max_workers:
+                self.adaptive_workers += 1
+                self.condition.notify_all()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import re
+import json
+import time
+from collections import Counter
+
+# Options that make rclone/rsync print a line per file or redraw a progress bar
+RCLONE_CHATTY_OPTIONS = {'--progress', '-P', '--verbose', '-v', '-vv', '-vvv'}
+RSYNC_CHATTY_OPTIONS = {'--progress', '--verbose', '-v', '-vv', '--human-readable', '-h'}
+
+OBJECTHANDLE_MARKERS = ("ObjectHandle is Invalid", "invalidResourceId")
+
+RSYNC_PROGRESS_RE = re.compile(
+    r'^\s*([\d,]+)\s+(\d+)%\s+(\S+)/s\s+\S+(?:\s+\(xfr#(\d+), (?:ir|to)-chk=(\d+)/(\d+)\))?')
+RCLONE_TEXT_ERROR_RE = re.compile(r'ERROR : (.+?): ')
+# rclone's end-of-attempt summaries, which repeat errors already logged per path
+RCLONE_SUMMARY_RE = re.compile(r'Attempt \d+/\d+ failed|Failed to \w+ with \d+ errors')
+# 429/503 only as HTTP statuses ("error 429", "HTTP status 503", "429 Too Many Requests"),
+# never as digits that happen to be part of a file name
+THROTTLE_RE = re.compile(
+    r'\b(?:HTTP|status|error|code)\W{1,3}(?:code\W{1,3})?(?:429|503)\b'
+    r'|Too Many Requests|Service Unavailable|throttl|activityLimitReached', re.IGNORECASE)
+
+def classify_error(message):
+    """Sort an rclone/rsync error message into a coarse class"""
+    if any(marker in message for marker in OBJECTHANDLE_MARKERS):
+        return 'objecthandle'
+    if THROTTLE_RE.search(message):
+        return 'throttled'
+    lowered = message.lower()
+    if 'not found' in lowered or 'no such file' in lowered:
+        return 'not_found'
+    if 'permission denied' in lowered or 'access denied' in lowered or 'accessdenied' in lowered:
+        return 'permission'
+    return 'other'
+
+def structured_rclone_options(options, interval):
+    """Replace per-file and progress-bar output with JSON logs and periodic stats"""
+    cleaned = [opt for opt in options if opt not in RCLONE_CHATTY_OPTIONS]
+    return cleaned + ['--use-json-log', '--stats', f"{interval}s", '--stats-log-level', 'NOTICE']
+
+def structured_rsync_options(options):
+    """Replace per-file and per-file-progress output with overall progress and stats"""
+    cleaned = [opt for opt in options if opt not in RSYNC_CHATTY_OPTIONS]
+    return cleaned + ['--info=progress2,stats2', '--no-inc-recursive']
+
+class TransferStats:
+    """Running counters for one transfer
+
+    Progress is logged at most once per interval instead of echoing every
+    line; errors are counted by class and the failing paths are kept. The
+    rclone and rsync streams below fill it from their process's output,
+    the in-process local sync updates it directly.
+    """
+
+    def __init__(self, logger, label=None, interval=30, echo=False):
+        self.logger = logger
+        self.prefix = f"[{label}] " if label else ""
+        self.interval = interval
+        self.echo = echo
+        self.started = time.time()
+        self.last_report = self.started
+        self.stats = {'bytes': 0, 'totalBytes': 0, 'transfers': 0, 'totalTransfers': 0,
+                      'checks': 0, 'errors': 0, 'speed': 0.0, 'eta': None}
+        self.errors_by_class = Counter()
+        self.failed_paths = {}
+        self.failure_messages = {}
+        self.unattributed_errors = 0  # errors that name no path, so a per-path retry can't fix them
+        self.objecthandle_count = 0
+        self.objecthandle_errors = []  # first few, for the end-of-run report
+
+    def record_error(self, path, message):
+        error_class = classify_error(message)
+        self.errors_by_class[error_class] += 1
+        if path:
+            self.failed_paths[path] = error_class
+            self.failure_messages[path] = message
+        elif not RCLONE_SUMMARY_RE.search(message):
+            self.unattributed_errors += 1
+        if error_class == 'objecthandle':
+            self.objecthandle_count += 1
+            if self.objecthandle_count <= 5:  # Only keep first 5 occurrences
+                if path and path not in message:
+                    message = f"{path}: {message}"
+                self.objecthandle_errors.append(self.prefix + message)
+
+    def maybe_report(self, force=False):
+        """Log a progress summary if the interval has passed"""
+        now = time.time()
+        if force or now - self.last_report >= self.interval:
+            self.last_report = now
+            self.logger.info(self.prefix + self.summary())
+
+    def summary(self):
+        stats = self.stats
+        gb = 1024 ** 3
+        parts = [f"{stats['bytes'] / gb:.2f}"
+                 + (f"/{stats['totalBytes'] / gb:.2f}" if stats['totalBytes'] else "") + " GB"]
+        parts.append(f"{stats['transfers']}"
+                     + (f"/{stats['totalTransfers']}" if stats['totalTransfers'] else "") + " files")
+        if stats['checks']:
+            parts.append(f"{stats['checks']} checked")
+        parts.append(f"{stats['speed'] / (1024 ** 2):.1f} MB/s")
+        error_total = sum(self.errors_by_class.values())
+        if error_total:
+            parts.append(f"{error_total} errors")
+        if stats['eta']:
+            parts.append(f"ETA {int(stats['eta']) // 60} min")
+        return "Progress: " + ", ".join(parts)
+
+    def merge(self, other, prefix=None):
+        """Add another stream's counters to this one (for parallel workers)
+
+        prefix is the folder other's paths are relative to, if any.
+        """
+        for key in ('bytes', 'totalBytes', 'transfers', 'totalTransfers', 'checks', 'errors', 'speed'):
+            self.stats[key] += other.stats[key] or 0
+        self.errors_by_class.update(other.errors_by_class)
+        for path, error_class in other.failed_paths.items():
+            full_path = f"{prefix}/{path}" if prefix else path
+            self.failed_paths[full_path] = error_class
+            self.failure_messages[full_path] = other.failure_messages.get(path, '')
+        self.unattributed_errors += other.unattributed_errors
+        self.objecthandle_count += other.objecthandle_count
+        self.objecthandle_errors.extend(other.objecthandle_errors)
+        self.started = min(self.started, other.started)
+
+    def as_record(self):
+        """Compact summary of the transfer for the run history"""
+        elapsed = max(time.time() - self.started, 1e-6)
+        return {
+            'bytes': self.stats['bytes'],
+            'files': self.stats['transfers'],
+            'checks': self.stats['checks'],
+            'errors': sum(self.errors_by_class.values()),
+            'errors_by_class': dict(self.errors_by_class),
+            'avg_speed': self.stats['bytes'] / elapsed,
+        }
+
+class RcloneStream(TransferStats):
+    """Parses rclone --use-json-log output, falling back to its text log format"""
+
+    def feed(self, line):
+        line = line.rstrip()
+        if not line:
+            return
+        if line.startswith('{'):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                entry = None
+            if isinstance(entry, dict):
+                self.handle_json(entry)
+                return
+        self.handle_text(line)
+
+    def handle_json(self, entry):
+        if 'stats' in entry:
+            for key in self.stats:
+                if key in entry['stats']:
+                    self.stats[key] = entry['stats'][key]
+            self.maybe_report()
+            return
+
+        message = entry.get('msg', '')
+        if entry.get('level') in ('error', 'critical') or any(m in message for m in OBJECTHANDLE_MARKERS):
+            self.record_error(entry.get('object'), message)
+        self.logger.debug(self.prefix + f"{entry.get('object', '')}: {message}")
+
+    def handle_text(self, line):
+        if self.echo:
+            print(self.prefix + line)
+        self.logger.debug(self.prefix + line)
+
+        if 'ERROR' in line or any(m in line for m in OBJECTHANDLE_MARKERS):
+            match = None if RCLONE_SUMMARY_RE.search(line) else RCLONE_TEXT_ERROR_RE.search(line)
+            self.record_error(match.group(1) if match else None, line)
+
+class RsyncStream(TransferStats):
+    """Parses rsync --info=progress2,stats2 output, falling back to echoing text"""
+
+    def feed(self, line):
+        line = line.rstrip()
+        if not line:
+            return
+
+        match = RSYNC_PROGRESS_RE.match(line)
+        if match:
+            self.stats['bytes'] = int(match.group(1).replace(',', ''))
+            self.stats['speed'] = self.parse_speed(match.group(3))
+            if match.group(4):
+                self.stats['transfers'] = int(match.group(4))
+                self.stats['totalTransfers'] = int(match.group(6))
+            percent = int(match.group(2))
+            if percent:
+                self.stats['totalBytes'] = self.stats['bytes'] * 100 // percent
+            self.maybe_report()
+            return
+
+        if line.startswith('rsync:') or line.startswith('rsync error:'):
+            self.record_error(None, line)
+        elif line.startswith('Number of regular files transferred:'):
+            self.stats['transfers'] = int(line.split(':', 1)[1].strip().replace(',', ''))
+
+        if self.echo:
+            print(self.prefix + line)
+        self.logger.debug(self.prefix + line)
+
+    @staticmethod
+    def parse_speed(text):
+        units = {'B': 1, 'kB': 1024, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+        match = re.match(r'([\d.,]+)(\w+)', text)
+        if not match:
+            return 0.0
+        return float(match.group(1).replace(',', '')) * units.get(match.group(2), 1)
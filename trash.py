@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+TRASH_DIR = '.trash'
+LOCK_NAME = '.purge.lock'
+
+def trash_dir(backup_dest):
+    return os.path.join(backup_dest, TRASH_DIR)
+
+def move_to_trash(backup_dest, path):
+    """Atomically move a snapshot out of sight into the trash area; return its new path"""
+    root = trash_dir(backup_dest)
+    os.makedirs(root, exist_ok=True)
+
+    target = os.path.join(root, os.path.basename(path))
+    suffix = 1
+    while os.path.lexists(target):
+        target = os.path.join(root, f"{os.path.basename(path)}.{suffix}")
+        suffix += 1
+
+    # Same filesystem, so this is a single rename no matter how big the snapshot is
+    os.rename(path, target)
+    return target
+
+def pending_items(backup_dest):
+    """Return the trashed entries still waiting to be deleted"""
+    root = trash_dir(backup_dest)
+    if not os.path.isdir(root):
+        return []
+    return [os.path.join(root, item) for item in sorted(os.listdir(root)) if item != LOCK_NAME]
+
+class RateLimiter:
+    """Token bucket shared by the deleter threads; rate 0 means unlimited"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+                self.last = now
+                if self.allowance >= 1:
+                    self.allowance -= 1
+                    return
+                wait = (1 - self.allowance) / self.rate
+            time.sleep(wait)
+
+def delete_tree(path, limiter):
+    """Delete a directory tree bottom-up, one rate-limited unlink at a time; return files removed"""
+    removed = 0
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            limiter.acquire()
+            try:
+                os.unlink(os.path.join(root, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        for name in dirs:
+            dir_path = os.path.join(root, name)
+            try:
+                if os.path.islink(dir_path):
+                    os.unlink(dir_path)
+                else:
+                    os.rmdir(dir_path)
+            except FileNotFoundError:
+                pass
+    try:
+        os.rmdir(path)
+    except FileNotFoundError:
+        pass
+    return removed
+
+def purge_item(path, workers, limiter):
+    """Delete one trashed snapshot, spreading its top-level folders across threads"""
+    if os.path.islink(path) or not os.path.isdir(path):
+        os.unlink(path)
+        return 1
+
+    subdirs = []
+    removed = 0
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+        else:
+            limiter.acquire()
+            os.unlink(entry.path)
+            removed += 1
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        removed += sum(executor.map(lambda d: delete_tree(d, limiter), subdirs))
+
+    os.rmdir(path)
+    return removed
+
+class PurgeLock:
+    """Non-blocking lock so only one deleter works on the trash at a time"""
+
+    def __init__(self, backup_dest):
+        self.path = os.path.join(trash_dir(backup_dest), LOCK_NAME)
+        self.handle = None
+
+    def acquire(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.handle = open(self.path, 'w')
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(self.handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            self.handle.close()
+            self.handle = None
+            return False
+
+    def release(self):
+        if self.handle:
+            self.handle.close()
+            self.handle = None